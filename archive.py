@@ -0,0 +1,259 @@
+#!/usr/bin/env python
+"""
+    An archive of every raw telegram, compressed per hour
+
+    The telegrams of the current hour go to a plain capture file, as --record writes
+    them. Once the hour is over that file is sealed into a chunk: blocks of five
+    minutes of records, each compressed on its own, followed by an index with the
+    time span and position of every block. A chunk is about a tenth of the raw
+    telegrams, and reading a time range decompresses only the blocks it overlaps.
+
+        <directory>/20260318-14.pmarc   sealed chunk of 14:00-15:00 UTC
+        <directory>/20260318-15.pmcap   the hour being written
+
+    Chunk layout: MAGIC, the compressed blocks, the index (INDEX_ENTRY per block),
+    and FOOTER (offset of the index, number of blocks, MAGIC).
+"""
+
+#    Copyright (C) 2016  Chris Brouwer
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import argparse
+import logging
+import os
+import struct
+import threading
+import zlib
+from datetime import datetime
+import pytz
+from capture import RECORD
+from capture import captureReader
+from capture import captureWriter
+from helpers import parseTime
+
+ARCHIVE_DIR = os.path.expanduser('~/.powermon/archive')
+
+MAGIC = b'PMARC1\n\0'
+# first received, last received, offset, compressed length, number of records
+INDEX_ENTRY = struct.Struct('<ddQII')
+# offset of the index, number of blocks, magic
+FOOTER = struct.Struct('<QI8s')
+
+CHUNK_SECONDS = {"hour": 3600, "day": 86400}
+CHUNK_FORMAT = {"hour": "%Y%m%d-%H", "day": "%Y%m%d"}
+BLOCK_SECONDS = 300
+COMPRESSION_LEVEL = 9
+
+
+def epoch(value):
+    """ Accepts an aware datetime, epoch seconds or None """
+    if value is None or isinstance(value, (int, float)):
+        return value
+    return value.timestamp()
+
+
+def sealChunk(capturePath, chunkPath, blockSeconds=BLOCK_SECONDS):
+    """ Compresses a capture file into a chunk, and removes the capture file """
+    index = []
+    tmp = chunkPath + ".tmp"
+    with open(tmp, "wb") as out:
+        out.write(MAGIC)
+        block = []
+
+        def writeBlock():
+            data = zlib.compress(b"".join(RECORD.pack(received, len(telegram)) + telegram
+                                          for received, telegram in block), COMPRESSION_LEVEL)
+            index.append((block[0][0], block[-1][0], out.tell(), len(data), len(block)))
+            out.write(data)
+
+        for received, telegram in captureReader(capturePath):
+            if block and received - block[0][0] >= blockSeconds:
+                writeBlock()
+                block = []
+            block.append((received, telegram))
+        if block:
+            writeBlock()
+        indexOffset = out.tell()
+        for entry in index:
+            out.write(INDEX_ENTRY.pack(*entry))
+        out.write(FOOTER.pack(indexOffset, len(index), MAGIC))
+        out.flush()
+        os.fsync(out.fileno())
+    os.replace(tmp, chunkPath)
+    os.remove(capturePath)
+    return index
+
+
+def readIndex(f):
+    """ Returns the index of an open chunk file """
+    f.seek(-FOOTER.size, os.SEEK_END)
+    indexOffset, count, magic = FOOTER.unpack(f.read(FOOTER.size))
+    if magic != MAGIC:
+        raise ValueError("%s is not a sealed archive chunk" % f.name)
+    f.seek(indexOffset)
+    data = f.read(count * INDEX_ENTRY.size)
+    return [INDEX_ENTRY.unpack_from(data, i * INDEX_ENTRY.size) for i in range(count)]
+
+
+def readBlock(f, offset, length):
+    f.seek(offset)
+    data = zlib.decompress(f.read(length))
+    position = 0
+    while position < len(data):
+        received, size = RECORD.unpack_from(data, position)
+        position += RECORD.size
+        yield received, data[position:position + size]
+        position += size
+
+
+class archiveWriter():
+    """ Archives telegrams. Has the interface of captureWriter, so it can take its
+        place as the recorder of a meter. Sealing a finished hour is done by a
+        background thread, so the telegram that crosses the hour doesn't wait for it. """
+    def __init__ (self, directory=ARCHIVE_DIR, chunk="hour"):
+        self.directory = directory
+        self.chunk = chunk
+        self.seconds = CHUNK_SECONDS[chunk]
+        os.makedirs(directory, exist_ok=True)
+        self.writer = None
+        self.end = None
+        self.sealing = None
+        # Captures left behind by a previous run are sealed once their hour is over
+        self.pending = sorted(name for name in os.listdir(directory) if name.endswith(".pmcap"))
+
+    def name(self, start):
+        return datetime.fromtimestamp(start, pytz.utc).strftime(CHUNK_FORMAT[self.chunk])
+
+    def write(self, received, telegram):
+        if self.end is None or received >= self.end:
+            self.rollover(received)
+        self.writer.write(received, telegram)
+
+    def rollover(self, received):
+        start = received - received % self.seconds
+        current = self.name(start) + ".pmcap"
+        if self.writer is not None:
+            self.writer.close()
+        self.pending = [name for name in self.pending if name != current]
+        if self.writer is not None:
+            self.pending.append(os.path.basename(self.writer.file.name))
+        self.writer = captureWriter(os.path.join(self.directory, current))
+        self.end = start + self.seconds
+        if self.pending and (self.sealing is None or not self.sealing.is_alive()):
+            pending, self.pending = self.pending, []
+            self.sealing = threading.Thread(target=self.seal, args=(pending,), name="archive", daemon=True)
+            self.sealing.start()
+
+    def seal(self, names):
+        for name in names:
+            capturePath = os.path.join(self.directory, name)
+            try:
+                index = sealChunk(capturePath, capturePath[:-len(".pmcap")] + ".pmarc")
+                logging.info("Archived %s: %d telegrams", name, sum(entry[4] for entry in index))
+            except Exception:
+                logging.exception("Error on archiving %s!", name)
+
+    def close(self):
+        """ Closes the current capture, which is sealed once its hour is over, by the
+            next run or by archive.py seal """
+        if self.writer is not None:
+            self.writer.close()
+        if self.sealing is not None:
+            self.sealing.join()
+
+
+class telegramArchive():
+    """ Reads an archive: iterates over the (received, telegram) records in a time
+        range, in order, decompressing only the blocks that overlap it """
+    def __init__ (self, directory=ARCHIVE_DIR):
+        self.directory = directory
+
+    def files(self):
+        """ The chunks and captures, oldest first """
+        names = [name for name in os.listdir(self.directory) if name.endswith((".pmarc", ".pmcap"))]
+        return [os.path.join(self.directory, name) for name in sorted(names)]
+
+    def chunkStart(self, path):
+        name = os.path.basename(path).rsplit(".", 1)[0]
+        format = CHUNK_FORMAT["hour"] if "-" in name else CHUNK_FORMAT["day"]
+        return pytz.utc.localize(datetime.strptime(name, format)).timestamp()
+
+    def read(self, start=None, end=None):
+        """ Yields the records with start <= received < end """
+        start = epoch(start)
+        end = epoch(end)
+        files = self.files()
+        for i, path in enumerate(files):
+            # A chunk ends where the next one starts
+            if end is not None and self.chunkStart(path) >= end:
+                break
+            if start is not None and i + 1 < len(files) and self.chunkStart(files[i + 1]) <= start:
+                continue
+            if path.endswith(".pmcap"):
+                records = captureReader(path)
+            else:
+                records = self.readChunk(path, start, end)
+            for received, telegram in records:
+                if (start is None or received >= start) and (end is None or received < end):
+                    yield received, telegram
+
+    def readChunk(self, path, start, end):
+        with open(path, "rb") as f:
+            for first, last, offset, length, count in readIndex(f):
+                if (start is not None and last < start) or (end is not None and first >= end):
+                    continue
+                yield from readBlock(f, offset, length)
+
+    def __iter__(self):
+        return self.read()
+
+
+if __name__ == '__main__':
+    argparser = argparse.ArgumentParser(description="Manage the raw telegram archive")
+    argparser.add_argument('--dir', default=ARCHIVE_DIR)
+    commands = argparser.add_subparsers(dest='command', required=True)
+    commands.add_parser('seal', help="archive finished captures left behind (powermon must not be running)")
+    show = commands.add_parser('list', help="list the chunks with their time span and size")
+    export = commands.add_parser('export', help="write a time range to a capture file, for --replay")
+    export.add_argument('output')
+    export.add_argument('--since', type=parseTime)
+    export.add_argument('--until', type=parseTime)
+    args = argparser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+
+    archive = telegramArchive(args.dir)
+    if args.command == 'seal':
+        for path in archive.files():
+            if path.endswith(".pmcap"):
+                sealChunk(path, path[:-len(".pmcap")] + ".pmarc")
+                logging.info("Archived %s", os.path.basename(path))
+    elif args.command == 'list':
+        for path in archive.files():
+            size = os.path.getsize(path)
+            if path.endswith(".pmcap"):
+                print("%s  open     %10d bytes" % (os.path.basename(path), size))
+                continue
+            with open(path, "rb") as f:
+                index = readIndex(f)
+            print("%s  %d blocks %10d bytes  %d telegrams" % (os.path.basename(path), len(index), size,
+                                                               sum(entry[4] for entry in index)))
+    else:
+        writer = captureWriter(args.output)
+        count = 0
+        for received, telegram in archive.read(args.since, args.until):
+            writer.write(received, telegram)
+            count += 1
+        writer.close()
+        logging.info("Exported %d telegrams to %s", count, args.output)
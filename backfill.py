@@ -0,0 +1,270 @@
+#!/usr/bin/env python
+"""
+    Backfill
+
+    Rebuilds the metrics.* collections from the raw readings, e.g. after downtime
+    or after a change of the rollup logic. Every month is handled by a separate
+    worker process, which streams its readings in chunks and finds the first
+    reading of every bucket with NumPy. The results are stitched together in month
+    order, and written in bulk.
+
+        python backfill.py [--meter ID] [--from 2019-01] [--to 2020-12] [--workers 4] [--dry-run]
+
+    Without --meter, the default (untagged) meter is rebuilt.
+"""
+
+#    Copyright (C) 2016  Chris Brouwer
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import argparse
+import logging
+import multiprocessing
+import os
+import time
+from datetime import datetime
+import numpy as np
+import pymongo
+import pytz
+from pymongo import MongoClient
+from pymongo import ReplaceOne
+from persistence import MONGO_URL
+from persistence import isTimeseries
+from rollup import UNIT_SECONDS
+from rollup import rollupEngine
+
+_client = None
+
+
+def boundaries(interval, start, end):
+    """ Returns the bucket starts of an interval in [start, end) and the start of the
+        bucket after each of them, as arrays of epoch seconds """
+    first = interval.floor(datetime.fromtimestamp(start, pytz.utc))
+    if interval.unit in UNIT_SECONDS:
+        seconds = UNIT_SECONDS[interval.unit] * interval.step
+        starts = np.arange(first, end, seconds, dtype=np.float64)
+        return starts, starts + seconds
+    starts = [first]
+    while True:
+        following = interval.next(starts[-1])
+        if following >= end:
+            break
+        starts.append(following)
+    starts = np.array(starts, dtype=np.float64)
+    nexts = np.append(starts[1:], interval.next(starts[-1]))
+    return starts, nexts
+
+
+def readChunks(collection, meter, start, end, chunkSize):
+    """ Streams the readings of a meter in [start, end) as (ts, t1, t2) arrays of at most
+        chunkSize """
+    query = {"meter": meter,
+             "ts": {"$gte": datetime.fromtimestamp(start, pytz.utc),
+                    "$lt": datetime.fromtimestamp(end, pytz.utc)},
+             "t1": {"$exists": True}}
+    cursor = collection.find(query, {"_id": 0, "ts": 1, "t1": 1, "t2": 1}) \
+                       .sort("ts", pymongo.ASCENDING).batch_size(chunkSize)
+    ts = np.empty(chunkSize, dtype=np.float64)
+    t1 = np.empty(chunkSize, dtype=np.float64)
+    t2 = np.empty(chunkSize, dtype=np.float64)
+    n = 0
+    for document in cursor:
+        # Documents come back as naive UTC datetimes
+        ts[n] = document["ts"].replace(tzinfo=pytz.utc).timestamp()
+        t1[n] = document["t1"]
+        t2[n] = document["t2"]
+        n += 1
+        if n == chunkSize:
+            yield ts, t1, t2
+            ts = np.empty(chunkSize, dtype=np.float64)
+            t1 = np.empty(chunkSize, dtype=np.float64)
+            t2 = np.empty(chunkSize, dtype=np.float64)
+            n = 0
+    if n:
+        yield ts[:n], t1[:n], t2[:n]
+
+
+def rollupMonth(job):
+    """ Worker: finds the first reading of every bucket in one month. Returns, per
+        collection, the bucket starts, the following bucket starts and the counters
+        of the first reading in each (non-empty) bucket. """
+    url, dbName, meter, start, end, chunkSize = job
+    global _client
+    if _client is None:
+        _client = MongoClient(url)
+    intervals = rollupEngine().intervals
+
+    bounds = {}
+    for interval in intervals:
+        starts, nexts = boundaries(interval, start, end)
+        bounds[interval.collection] = (starts, nexts, np.full(len(starts), -1, dtype=np.int64),
+                                       np.empty(len(starts)), np.empty(len(starts)))
+
+    readings = 0
+    for ts, t1, t2 in readChunks(_client[dbName].reading, meter, start, end, chunkSize):
+        readings += len(ts)
+        for starts, nexts, found, first_t1, first_t2 in bounds.values():
+            # First reading at or after every boundary; readings arrive in order, so the
+            # first chunk that has one settles the boundary for good
+            idx = np.searchsorted(ts, starts, side="left")
+            hit = (found < 0) & (idx < len(ts))
+            idx = np.minimum(idx, len(ts) - 1)
+            inBucket = hit & (ts[idx] < nexts)
+            found[hit] = np.where(inBucket[hit], 1, 0)
+            first_t1[inBucket] = t1[idx[inBucket]]
+            first_t2[inBucket] = t2[idx[inBucket]]
+
+    result = {}
+    for collection, (starts, nexts, found, first_t1, first_t2) in bounds.items():
+        keep = found == 1
+        result[collection] = (starts[keep], nexts[keep], first_t1[keep], first_t2[keep])
+    return start, readings, result
+
+
+def precedingBucket(collection, meter, interval, start):
+    """ Returns the bucket before the one starting at start, with the counters of its
+        first reading, in the form rollupMonth returns them. None if it has no readings. """
+    previous = interval.floor(datetime.fromtimestamp(start - 1, pytz.utc))
+    document = collection.find_one({"meter": meter,
+                                    "ts": {"$gte": datetime.fromtimestamp(previous, pytz.utc),
+                                           "$lt": datetime.fromtimestamp(start, pytz.utc)},
+                                    "t1": {"$exists": True}},
+                                   sort=[("ts", pymongo.ASCENDING)])
+    if document is None:
+        return None
+    return (np.array([previous]), np.array([float(start)]),
+            np.array([document["t1"]], dtype=np.float64), np.array([document["t2"]], dtype=np.float64))
+
+
+def stitch(parts, seed=None):
+    """ Joins the per month results of one collection, and computes the deltas the same
+        way the rollup engine does: zero after a gap. The first bucket only gets a delta
+        from seed, the bucket before it as precedingBucket returns it. Without a seed it
+        is left out, so an existing document for it isn't overwritten. """
+    if seed is not None:
+        parts = [seed] + parts
+    starts = np.concatenate([p[0] for p in parts])
+    nexts = np.concatenate([p[1] for p in parts])
+    t1 = np.concatenate([p[2] for p in parts])
+    t2 = np.concatenate([p[3] for p in parts])
+    adjacent = np.zeros(len(starts), dtype=bool)
+    adjacent[1:] = nexts[:-1] == starts[1:]
+    d_t1 = np.zeros(len(starts))
+    d_t2 = np.zeros(len(starts))
+    d_t1[1:] = np.where(adjacent[1:], np.round(t1[1:] - t1[:-1], 5), 0)
+    d_t2[1:] = np.where(adjacent[1:], np.round(t2[1:] - t2[:-1], 5), 0)
+    return starts[1:], t1[1:], t2[1:], d_t1[1:], d_t2[1:], np.round(d_t1[1:] + d_t2[1:], 5)
+
+
+def write(db, collection, meter, columns, batchSize=5000):
+    starts, t1, t2, d_t1, d_t2, d_total = columns
+    documents = ({"ts": datetime.fromtimestamp(starts[i], pytz.utc),
+                  "t1": float(t1[i]), "t2": float(t2[i]),
+                  "d_t1": float(d_t1[i]), "d_t2": float(d_t2[i]), "d_total": float(d_total[i])}
+                 for i in range(len(starts)))
+    timeseries = isTimeseries(db, collection)
+    if timeseries and len(starts):
+        # No upserts on time-series collections, so replace the whole range instead
+        db[collection].delete_many({"meter": meter,
+                                    "ts": {"$gte": datetime.fromtimestamp(starts[0], pytz.utc),
+                                           "$lte": datetime.fromtimestamp(starts[-1], pytz.utc)}})
+    batch = []
+    for document in documents:
+        if meter is not None:
+            document["meter"] = meter
+        batch.append(document if timeseries else
+                     ReplaceOne({"ts": document["ts"], "meter": meter}, document, upsert=True))
+        if len(batch) >= batchSize:
+            flush(db[collection], batch, timeseries)
+            batch = []
+    if batch:
+        flush(db[collection], batch, timeseries)
+
+
+def flush(collection, batch, timeseries):
+    if timeseries:
+        collection.insert_many(batch, ordered=False)
+    else:
+        collection.bulk_write(batch, ordered=False)
+
+
+def months(first, last, tz):
+    """ Returns the [start, end) epoch ranges of the local months from first up to and
+        including last """
+    month = [i for i in rollupEngine(tz=tz).intervals if i.unit == "month"][0]
+    start = month.floor(first)
+    ranges = []
+    while start <= last.timestamp():
+        end = month.next(start)
+        ranges.append((start, end))
+        start = end
+    return ranges
+
+
+def main():
+    argparser = argparse.ArgumentParser(description="Rebuild the metrics from the raw readings")
+    argparser.add_argument('--url', default=MONGO_URL)
+    argparser.add_argument('--db', default='powermon')
+    argparser.add_argument('--meter', help="meter id, leave out for the default meter")
+    argparser.add_argument('--from', dest='first', help="first month, YYYY-MM")
+    argparser.add_argument('--to', dest='last', help="last month, YYYY-MM")
+    argparser.add_argument('--workers', type=int, default=os.cpu_count())
+    argparser.add_argument('--chunk', type=int, default=100000, help="readings per chunk")
+    argparser.add_argument('--dry-run', action='store_true', help="compute, but don't write")
+    args = argparser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    tz = pytz.timezone("Europe/Amsterdam")
+    db = MongoClient(args.url)[args.db]
+    query = {"meter": args.meter, "t1": {"$exists": True}}
+    oldest = db.reading.find_one(query, sort=[("ts", pymongo.ASCENDING)])
+    newest = db.reading.find_one(query, sort=[("ts", pymongo.DESCENDING)])
+    if oldest is None:
+        logging.info("No readings with counters, nothing to do")
+        return
+    first = oldest["ts"].replace(tzinfo=pytz.utc)
+    last = newest["ts"].replace(tzinfo=pytz.utc)
+    if args.first:
+        first = max(first, tz.localize(datetime.strptime(args.first, "%Y-%m")))
+    if args.last:
+        last = min(last, tz.localize(datetime.strptime(args.last, "%Y-%m")))
+
+    started = time.monotonic()
+    jobs = [(args.url, args.db, args.meter, start, end, args.chunk) for start, end in months(first, last, tz)]
+    logging.info("Backfilling %d months with %d workers", len(jobs), args.workers)
+    parts = {}
+    readings = 0
+    with multiprocessing.Pool(args.workers) as pool:
+        # imap keeps the months in order, which stitching relies on
+        for start, count, result in pool.imap(rollupMonth, jobs):
+            readings += count
+            logging.info("%s: %d readings", datetime.fromtimestamp(start, tz).strftime("%Y-%m"), count)
+            for collection, part in result.items():
+                parts.setdefault(collection, []).append(part)
+
+    intervals = {i.collection: i for i in rollupEngine(tz=tz).intervals}
+    for collection, collectionParts in parts.items():
+        starts = np.concatenate([p[0] for p in collectionParts])
+        seed = None
+        if len(starts):
+            seed = precedingBucket(db.reading, args.meter, intervals[collection], starts[0])
+        columns = stitch(collectionParts, seed)
+        logging.info("%s: %d buckets", collection, len(columns[0]))
+        if not args.dry_run:
+            write(db, collection, args.meter, columns)
+    logging.info("Processed %d readings in %.1f s", readings, time.monotonic() - started)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,5 @@
+"""
+    Micro-benchmarks for PowerMon. Run them from the repository root, e.g.
+
+        python -m benchmarks.parser
+"""
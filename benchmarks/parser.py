@@ -0,0 +1,84 @@
+"""
+    Compares the throughput of the telegram parser with the line based
+    processLine it replaced.
+
+        python -m benchmarks.parser [--number N] [--repeat R]
+"""
+
+import argparse
+from datetime import datetime
+from time import perf_counter
+import pytz
+
+from helpers import reading
+from obis import telegramParser
+from benchmarks import samples
+
+
+class legacyParser():
+    """ The original p1Interface.processLine, kept here as the baseline """
+    def __init__ (self):
+        self.tz = pytz.timezone("Europe/Amsterdam")
+
+    def parse(self, telegram):
+        self.values = {}
+        for p1_raw in telegram.splitlines():
+            self.processLine(str(p1_raw))
+        return reading.fromDict(self.values)
+
+    def processLine(self, line):
+        line=line.replace("\x00", "")
+        if "0-0:1.0.0" in line:
+            i_start = line.index('(')
+            i_end = line.index(')')
+            if (line.find('W') > -1):
+               i_end = line.index('W')
+            try:
+               date = datetime.strptime( line[i_start+1:i_end], '%y%m%d%H%M%SS')
+            except ValueError:
+              date = datetime.strptime( line[i_start+1:i_end], '%y%m%d%H%M%S')
+            self.values['timestamp'] = self.tz.localize(date).astimezone(pytz.utc)
+        elif "1-0:1.7.0" in line:
+            i_start = line.index('(')
+            i_end = line.index('*')
+            self.values['consumption'] = float(line[i_start+1:i_end])
+        elif "1-0:1.8.1" in line:
+            i_start = line.index('(')
+            i_end = line.index('*')
+            self.values['t1'] = float(line[i_start+1:i_end])
+        elif "1-0:1.8.2" in line:
+            i_start = line.index('(')
+            i_end = line.index('*')
+            self.values['t2'] = float(line[i_start+1:i_end])
+
+
+def measure(parse, telegram, number, repeat):
+    """ Returns the best telegrams/s out of `repeat` runs of `number` parses """
+    best = None
+    for _ in range(repeat):
+        start = perf_counter()
+        for _ in range(number):
+            parse(telegram)
+        elapsed = perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return number / best
+
+
+def main():
+    argparser = argparse.ArgumentParser(description=__doc__)
+    argparser.add_argument('--number', type=int, default=5000)
+    argparser.add_argument('--repeat', type=int, default=5)
+    args = argparser.parse_args()
+
+    legacy = legacyParser()
+    parser = telegramParser()
+    print('{:<10} {:>16} {:>16} {:>8}'.format('telegram', 'processLine/s', 'parse/s', 'speedup'))
+    for name, telegram in (('DSMR 5', samples.DSMR5), ('DSMR 2.2', samples.DSMR22)):
+        old = measure(legacy.parse, telegram, args.number, args.repeat)
+        new = measure(parser.parse, telegram, args.number, args.repeat)
+        print('{:<10} {:>16,.0f} {:>16,.0f} {:>7.1f}x'.format(name, old, new, new / old))
+
+
+if __name__ == '__main__':
+    main()
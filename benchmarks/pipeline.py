@@ -0,0 +1,250 @@
+"""
+    End-to-end benchmark of the powermon pipeline: framing, parsing, storing,
+    rolling up and forwarding, with an in-memory Mongo stand-in (or a scratch SQLite
+    database, or the memory backend) and a local HTTP sink in place of DSMR-reader.
+
+        python -m benchmarks.pipeline [--telegrams N] [--backend mongo|sqlite|memory]
+                                      [--compare results/old.json]
+
+    Reports throughput, p50/p99 latency per stage and memory allocated per
+    telegram, and saves the results as JSON (in benchmarks/results by default),
+    so runs can be compared to catch regressions.
+"""
+
+import argparse
+import json
+import os
+import platform
+import re
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime
+from datetime import timedelta
+from time import perf_counter
+
+from framer import crc16
+from framer import telegramFramer
+from forwarder import fanOutForwarder
+from persistence import BACKENDS
+from persistence import createPersistence
+from powermon import p1Interface
+from powermon import powermon
+from sinks import forwardSink
+from benchmarks import samples
+from benchmarks.standins import httpSink
+from benchmarks.standins import memoryMongoClient
+
+STAGES = ("frame", "parse", "store", "rollup", "forward")
+
+
+def syntheticTelegrams(count, start=datetime(2019, 3, 31, 0, 0, 0)):
+    """ Turns the sample DSMR 5 telegram into a stream with increasing timestamps and
+        counters, and valid CRCs """
+    template = samples.DSMR5[:samples.DSMR5.index(b'!') + 1]
+    t1 = 4472.854
+    t2 = 4314.219
+    telegrams = []
+    for i in range(count):
+        ts = start + timedelta(seconds=i)
+        t1 += 0.0001
+        body = re.sub(rb'0-0:1\.0\.0\(\d+W?S?\)', b'0-0:1.0.0(' + ts.strftime('%y%m%d%H%M%S').encode() + b'W)', template)
+        body = re.sub(rb'1-0:1\.8\.1\([\d.]+', b'1-0:1.8.1(%010.3f' % t1, body)
+        body = re.sub(rb'1-0:1\.8\.2\([\d.]+', b'1-0:1.8.2(%010.3f' % t2, body)
+        telegrams.append(body + b'%04X\r\n' % crc16(body))
+    return telegrams
+
+
+def percentile(samples, fraction):
+    return samples[min(len(samples) - 1, int(len(samples) * fraction))]
+
+
+def buildPipeline(sink, spoolDir, backend):
+    forwarder = fanOutForwarder([(sink.url, 'benchmark')], spoolDir)
+    if backend == 'mongo':
+        persistence = createPersistence('mongo', client=memoryMongoClient())
+    elif backend == 'sqlite':
+        persistence = createPersistence('sqlite', path=os.path.join(spoolDir, 'powermon.db'))
+    else:
+        persistence = createPersistence(backend)
+    return powermon(p1Interface(port=None), persistence, forwarder)
+
+
+def runStages(instance, forward, framer, telegram, clock):
+    """ Pushes one telegram through all stages, and returns clock() before the first
+        and after each """
+    times = [clock()]
+    telegram = framer.feed(telegram)[0]
+    times.append(clock())
+    reading = instance.p1.parseTelegram(telegram)
+    times.append(clock())
+    instance.persistence.storeReading(reading)
+    times.append(clock())
+    instance.persistence.updateMetrics(reading)
+    times.append(clock())
+    forward.write(instance.p1.meter, None, telegram, reading)
+    times.append(clock())
+    return times
+
+
+def measureLatency(telegrams, sink, spoolDir, backend):
+    instance = buildPipeline(sink, spoolDir, backend)
+    forward = forwardSink(instance.forwarder)
+    framer = telegramFramer()
+    durations = {stage: [] for stage in STAGES}
+    total = []
+    start = perf_counter()
+    for telegram in telegrams:
+        times = runStages(instance, forward, framer, telegram, perf_counter)
+        for i, stage in enumerate(STAGES):
+            durations[stage].append(times[i + 1] - times[i])
+        total.append(times[-1] - times[0])
+    elapsed = perf_counter() - start
+
+    # Let the background workers catch up, to see how they keep up
+    deadline = time.monotonic() + 60
+    while sink.received < len(telegrams) and time.monotonic() < deadline:
+        time.sleep(0.05)
+    forwarded = instance.forwarder.stats()[0]
+    instance.close()
+    buffer = getattr(instance.persistence, 'buffer', None)
+
+    results = {"throughput": len(telegrams) / elapsed, "stages": {}}
+    for stage, samples_ in list(durations.items()) + [("total", total)]:
+        samples_.sort()
+        results["stages"][stage] = {"mean_us": 1e6 * sum(samples_) / len(samples_),
+                                    "p50_us": 1e6 * percentile(samples_, 0.50),
+                                    "p99_us": 1e6 * percentile(samples_, 0.99)}
+    results["forward"] = {"delivered": sink.received,
+                          "latency_avg_ms": 1000 * (forwarded["latency_avg"] or 0),
+                          "latency_max_ms": 1000 * forwarded["latency_max"]}
+    if buffer is not None:
+        flushed = buffer.stats()
+        results["write_behind"] = {"flushes": flushed["flushes"],
+                                   "flush_size_avg": flushed["flush_size_avg"],
+                                   "flush_latency_avg_ms": 1000 * (flushed["flush_latency_avg"] or 0)}
+    return results
+
+
+def measureAllocations(telegrams, sink, spoolDir, backend):
+    """ Peak memory allocated within each stage, per telegram, traced with tracemalloc """
+    instance = buildPipeline(sink, spoolDir, backend)
+    forward = forwardSink(instance.forwarder)
+    framer = telegramFramer()
+    allocated = dict.fromkeys(STAGES, 0)
+
+    def mark():
+        # Memory in use now, and the most in use since the previous mark
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.reset_peak()
+        return current, peak
+
+    tracemalloc.start()
+    blocks = sys.getallocatedblocks()
+    for telegram in telegrams:
+        marks = runStages(instance, forward, framer, telegram, mark)
+        for i, stage in enumerate(STAGES):
+            allocated[stage] += marks[i + 1][1] - marks[i][0]
+    retained = sys.getallocatedblocks() - blocks
+    tracemalloc.stop()
+    instance.close()
+    results = {stage: total / len(telegrams) for stage, total in allocated.items()}
+    results["total"] = sum(results.values())
+    return {"alloc_bytes": results, "retained_blocks": retained / len(telegrams)}
+
+
+def flatten(results):
+    """ Turns the results into metric -> (value, higher is better) for comparing """
+    metrics = {"throughput": (results["throughput"], True)}
+    for stage, values in results["stages"].items():
+        metrics["%s.p50_us" % stage] = (values["p50_us"], False)
+        metrics["%s.p99_us" % stage] = (values["p99_us"], False)
+    for stage, value in results["alloc_bytes"].items():
+        metrics["%s.alloc_bytes" % stage] = (value, False)
+    return metrics
+
+
+def compare(old, new, threshold):
+    """ Prints the differences between two runs, and returns the number of regressions """
+    regressions = 0
+    oldMetrics = flatten(old)
+    print('\n{:<22} {:>14} {:>14} {:>9}'.format('metric', 'baseline', 'this run', 'change'))
+    for name, (value, higherIsBetter) in flatten(new).items():
+        if name not in oldMetrics or not oldMetrics[name][0]:
+            continue
+        baseline = oldMetrics[name][0]
+        change = (value - baseline) / baseline
+        worse = -change if higherIsBetter else change
+        flag = ''
+        if worse > threshold:
+            flag = '  REGRESSION'
+            regressions += 1
+        print('{:<22} {:>14.1f} {:>14.1f} {:>+8.1%}{}'.format(name, baseline, value, change, flag))
+    return regressions
+
+
+def gitRevision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except Exception:
+        return None
+
+
+def main():
+    argparser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    argparser.add_argument('--telegrams', type=int, default=5000)
+    argparser.add_argument('--alloc-telegrams', type=int, default=500,
+                           help="telegrams for the (slower) allocation pass")
+    argparser.add_argument('--backend', choices=BACKENDS, default='mongo',
+                           help="persistence backend; mongo runs against an in-memory stand-in")
+    argparser.add_argument('--output', default=os.path.join(os.path.dirname(__file__), 'results'))
+    argparser.add_argument('--compare', metavar='FILE', help="results of an earlier run to compare with")
+    argparser.add_argument('--threshold', type=float, default=0.10,
+                           help="relative change that counts as a regression (default 0.10)")
+    args = argparser.parse_args()
+
+    telegrams = syntheticTelegrams(max(args.telegrams, args.alloc_telegrams))
+    sink = httpSink()
+    try:
+        with tempfile.TemporaryDirectory() as spoolDir:
+            results = measureLatency(telegrams[:args.telegrams], sink,
+                                     os.path.join(spoolDir, 'latency'), args.backend)
+            results.update(measureAllocations(telegrams[:args.alloc_telegrams], sink,
+                                              os.path.join(spoolDir, 'alloc'), args.backend))
+    finally:
+        sink.close()
+    results["meta"] = {"date": datetime.now().isoformat(timespec='seconds'),
+                       "revision": gitRevision(),
+                       "python": platform.python_version(),
+                       "machine": platform.machine(),
+                       "telegrams": args.telegrams,
+                       "backend": args.backend}
+
+    print('Throughput: {:,.0f} telegrams/s'.format(results["throughput"]))
+    print('{:<10} {:>10} {:>10} {:>10} {:>14}'.format('stage', 'mean us', 'p50 us', 'p99 us', 'alloc B/tg'))
+    for stage, values in results["stages"].items():
+        print('{:<10} {:>10.1f} {:>10.1f} {:>10.1f} {:>14.0f}'.format(
+            stage, values["mean_us"], values["p50_us"], values["p99_us"], results["alloc_bytes"][stage]))
+    print('Retained blocks per telegram: {:.2f}'.format(results["retained_blocks"]))
+    print('Forwarded: {delivered}, avg latency {latency_avg_ms:.2f} ms'.format(**results["forward"]))
+    if "write_behind" in results:
+        print('Write-behind: {flushes} flushes, avg latency {flush_latency_avg_ms:.2f} ms'.format(**results["write_behind"]))
+
+    os.makedirs(args.output, exist_ok=True)
+    path = os.path.join(args.output, 'pipeline-%s.json' % datetime.now().strftime('%Y%m%d-%H%M%S'))
+    with open(path, 'w') as f:
+        json.dump(results, f, indent=2)
+    print('Results saved to', path)
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(json.load(f), results, args.threshold)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,118 @@
+"""
+    Measures what the schema provisioning buys: the startup queries (last document
+    of every metrics collection) and typical range queries, on a scratch database
+    filled with synthetic data, before and after provisionSchema.
+
+        python -m benchmarks.queries [--url mongodb://localhost:27017/] [--timeseries]
+
+    The scratch database (powermon_bench by default) is dropped afterwards.
+"""
+
+import argparse
+from datetime import datetime, timedelta
+from time import perf_counter
+import pymongo
+from pymongo import MongoClient
+
+from persistence import METRICS_COLLECTIONS, provisionSchema, migrateToTimeseries
+
+STEPS = {"metrics.1m": timedelta(minutes=1), "metrics.minute": timedelta(minutes=5),
+         "metrics.15m": timedelta(minutes=15), "metrics.hour": timedelta(hours=1),
+         "metrics.day": timedelta(days=1), "metrics.month": timedelta(days=30)}
+
+
+def fill(db, collection, start, end, step, batchSize=10000):
+    batch = []
+    ts = start
+    counter = 0.0
+    while ts < end:
+        counter += 0.01
+        batch.append({"ts": ts, "t1": counter, "t2": counter, "d_t1": 0.01, "d_t2": 0.01,
+                      "d_total": 0.02, "consumption": 0.4})
+        if len(batch) >= batchSize:
+            db[collection].insert_many(batch, ordered=False)
+            batch = []
+        ts += step
+    if batch:
+        db[collection].insert_many(batch, ordered=False)
+
+
+def timed(function, repeat):
+    best = None
+    for _ in range(repeat):
+        start = perf_counter()
+        result = function()
+        elapsed = perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best, result
+
+
+def examined(cursor):
+    try:
+        return cursor.explain()["executionStats"]["totalDocsExamined"]
+    except Exception:
+        return None
+
+
+def measure(db, end, repeat):
+    results = []
+
+    def startup():
+        return [db[name].find_one(sort=[("ts", pymongo.DESCENDING)]) for name in METRICS_COLLECTIONS]
+    elapsed, _ = timed(startup, repeat)
+    docs = [examined(db[name].find().sort("ts", pymongo.DESCENDING).limit(1)) for name in METRICS_COLLECTIONS]
+    docs = None if None in docs else sum(docs)
+    results.append(("startup (last of %d collections)" % len(METRICS_COLLECTIONS), elapsed, docs))
+
+    month = {"ts": {"$gte": end - timedelta(days=31), "$lt": end}}
+    elapsed, _ = timed(lambda: list(db["metrics.minute"].find(month, {"d_total": 1})), repeat)
+    results.append(("metrics.minute, last month", elapsed, examined(db["metrics.minute"].find(month))))
+
+    hour = {"ts": {"$gte": end - timedelta(hours=1), "$lt": end}}
+    elapsed, _ = timed(lambda: list(db["reading"].find(hour, {"consumption": 1})), repeat)
+    results.append(("reading, last hour", elapsed, examined(db["reading"].find(hour))))
+    return results
+
+
+def main():
+    argparser = argparse.ArgumentParser(description=__doc__)
+    argparser.add_argument('--url', default='mongodb://localhost:27017/')
+    argparser.add_argument('--db', default='powermon_bench')
+    argparser.add_argument('--days', type=int, default=3, help="days of 1 Hz readings")
+    argparser.add_argument('--years', type=int, default=3, help="years of metrics")
+    argparser.add_argument('--repeat', type=int, default=5)
+    argparser.add_argument('--timeseries', action='store_true',
+                           help="migrate reading and metrics.minute to time-series collections")
+    argparser.add_argument('--keep', action='store_true', help="don't drop the scratch database")
+    args = argparser.parse_args()
+
+    client = MongoClient(args.url)
+    client.drop_database(args.db)
+    db = client[args.db]
+
+    end = datetime(2020, 1, 1)
+    print("Filling %s with synthetic data..." % args.db)
+    fill(db, "reading", end - timedelta(days=args.days), end, timedelta(seconds=1))
+    for name in METRICS_COLLECTIONS:
+        fill(db, name, end - timedelta(days=365 * args.years), end, STEPS[name])
+
+    before = measure(db, end, args.repeat)
+    timeseries = ("reading", "metrics.minute") if args.timeseries else ()
+    for name in timeseries:
+        migrateToTimeseries(db, name)
+    provisionSchema(db, timeseries)
+    after = measure(db, end, args.repeat)
+
+    print('{:<34} {:>12} {:>12} {:>14} {:>14}'.format('query', 'before (ms)', 'after (ms)',
+                                                     'docs before', 'docs after'))
+    for (name, old, oldDocs), (_, new, newDocs) in zip(before, after):
+        print('{:<34} {:>12.2f} {:>12.2f} {:>14} {:>14}'.format(name, old * 1000, new * 1000,
+                                                              str(oldDocs), str(newDocs)))
+
+    if not args.keep:
+        client.drop_database(args.db)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,69 @@
+"""
+    Sample telegrams, as received from real meters
+"""
+
+# DSMR 5 (Iskra AM550), with CRC
+DSMR5 = (
+    b'/ISK5\\2M550T-1012\r\n'
+    b'\r\n'
+    b'1-3:0.2.8(50)\r\n'
+    b'0-0:1.0.0(190331103512S)\r\n'
+    b'0-0:96.1.1(4530303434303037313331363530363137)\r\n'
+    b'1-0:1.8.1(004472.854*kWh)\r\n'
+    b'1-0:1.8.2(004314.219*kWh)\r\n'
+    b'1-0:2.8.1(000000.000*kWh)\r\n'
+    b'1-0:2.8.2(000000.000*kWh)\r\n'
+    b'0-0:96.14.0(0002)\r\n'
+    b'1-0:1.7.0(00.327*kW)\r\n'
+    b'1-0:2.7.0(00.000*kW)\r\n'
+    b'0-0:96.7.21(00010)\r\n'
+    b'0-0:96.7.9(00004)\r\n'
+    b'1-0:99.97.0(2)(0-0:96.7.19)(180215090315W)(0000009011*s)(170223083107W)(0000004216*s)\r\n'
+    b'1-0:32.32.0(00007)\r\n'
+    b'1-0:52.32.0(00007)\r\n'
+    b'1-0:72.32.0(00007)\r\n'
+    b'1-0:32.36.0(00000)\r\n'
+    b'1-0:52.36.0(00000)\r\n'
+    b'1-0:72.36.0(00000)\r\n'
+    b'0-0:96.13.0()\r\n'
+    b'1-0:32.7.0(230.0*V)\r\n'
+    b'1-0:52.7.0(231.0*V)\r\n'
+    b'1-0:72.7.0(229.0*V)\r\n'
+    b'1-0:31.7.0(000*A)\r\n'
+    b'1-0:51.7.0(001*A)\r\n'
+    b'1-0:71.7.0(000*A)\r\n'
+    b'1-0:21.7.0(00.081*kW)\r\n'
+    b'1-0:41.7.0(00.172*kW)\r\n'
+    b'1-0:61.7.0(00.073*kW)\r\n'
+    b'1-0:22.7.0(00.000*kW)\r\n'
+    b'1-0:42.7.0(00.000*kW)\r\n'
+    b'1-0:62.7.0(00.000*kW)\r\n'
+    b'0-1:24.1.0(003)\r\n'
+    b'0-1:96.1.0(4730303339303031363532303530323136)\r\n'
+    b'0-1:24.2.1(190331103000S)(03911.932*m3)\r\n'
+    b'!C164\r\n'
+)
+
+# DSMR 2.2 (Kaifa), no CRC and gas on a continuation line
+DSMR22 = (
+    b'/KMP5 KA6U001585575011\r\n'
+    b'\r\n'
+    b'0-0:96.1.1(204B413655303031353835353735303131)\r\n'
+    b'1-0:1.8.1(03436.123*kWh)\r\n'
+    b'1-0:1.8.2(04118.461*kWh)\r\n'
+    b'1-0:2.8.1(00000.000*kWh)\r\n'
+    b'1-0:2.8.2(00000.000*kWh)\r\n'
+    b'0-0:96.14.0(0001)\r\n'
+    b'1-0:1.7.0(0000.43*kW)\r\n'
+    b'1-0:2.7.0(0000.00*kW)\r\n'
+    b'0-0:17.0.0(999*A)\r\n'
+    b'0-0:96.3.10(1)\r\n'
+    b'0-0:96.13.1()\r\n'
+    b'0-0:96.13.0()\r\n'
+    b'0-1:24.1.0(3)\r\n'
+    b'0-1:96.1.0(3238313031453631373038383330343136)\r\n'
+    b'0-1:24.3.0(121209110000)(00)(60)(1)(0-1:24.2.1)(m3)\r\n'
+    b'(01234.567)\r\n'
+    b'0-1:24.4.0(1)\r\n'
+    b'!\r\n'
+)
@@ -0,0 +1,117 @@
+"""
+    In-process stand-ins for the external services powermon talks to, so the
+    pipeline can be benchmarked without a Mongo server or a DSMR-reader host.
+"""
+
+import threading
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+from pymongo import InsertOne
+from pymongo import ReplaceOne
+from pymongo import UpdateOne
+
+
+class memoryCollection():
+    """ Just enough of a pymongo collection for mongoPersistence """
+    def __init__ (self):
+        self.documents = []
+        self.keyed = {}
+        self.lock = threading.Lock()
+
+    def insert_one(self, document):
+        with self.lock:
+            self.documents.append(document)
+
+    def insert_many(self, documents, ordered=True):
+        with self.lock:
+            self.documents.extend(documents)
+
+    def bulk_write(self, operations, ordered=True):
+        with self.lock:
+            for operation in operations:
+                if isinstance(operation, InsertOne):
+                    self.documents.append(operation._doc)
+                elif isinstance(operation, (ReplaceOne, UpdateOne)):
+                    key = tuple(sorted(operation._filter.items()))
+                    document = operation._doc.get("$set", operation._doc)
+                    if key not in self.keyed:
+                        self.documents.append(document)
+                    else:
+                        self.documents[self.keyed[key]] = document
+                        continue
+                    self.keyed[key] = len(self.documents) - 1
+                else:
+                    raise TypeError("Unsupported operation %r" % operation)
+
+    def find_one(self, filter=None, sort=None):
+        with self.lock:
+            if not self.documents:
+                return None
+            if sort:
+                field, direction = sort[0]
+                pick = max if direction < 0 else min
+                return pick(self.documents, key=lambda document: document[field])
+            return self.documents[0]
+
+    def count_documents(self, filter):
+        return len(self.documents)
+
+    def create_index(self, keys, **kwargs):
+        return kwargs.get("name")
+
+
+class memoryDatabase(dict):
+    def __missing__(self, name):
+        collection = self[name] = memoryCollection()
+        return collection
+
+    def list_collection_names(self):
+        return list(self)
+
+    def list_collections(self, filter=None):
+        return [{"name": name, "type": "collection"} for name in self
+                if not filter or filter.get("name") == name]
+
+
+class memoryMongoClient(dict):
+    """ Stands in for MongoClient, keeping everything in memory """
+    def __missing__(self, name):
+        database = self[name] = memoryDatabase()
+        return database
+
+    def close(self):
+        pass
+
+
+class httpSink():
+    """ A local HTTP server that accepts every POST like DSMR-reader does """
+    def __init__ (self):
+        sink = self
+        self.received = 0
+        self.lock = threading.Lock()
+
+        class handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_POST(self):
+                self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                with sink.lock:
+                    sink.received += 1
+                self.send_response(201)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:%d/api/v1/datalogger/dsmrreading" % self.server.server_port
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+"""
+    Recording and replaying of raw telegram streams
+
+    A capture file starts with a short magic header, followed by one record per
+    telegram: the receive time (epoch seconds, double), the length of the telegram
+    (unsigned int) and the raw telegram bytes.
+"""
+
+#    Copyright (C) 2016  Chris Brouwer
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import logging
+import os
+import struct
+from time import perf_counter
+from time import sleep
+from instrumentation import formatSnapshot
+from instrumentation import stats
+
+MAGIC = b'PMCAP1\n'
+RECORD = struct.Struct('<dI')
+
+
+class captureWriter():
+    """ Appends telegrams to a capture file """
+    def __init__ (self, path):
+        self.file = open(path, 'ab')
+        if self.file.tell() == 0:
+            self.file.write(MAGIC)
+
+    def write(self, received, telegram):
+        self.file.write(RECORD.pack(received, len(telegram)))
+        self.file.write(telegram)
+        # One telegram per second or so; flushing keeps the capture usable after a crash
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+class captureReader():
+    """ Iterates over the (received, telegram) records of a capture file """
+    def __init__ (self, path):
+        self.path = path
+
+    def __iter__(self):
+        with open(self.path, 'rb') as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise ValueError("%s is not a capture file" % self.path)
+            while True:
+                header = f.read(RECORD.size)
+                if len(header) < RECORD.size:
+                    break
+                received, length = RECORD.unpack(header)
+                telegram = f.read(length)
+                if len(telegram) < length:
+                    logging.warning("Capture %s ends with a truncated record", self.path)
+                    break
+                yield received, telegram
+
+
+def replayCapture(instance, path, speed=1.0):
+    """ Feeds a capture through the pipeline of a powermon instance: parse, store, roll up
+        and forward. With speed 1 the telegrams are paced as they were received, with
+        speed N N times as fast, and with speed 0 as fast as possible. Logs the
+        throughput and the latency per stage, and returns the number of telegrams. """
+    return replayTelegrams(instance, captureReader(path), os.path.basename(path), speed)
+
+
+def replayTelegrams(instance, records, name, speed=1.0):
+    """ replayCapture() for any iterable of (received, telegram) records, e.g. an archive """
+    stats.enable()
+    count = 0
+    incomplete = 0
+    first = None
+    start = perf_counter()
+    for received, telegram in records:
+        if speed > 0:
+            if first is None:
+                first = received
+            delay = start + (received - first) / speed - perf_counter()
+            if delay > 0:
+                sleep(delay)
+        count += 1
+        if instance.process(telegram, received=received) is None:
+            incomplete += 1
+
+    elapsed = perf_counter() - start
+    logging.info("Replayed %d telegrams (%d incomplete) from %s in %.2f s: %.0f telegrams/s",
+                 count, incomplete, name, elapsed, count / elapsed if elapsed else 0)
+    logging.info("  %s", formatSnapshot(stats.snapshot()))
+    return count
@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+"""
+    Local checkpoint of the rollup state
+
+    Restoring the rollup engines from the database takes a query per interval per
+    meter, and can't be done at all while the database is down. So the state of
+    the engines is also written to a small local file, at every bucket boundary.
+    At startup that file is all powermon needs; the database is checked later, in
+    the background.
+"""
+
+#    Copyright (C) 2016  Chris Brouwer
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import json
+import logging
+import os
+from time import time
+
+CHECKPOINT_PATH = os.path.expanduser('~/.powermon/rollup-state.json')
+VERSION = 1
+
+
+class rollupCheckpoint():
+    """ Saves and loads the state of the rollup engines of all meters. A save writes a
+        temporary file, syncs it and renames it over the old one, so after a crash
+        there is either the old or the new checkpoint, never half of one. """
+    def __init__ (self, path=CHECKPOINT_PATH):
+        self.path = path
+        self.saves = 0
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def load(self):
+        """ Returns meter -> engine state, empty if there is no (usable) checkpoint """
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError):
+            logging.exception("Ignoring unreadable rollup checkpoint %s", self.path)
+            return {}
+        if data.get("version") != VERSION:
+            logging.warning("Ignoring rollup checkpoint %s of version %s", self.path, data.get("version"))
+            return {}
+        return {meter["meter"]: meter["state"] for meter in data["meters"]}
+
+    def save(self, rollups):
+        """ Writes the state of the rollup engines in rollups (meter -> engine) """
+        data = {"version": VERSION,
+                "saved": time(),
+                "meters": [{"meter": meter, "state": engine.state()} for meter, engine in rollups.items()]}
+        tmp = self.path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(data, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path)
+        # Make the rename itself durable
+        directory = os.open(os.path.dirname(os.path.abspath(self.path)), os.O_RDONLY)
+        try:
+            os.fsync(directory)
+        finally:
+            os.close(directory)
+        self.saves += 1
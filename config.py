@@ -0,0 +1,169 @@
+#!/usr/bin/env python
+"""
+    The configuration of powermon
+
+    Settings come from, in increasing order of precedence: the defaults below,
+    /etc/powermon.ini, ~/.powermon/powermon.ini (or only the file in $POWERMON_CONFIG
+    or --config), the environment, and the command line. Every setting can be set
+    from the environment as POWERMON_<SECTION>_<KEY>, e.g. POWERMON_MONGO_URL or
+    POWERMON_DSMR_READER_SERVERS; the keys of [powermon] as POWERMON_<KEY>.
+
+    [powermon] sinks lists the outputs to feed: mongo, sqlite and memory store the
+    readings (the first one listed also answers the HTTP queries), dsmr-reader
+    forwards the telegrams, archive keeps them, http serves the live state, and
+    peaks tracks the quarter-hour peaks. See powermon.ini.example.
+"""
+
+#    Copyright (C) 2016  Chris Brouwer
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import configparser
+import os
+import re
+import sys
+from archive import ARCHIVE_DIR
+from checkpoint import CHECKPOINT_PATH
+from persistence import BACKENDS
+from persistence import MONGO_URL
+from sqlitepersistence import SQLITE_PATH
+from wal import WAL_DIR
+
+CONFIG_PATHS = ('/etc/powermon.ini', os.path.expanduser('~/.powermon/powermon.ini'))
+
+SINKS = BACKENDS + ("dsmr-reader", "archive", "http", "peaks")
+
+DEFAULTS = {
+    "powermon": {"sinks": "mongo, dsmr-reader"},
+    "serial": {"port": "/dev/ttyUSB0",
+               "mode": "115200 7E1",
+               "xonxoff": "no",
+               "meters": ""},
+    "mongo": {"url": MONGO_URL,
+              "db": "powermon",
+              "wal": WAL_DIR},
+    "sqlite": {"path": SQLITE_PATH},
+    "dsmr-reader": {"servers": "",
+                    "spool": os.path.expanduser('~/.powermon/spool')},
+    "archive": {"dir": ARCHIVE_DIR,
+                "chunk": "hour"},
+    "http": {"port": "8080",
+             "host": ""},
+    "processing": {"checkpoint": CHECKPOINT_PATH,
+                   "queue_size": "600",
+                   "write_queue": "10000",
+                   "overload": "drop-oldest",
+                   "downsample": "off",
+                   "deviation": "0.025",
+                   "max_gap": "300",
+                   "recent_hours": "24"},
+    "peaks": {"top": "5",
+              "threshold": "2.5",
+              "warn_after": "300"},
+    "stats": {"log": "no",
+              "json": "",
+              "interval": "300"},
+}
+
+
+def environmentName(section, key):
+    name = key if section == "powermon" else section + "_" + key
+    return "POWERMON_" + re.sub("[^A-Z0-9]", "_", name.upper())
+
+
+def loadConfig(path=None, environ=os.environ):
+    """ Returns a ConfigParser with the defaults, the config file and the environment
+        applied; a file that is asked for explicitly has to exist """
+    config = configparser.ConfigParser(interpolation=None)
+    config.read_dict(DEFAULTS)
+    path = path or environ.get("POWERMON_CONFIG")
+    if path:
+        with open(os.path.expanduser(path)) as f:
+            config.read_file(f)
+    else:
+        config.read(CONFIG_PATHS)
+    for section in config.sections():
+        for key in config[section]:
+            value = environ.get(environmentName(section, key))
+            if value is not None:
+                config[section][key] = value
+    return config
+
+
+def splitList(value):
+    """ Splits a value on commas and newlines, dropping empty items """
+    return [item.strip() for item in re.split("[,\n]", value) if item.strip()]
+
+
+def parseServers(value):
+    """ Parses DSMR-reader endpoints, given as URL and API key pairs separated by
+        whitespace (one pair per line in a file) """
+    words = value.split()
+    if len(words) % 2:
+        raise ValueError("Every DSMR-reader server needs a URL and an API key, got %r" % value)
+    return list(zip(words[0::2], words[1::2]))
+
+
+def argumentDefaults(config):
+    """ Translates a configuration into defaults for the powermon command line """
+    sinks = splitList(config["powermon"]["sinks"])
+    unknown = [name for name in sinks if name not in SINKS]
+    if unknown:
+        raise ValueError("Unknown sinks %s, expected some of %s" % (", ".join(unknown), ", ".join(SINKS)))
+    serial = config["serial"]
+    mongo = config["mongo"]
+    forward = config["dsmr-reader"]
+    http = config["http"]
+    processing = config["processing"]
+    reports = config["stats"]
+    servers = parseServers(forward["servers"])
+    return {
+        "port": serial["port"],
+        "serial": serial["mode"],
+        "xonxoff": serial.getboolean("xonxoff"),
+        "config_meters": splitList(serial["meters"]),
+        # Readings are always rolled up somewhere, if only in memory
+        "backend": [name for name in sinks if name in BACKENDS] or ["memory"],
+        "mongo_url": mongo["url"],
+        "db": mongo["db"],
+        "wal": os.path.expanduser(mongo["wal"]),
+        "sqlite_path": os.path.expanduser(config["sqlite"]["path"]),
+        "servers": servers,
+        "spool": os.path.expanduser(forward["spool"]),
+        "no_forward": "dsmr-reader" not in sinks or not servers,
+        "archive": os.path.expanduser(config["archive"]["dir"]) if "archive" in sinks else None,
+        "archive_chunk": config["archive"]["chunk"],
+        "http_port": http.getint("port") if "http" in sinks else None,
+        "http_host": http["host"],
+        "checkpoint": os.path.expanduser(processing["checkpoint"]),
+        "queue_size": processing.getint("queue_size"),
+        "write_queue": processing.getint("write_queue"),
+        "overload": processing["overload"],
+        "downsample": processing["downsample"],
+        "deviation": processing.getfloat("deviation"),
+        "max_gap": processing.getfloat("max_gap"),
+        "recent_hours": processing.getfloat("recent_hours"),
+        "peaks": "peaks" in sinks,
+        "peak_top": config["peaks"].getint("top"),
+        "peak_threshold": config["peaks"].getfloat("threshold"),
+        "peak_warn_after": config["peaks"].getfloat("warn_after"),
+        "stats_log": reports.getboolean("log"),
+        "stats_json": reports["json"] or None,
+        "stats_interval": reports.getfloat("interval"),
+    }
+
+
+if __name__ == '__main__':
+    # Shows the settings in effect, as a config file
+    loadConfig(sys.argv[1] if len(sys.argv) > 1 else None).write(sys.stdout)
@@ -0,0 +1,199 @@
+#!/usr/bin/env python
+"""
+    Downsampling of the readings before they are stored
+
+    A DSMR5 meter sends a reading every second, and most of them differ from the
+    one before by a few watts. A filter decides which readings are worth storing:
+
+        deadband       stores a reading when the power moved more than deviation away
+                       from the last stored reading; holding the last stored value
+                       reconstructs every skipped reading within deviation
+        swinging-door  stores the points where the power curve bends (swinging door
+                       trending); interpolating linearly between the stored readings
+                       reconstructs every skipped reading within deviation
+
+    Either way a reading is stored at least every maxGap seconds, and whenever the
+    tariff or the gas reading changes. The rollup gets every reading regardless, so
+    the metrics stay exact.
+"""
+
+#    Copyright (C) 2016  Chris Brouwer
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import logging
+
+MODES = ("off", "deadband", "swinging-door")
+
+# The fields the filters look at, in kW
+POWER_FIELDS = ("consumption", "production")
+
+# A change in any of these is always stored
+KEY_FIELDS = ("tariff", "gas_timestamp")
+
+
+class changeFilter():
+    """ What both filters share: the first reading, readings with a different tariff
+        or gas reading, readings after a step back in time, and readings maxGap after
+        the last stored one are always stored. offer() returns the readings to store,
+        flush() the one a filter may still be holding. """
+    def __init__ (self, deviation=0.025, maxGap=300, fields=POWER_FIELDS):
+        self.deviation = deviation
+        self.maxGap = maxGap
+        self.fields = fields
+        self.anchor = None
+        self.anchorTs = None
+
+    def values(self, reading):
+        return [getattr(reading, field) for field in self.fields]
+
+    def forced(self, reading, now):
+        anchor = self.anchor
+        if anchor is None or now <= self.anchorTs or now - self.anchorTs >= self.maxGap:
+            return True
+        for field in KEY_FIELDS:
+            if getattr(reading, field) != getattr(anchor, field):
+                return True
+        # A field that comes or goes can't be compared
+        return any(value is None for value in self.values(reading)) != \
+               any(value is None for value in self.values(anchor))
+
+    def store(self, reading, now):
+        self.anchor = reading
+        self.anchorTs = now
+
+    def flush(self):
+        return []
+
+
+class deadbandFilter(changeFilter):
+    def offer(self, reading):
+        now = reading.timestamp.timestamp()
+        if not self.forced(reading, now):
+            for value, stored in zip(self.values(reading), self.values(self.anchor)):
+                if value is not None and abs(value - stored) > self.deviation:
+                    break
+            else:
+                return []
+        self.store(reading, now)
+        return [reading]
+
+
+class swingingDoorFilter(changeFilter):
+    """ Keeps, per field, the steepest and the flattest slope from the last stored
+        reading that stays within deviation of every reading since. A reading can be
+        held as the end of the line as long as the slope to it lies in between; once
+        it doesn't, the previous reading gets stored. """
+    def __init__ (self, deviation=0.025, maxGap=300, fields=POWER_FIELDS):
+        changeFilter.__init__(self, deviation, maxGap, fields)
+        self.held = None
+        self.upper = None
+        self.lower = None
+
+    def store(self, reading, now):
+        changeFilter.store(self, reading, now)
+        self.anchorValues = self.values(reading)
+        self.upper = [float("-inf")] * len(self.fields)
+        self.lower = [float("inf")] * len(self.fields)
+        self.held = None
+
+    def swing(self, reading, now):
+        """ Narrows the doors with reading; returns False if the line to it would
+            pass too far from one of the readings since the anchor """
+        dt = now - self.anchorTs
+        upper = []
+        lower = []
+        for value, anchor, up, low in zip(self.values(reading), self.anchorValues, self.upper, self.lower):
+            if value is None:
+                upper.append(up)
+                lower.append(low)
+                continue
+            up = max(up, (value - self.deviation - anchor) / dt)
+            low = min(low, (value + self.deviation - anchor) / dt)
+            if not up <= (value - anchor) / dt <= low:
+                return False
+            upper.append(up)
+            lower.append(low)
+        self.upper = upper
+        self.lower = lower
+        return True
+
+    def offer(self, reading):
+        now = reading.timestamp.timestamp()
+        out = []
+        held = self.held
+        if self.forced(reading, now) or (held is not None and now <= held.timestamp.timestamp()):
+            if held is not None:
+                out.append(held)
+            self.store(reading, now)
+            out.append(reading)
+            return out
+        if not self.swing(reading, now):
+            # The held reading ends the line from the anchor, and starts the next one
+            out.append(held)
+            self.store(held, held.timestamp.timestamp())
+            self.swing(reading, now)
+        self.held = reading
+        return out
+
+    def flush(self):
+        held, self.held = self.held, None
+        return [held] if held is not None else []
+
+
+FILTERS = {"deadband": deadbandFilter, "swinging-door": swingingDoorFilter}
+
+
+class downsampler():
+    """ Runs a filter per meter, and counts what it keeps """
+    def __init__ (self, mode="swinging-door", deviation=0.025, maxGap=300, fields=POWER_FIELDS):
+        if mode not in FILTERS:
+            raise ValueError("Unknown downsampling mode %r, expected one of %s" % (mode, ", ".join(FILTERS)))
+        self.mode = mode
+        self.options = {"deviation": deviation, "maxGap": maxGap, "fields": fields}
+        self.filters = {}
+        self.offered = 0
+        self.stored = 0
+
+    def offer(self, reading, meter=None):
+        """ Returns the readings of the meter to store now, possibly none """
+        filter = self.filters.get(meter)
+        if filter is None:
+            filter = self.filters[meter] = FILTERS[self.mode](**self.options)
+        readings = filter.offer(reading)
+        self.offered += 1
+        self.stored += len(readings)
+        return readings
+
+    def flush(self):
+        """ Returns (meter, reading) for the readings the filters still hold """
+        held = [(meter, reading) for meter, filter in self.filters.items() for reading in filter.flush()]
+        self.stored += len(held)
+        return held
+
+    def ratio(self):
+        """ Readings offered per reading stored """
+        return self.offered / self.stored if self.stored else None
+
+    def stats(self):
+        return {"mode": self.mode,
+                "offered": self.offered,
+                "stored": self.stored,
+                "ratio": self.ratio()}
+
+    def report(self):
+        ratio = self.ratio()
+        if ratio is not None:
+            logging.info("Downsampling (%s): stored %d of %d readings, %.1fx fewer", self.mode,
+                         self.stored, self.offered, ratio)
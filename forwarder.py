@@ -0,0 +1,269 @@
+#!/usr/bin/env python
+"""
+    Forwards raw telegrams to a DSMR-reader API in the background
+"""
+
+#    Copyright (C) 2016  Chris Brouwer
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import logging
+import os
+import queue
+import threading
+import time
+from urllib.parse import urlparse
+import requests
+from requests.adapters import HTTPAdapter
+from helpers import circuitBreaker
+from instrumentation import stats
+
+
+class telegramSpool():
+    """ Keeps telegrams that could not be delivered on disk, one file per telegram """
+    def __init__ (self, directory, maxFiles=100000):
+        self.directory = directory
+        self.maxFiles = maxFiles
+        self.storedSinceTrim = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def store(self, telegram):
+        name = os.path.join(self.directory, "%020d.telegram" % time.time_ns())
+        with open(name + ".tmp", "w") as f:
+            f.write(telegram)
+        os.replace(name + ".tmp", name)
+        # Listing a large spool isn't free, so only check the size every now and then
+        self.storedSinceTrim += 1
+        if self.storedSinceTrim >= 100:
+            self.storedSinceTrim = 0
+            self.trim()
+
+    def pending(self):
+        """ Returns the spooled files, oldest first """
+        return sorted(f for f in os.listdir(self.directory) if f.endswith(".telegram"))
+
+    def count(self):
+        return len(self.pending())
+
+    def load(self, name):
+        with open(os.path.join(self.directory, name)) as f:
+            return f.read()
+
+    def remove(self, name):
+        try:
+            os.remove(os.path.join(self.directory, name))
+        except FileNotFoundError:
+            pass
+
+    def trim(self):
+        pending = self.pending()
+        if len(pending) > self.maxFiles:
+            logging.warning("Spool in %s is full, dropping the oldest telegrams", self.directory)
+            for name in pending[:len(pending) - self.maxFiles]:
+                self.remove(name)
+
+
+class telegramForwarder():
+    """ Posts telegrams to a DSMR-reader API from a worker thread.
+
+        submit() never blocks: telegrams go into a bounded queue, and when that is
+        full (or the API is unreachable) they are spooled to disk and sent later. """
+    def __init__ (self, api_url, api_key, spoolDir, maxQueue=1000, batchSize=50,
+                  timeout=(3.05, 10), retries=3, backoff=1.0, maxBackoff=300, statsInterval=300,
+                  name="forwarder"):
+        self.api_url = api_url
+        self.queue = queue.Queue(maxsize=maxQueue)
+        self.batchSize = batchSize
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.maxBackoff = maxBackoff
+        self.statsInterval = statsInterval
+        self.spool = telegramSpool(spoolDir)
+
+        # One keep-alive connection is all we need, since there is only one worker
+        self.session = requests.Session()
+        self.session.headers['X-AUTHKEY'] = api_key
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=1)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+        # Statistics
+        self.sent = 0
+        self.rejected = 0
+        self.spooled = 0
+        # Taken from the queue, but not sent or spooled yet
+        self.inFlight = 0
+        self.lastLatency = None
+        self.maxLatency = 0.0
+        self.totalLatency = 0.0
+
+        # Once retrying doesn't help, stop trying for a while (with a growing timeout)
+        self.breaker = circuitBreaker(failureThreshold=1, resetTimeout=backoff * 2 ** retries,
+                                      maxResetTimeout=maxBackoff)
+        self.stopping = threading.Event()
+        self.thread = threading.Thread(target=self.run, name=name, daemon=True)
+        self.thread.start()
+
+    def submit(self, telegram):
+        """ Queues a telegram for forwarding, without ever waiting on the network """
+        try:
+            self.queue.put_nowait((time.monotonic(), telegram))
+        except queue.Full:
+            self.spoolTelegram(telegram)
+
+    def stats(self):
+        sent = self.sent
+        return {"url": self.api_url,
+                "queued": self.queue.qsize() + self.inFlight,
+                "spooled": self.spool.count(),
+                "sent": sent,
+                "rejected": self.rejected,
+                "state": self.breaker.state,
+                "failures": self.breaker.failures,
+                "latency_last": self.lastLatency,
+                "latency_avg": self.totalLatency / sent if sent else None,
+                "latency_max": self.maxLatency}
+
+    def close(self, timeout=10):
+        """ Stops the worker. Whatever could not be sent in time ends up in the spool. """
+        self.stopping.set()
+        self.thread.join(timeout)
+        while True:
+            try:
+                _, telegram = self.queue.get_nowait()
+            except queue.Empty:
+                break
+            self.spoolTelegram(telegram)
+        self.session.close()
+
+    def run(self):
+        nextStats = time.monotonic() + self.statsInterval
+        while not self.stopping.is_set():
+            try:
+                batch = [self.queue.get(timeout=1)]
+            except queue.Empty:
+                batch = []
+            # While the API is failing, a post can take many seconds; the rest of the
+            # queue had better wait where stats() and close() can see it
+            batchSize = self.batchSize if self.breaker.isClosed() else 1
+            while batch and len(batch) < batchSize:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            self.inFlight = len(batch)
+            for queuedAt, telegram in batch:
+                if not self.breaker.allow() or not self.post(telegram):
+                    self.spoolTelegram(telegram)
+                else:
+                    self.recordLatency(time.monotonic() - queuedAt)
+                self.inFlight -= 1
+
+            if self.breaker.isClosed():
+                self.drainSpool()
+
+            if time.monotonic() >= nextStats:
+                logging.info("Forwarder stats: %s", self.stats())
+                nextStats = time.monotonic() + self.statsInterval
+
+    def post(self, telegram):
+        """ Sends a single telegram, retrying with exponential backoff. Returns False if
+            the API could not be reached; the caller is expected to spool the telegram. """
+        for attempt in range(self.retries):
+            t0 = time.perf_counter()
+            try:
+                response = self.session.post(self.api_url, data={'telegram': telegram},
+                                             timeout=self.timeout)
+            except requests.RequestException:
+                response = None
+            stats.observe("forward", time.perf_counter() - t0)
+            if response is None or response.status_code >= 500:
+                logging.warning("Could not forward telegram to %s (attempt %d)",
+                                self.api_url, attempt + 1)
+                if self.stopping.wait(min(self.backoff * 2 ** attempt, self.maxBackoff)):
+                    break
+                continue
+
+            self.breaker.success()
+            # Old versions of DSMR-reader return 200, new ones 201.
+            if response.status_code not in (200, 201):
+                # Or you will find the error (hint) in the reponse body on failure.
+                # Retrying won't help, so the telegram is dropped.
+                logging.error("API error: %s", response.text)
+                self.rejected += 1
+                stats.count("forward_rejected")
+            else:
+                self.sent += 1
+            return True
+
+        self.breaker.failure()
+        stats.count("forward_failed")
+        return False
+
+    def drainSpool(self):
+        for name in self.spool.pending():
+            if self.stopping.is_set() or not self.queue.empty():
+                # Live telegrams go first
+                return
+            try:
+                telegram = self.spool.load(name)
+            except OSError:
+                logging.exception("Error on reading spooled telegram %s", name)
+                self.spool.remove(name)
+                continue
+            if not self.post(telegram):
+                return
+            self.spool.remove(name)
+
+    def spoolTelegram(self, telegram):
+        try:
+            self.spool.store(telegram)
+            self.spooled += 1
+        except OSError:
+            logging.exception("Error on spooling telegram, it is lost!")
+
+    def recordLatency(self, latency):
+        self.lastLatency = latency
+        self.totalLatency += latency
+        if latency > self.maxLatency:
+            self.maxLatency = latency
+
+
+class fanOutForwarder():
+    """ Sends every telegram to several DSMR-reader APIs at the same time. Each endpoint
+        has its own worker, connection pool, backlog, spool and circuit breaker, so a
+        slow or dead endpoint cannot hold up the others. """
+    def __init__ (self, servers, spoolDir, **kwargs):
+        self.forwarders = []
+        for index, (api_url, api_key) in enumerate(servers):
+            host = urlparse(api_url).netloc.replace(':', '_') or 'endpoint'
+            name = "%d-%s" % (index, host)
+            self.forwarders.append(telegramForwarder(api_url, api_key, os.path.join(spoolDir, name),
+                                                     name="forwarder-" + name, **kwargs))
+
+    def submit(self, telegram):
+        for forwarder in self.forwarders:
+            forwarder.submit(telegram)
+
+    def stats(self):
+        return [forwarder.stats() for forwarder in self.forwarders]
+
+    def close(self, timeout=10):
+        # Stop all workers first, so the total wait doesn't grow with the number of endpoints
+        for forwarder in self.forwarders:
+            forwarder.stopping.set()
+        for forwarder in self.forwarders:
+            forwarder.close(timeout)
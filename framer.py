@@ -0,0 +1,215 @@
+#!/usr/bin/env python
+"""
+    Splits the raw byte stream of the P1 interface into complete telegrams
+"""
+
+#    Copyright (C) 2016  Chris Brouwer
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import logging
+import select
+import selectors
+from collections import deque
+from time import monotonic
+from time import perf_counter
+from instrumentation import stats
+
+
+def _crc16Table():
+    table = []
+    for byte in range(256):
+        crc = byte
+        for _ in range(8):
+            if crc & 1:
+                crc = (crc >> 1) ^ 0xA001
+            else:
+                crc >>= 1
+        table.append(crc)
+    return tuple(table)
+
+CRC16_TABLE = _crc16Table()
+
+
+def crc16(data):
+    """ CRC16/ARC as used by DSMR 4 and up, calculated from the '/' up to and
+        including the '!' of a telegram """
+    crc = 0
+    table = CRC16_TABLE
+    for byte in data:
+        crc = (crc >> 8) ^ table[(crc ^ byte) & 0xFF]
+    return crc
+
+
+class telegramFramer():
+    """ Collects bytes from the P1 interface and hands out complete telegrams.
+
+        A telegram starts with a '/' header and ends with a '!' trailer, which is
+        followed by a CRC16 in hex (DSMR 4 and up) or directly by the line end
+        (DSMR 2.2 and 3, which carry no checksum). """
+    def __init__ (self, maxSize=8192):
+        self.buffer = bytearray()
+        self.maxSize = maxSize
+        # Counters, for monitoring the health of the serial line
+        self.frames = 0
+        self.dropped = 0
+        self.corrupt = 0
+        self.discardedBytes = 0
+
+    def feed(self, data):
+        """ Adds raw bytes, and returns a list of the telegrams completed by them """
+        buf = self.buffer
+        buf += data
+        telegrams = []
+        while buf:
+            start = buf.find(b'/')
+            if start < 0:
+                # Nothing but noise, or the tail of a telegram we never saw the start of
+                self.discardedBytes += len(buf)
+                del buf[:]
+                break
+            if start > 0:
+                self.discardedBytes += start
+                del buf[:start]
+
+            end = buf.find(b'!')
+            restart = buf.find(b'/', 1, end if end >= 0 else len(buf))
+            if restart > 0:
+                # A new header before the trailer: the previous telegram got cut off
+                self.dropped += 1
+                stats.count("telegrams_dropped")
+                logging.warning("Dropping truncated telegram (%d dropped so far)", self.dropped)
+                self.discardedBytes += restart
+                del buf[:restart]
+                continue
+
+            eol = buf.find(b'\n', end) if end >= 0 else -1
+            if eol < 0:
+                if len(buf) > self.maxSize:
+                    self.dropped += 1
+                    stats.count("telegrams_dropped")
+                    logging.warning("Dropping oversized telegram (%d dropped so far)", self.dropped)
+                    self.discardedBytes += len(buf)
+                    del buf[:]
+                break
+
+            telegram = bytes(buf[:eol + 1])
+            del buf[:eol + 1]
+            checksum = telegram[end + 1:].strip()
+            if checksum and not self.checksumMatches(telegram[:end + 1], checksum):
+                self.corrupt += 1
+                stats.count("telegrams_rejected")
+                logging.warning("Ignoring telegram with invalid CRC (%d corrupt so far)", self.corrupt)
+                continue
+            self.frames += 1
+            stats.count("telegrams_received")
+            telegrams.append(telegram)
+        return telegrams
+
+    def checksumMatches(self, payload, checksum):
+        try:
+            return len(checksum) == 4 and int(checksum, 16) == crc16(payload)
+        except ValueError:
+            return False
+
+
+class serialTelegramReader():
+    """ Reads telegrams from an opened serial connection. Rather than polling, it
+        waits on the file descriptor of the port and reads whatever is available
+        in one go. """
+    def __init__ (self, serial_connection, framer=None, timeout=20):
+        self.serial_connection = serial_connection
+        self.framer = framer if framer is not None else telegramFramer()
+        self.timeout = timeout
+        self.pending = deque()
+
+    def readTelegram(self):
+        """ Will block until a complete telegram is received, and returns it as bytes.
+            Returns None if nothing was received within the timeout. """
+        if self.pending:
+            return self.pending.popleft()
+        start = perf_counter()
+        framing = 0.0
+        while not self.pending:
+            ready, _, _ = select.select([self.serial_connection.fileno()], [], [], self.timeout)
+            if not ready:
+                return None
+            data = self.serial_connection.read(self.serial_connection.in_waiting or 1)
+            t0 = perf_counter()
+            self.pending.extend(self.framer.feed(data))
+            framing += perf_counter() - t0
+        # A telegram trickles in over many reads; count the framing of all of them
+        stats.observe("serial_wait", perf_counter() - start - framing)
+        stats.observe("frame", framing)
+        return self.pending.popleft()
+
+    def __iter__(self):
+        while True:
+            telegram = self.readTelegram()
+            if telegram is not None:
+                yield telegram
+
+
+class multiTelegramReader():
+    """ Reads telegrams from several serial connections in one thread, waiting on all
+        of their file descriptors at once. Takes a dict of key -> serialTelegramReader;
+        every connection keeps its own framer, so partial telegrams don't get mixed. """
+    def __init__ (self, readers, timeout=20):
+        self.readers = readers
+        self.timeout = timeout
+        self.selector = selectors.DefaultSelector()
+        for key, reader in readers.items():
+            self.selector.register(reader.serial_connection.fileno(), selectors.EVENT_READ, key)
+        self.pending = deque()
+        self.lastSeen = dict.fromkeys(readers, monotonic())
+
+    def readTelegram(self):
+        """ Will block until any connection delivers a complete telegram, and returns it
+            as (key, telegram). Returns None if none did within the timeout. """
+        if self.pending:
+            return self.pending.popleft()
+        start = perf_counter()
+        framing = 0.0
+        deadline = monotonic() + self.timeout
+        while not self.pending:
+            remaining = deadline - monotonic()
+            if remaining <= 0:
+                return None
+            for selected, _ in self.selector.select(remaining):
+                key = selected.data
+                reader = self.readers[key]
+                connection = reader.serial_connection
+                data = connection.read(connection.in_waiting or 1)
+                t0 = perf_counter()
+                for telegram in reader.framer.feed(data):
+                    self.pending.append((key, telegram))
+                    self.lastSeen[key] = monotonic()
+                framing += perf_counter() - t0
+        stats.observe("serial_wait", perf_counter() - start - framing)
+        stats.observe("frame", framing)
+        return self.pending.popleft()
+
+    def silent(self):
+        """ Returns the keys of the connections without a telegram for longer than the timeout """
+        now = monotonic()
+        return [key for key, seen in self.lastSeen.items() if now - seen > self.timeout]
+
+    def close(self):
+        self.selector.close()
+
+    def __iter__(self):
+        while True:
+            item = self.readTelegram()
+            if item is not None:
+                yield item
@@ -18,17 +18,167 @@
 #    You should have received a copy of the GNU General Public License
 #    along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import struct
+import threading
+import time
+from datetime import datetime
+from operator import itemgetter
+import pytz
 
-class reading():
-    """Simple wrapper for the data of a reading from the p1 interface"""
-    def __init__ (self):
-        self.timestamp = None
-        self.t1 = 0
-        self.t2 = 0
-        self.consumption = 0
+
+# Everything a DSMR telegram can tell us, in a fixed order. Power is in kW, counters
+# in kWh, voltage in V, current in A and gas in m3; timestamps are aware datetimes.
+READING_FIELDS = (
+    "timestamp", "tariff",
+    "t1", "t2", "t1_return", "t2_return",
+    "consumption", "production",
+    "power_l1", "power_l2", "power_l3",
+    "return_l1", "return_l2", "return_l3",
+    "voltage_l1", "voltage_l2", "voltage_l3",
+    "current_l1", "current_l2", "current_l3",
+    "gas", "gas_timestamp",
+)
+FIELD_BITS = {name: 1 << index for index, name in enumerate(READING_FIELDS)}
+TIMESTAMP_FIELDS = ("timestamp", "gas_timestamp")
+REQUIRED = FIELD_BITS["timestamp"] | FIELD_BITS["t1"] | FIELD_BITS["t2"] | FIELD_BITS["consumption"]
+
+# Presence mask, then every field as a double: timestamps as epoch seconds, missing
+# values as NaN
+READING_STRUCT = struct.Struct("<I%dd" % len(READING_FIELDS))
+NAN = float("nan")
+
+
+class reading(tuple):
+    """An immutable reading from the p1 interface. Fields that were not in the telegram
+       are None, and the present bitmask tells which ones were, so a value of 0 (no
+       consumption while the solar panels deliver) is a value like any other."""
+    __slots__ = ()
+
+    def __new__ (cls, **values):
+        return cls.fromDict(values)
+
+    @classmethod
+    def fromDict(cls, values):
+        present = 0
+        row = []
+        for name in READING_FIELDS:
+            value = values.get(name)
+            if value is not None:
+                present |= FIELD_BITS[name]
+            row.append(value)
+        row.append(present)
+        return tuple.__new__(cls, row)
+
+    def has(self, name):
+        return bool(self.present & FIELD_BITS[name])
 
     def isComplete(self):
-       return self.timestamp != None \
-              and self.t1 != 0 \
-              and self.t2 != 0 \
-              and self.consumption != 0
+        return self.present & REQUIRED == REQUIRED
+
+    def asDict(self):
+        """ The fields that are present """
+        present = self.present
+        return {name: self[index] for index, name in enumerate(READING_FIELDS)
+                if present & (1 << index)}
+
+    def replace(self, **changes):
+        values = self.asDict()
+        values.update(changes)
+        return reading.fromDict(values)
+
+    def toBytes(self):
+        row = [self.present]
+        for name, value in zip(READING_FIELDS, self):
+            if value is None:
+                value = NAN
+            elif name in TIMESTAMP_FIELDS:
+                value = value.timestamp()
+            row.append(value)
+        return READING_STRUCT.pack(*row)
+
+    @classmethod
+    def fromBytes(cls, data):
+        row = READING_STRUCT.unpack(data)
+        present = row[0]
+        values = {}
+        for index, name in enumerate(READING_FIELDS):
+            if present & (1 << index):
+                value = row[index + 1]
+                if name in TIMESTAMP_FIELDS:
+                    value = datetime.fromtimestamp(value, pytz.utc)
+                elif name == "tariff":
+                    value = int(value)
+                values[name] = value
+        return cls.fromDict(values)
+
+    def __repr__(self):
+        return "reading(%s)" % ", ".join("%s=%r" % item for item in self.asDict().items())
+
+    def __reduce__(self):
+        return (reading.fromBytes, (self.toBytes(),))
+
+
+for _index, _name in enumerate(READING_FIELDS + ("present",)):
+    setattr(reading, _name, property(itemgetter(_index)))
+del _index, _name
+
+
+def parseTime(value):
+    """ Parses an ISO date or time; without a zone it is taken as local (Amsterdam) time """
+    moment = datetime.fromisoformat(value)
+    if moment.tzinfo is None:
+        moment = pytz.timezone("Europe/Amsterdam").localize(moment)
+    return moment
+
+
+class circuitBreaker():
+    """Stops calling a failing dependency for a while, so it cannot hold up the caller.
+
+       After failureThreshold consecutive failures the breaker opens, and allow()
+       returns False until resetTimeout has passed. Then a single trial call is let
+       through (half-open): if it succeeds the breaker closes again, if not it opens
+       again with a doubled timeout (up to maxResetTimeout)."""
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half-open"
+
+    def __init__ (self, failureThreshold=3, resetTimeout=5, maxResetTimeout=300):
+        self.failureThreshold = failureThreshold
+        self.resetTimeout = resetTimeout
+        self.maxResetTimeout = maxResetTimeout
+        self.lock = threading.Lock()
+        self.state = circuitBreaker.CLOSED
+        self.failures = 0
+        self.timeout = resetTimeout
+        self.openedAt = 0.0
+        self.trips = 0
+
+    def allow(self):
+        with self.lock:
+            if self.state == circuitBreaker.CLOSED:
+                return True
+            if self.state == circuitBreaker.OPEN and time.monotonic() - self.openedAt >= self.timeout:
+                self.state = circuitBreaker.HALF_OPEN
+                return True
+            return False
+
+    def success(self):
+        with self.lock:
+            self.state = circuitBreaker.CLOSED
+            self.failures = 0
+            self.timeout = self.resetTimeout
+
+    def failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.state == circuitBreaker.HALF_OPEN:
+                self.timeout = min(self.timeout * 2, self.maxResetTimeout)
+            elif self.failures < self.failureThreshold:
+                return
+            if self.state != circuitBreaker.OPEN:
+                self.trips += 1
+            self.state = circuitBreaker.OPEN
+            self.openedAt = time.monotonic()
+
+    def isClosed(self):
+        return self.state == circuitBreaker.CLOSED
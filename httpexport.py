@@ -0,0 +1,313 @@
+#!/usr/bin/env python
+"""
+    A small HTTP server showing what powermon is doing
+
+        /reading      the latest complete reading (of ?meter=ID), as JSON
+        /buckets      the rollup buckets being filled (of ?meter=ID), as JSON
+        /recent       min/max/mean over the last ?seconds=N (default 3600), as JSON
+        /consumption  consumption per tariff between ?start= and ?end= (ISO times,
+                      end defaults to now), of ?meter=ID, as JSON
+        /peaks        the running quarter hour and the peaks of the month (of
+                      ?meter=ID), as JSON
+        /metrics      power, counters and pipeline statistics for Prometheus
+
+    Everything but /consumption is served from state powermon keeps in memory
+    anyway, so scraping doesn't touch the database. The server runs on its own
+    daemon threads, and only reads that state, so it can never hold up the serial
+    reader.
+"""
+
+#    Copyright (C) 2016  Chris Brouwer
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import json
+import logging
+import threading
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+from urllib.parse import parse_qs
+from urllib.parse import urlsplit
+from helpers import parseTime
+from instrumentation import stats
+
+# Reading field -> (metric name, labels, help). Power is in kW, counters in kWh.
+READING_METRICS = (
+    ("consumption", "powermon_power_kw", 'direction="consumption"', "Current power"),
+    ("production", "powermon_power_kw", 'direction="production"', "Current power"),
+    ("power_l1", "powermon_phase_power_kw", 'phase="l1",direction="consumption"', "Power per phase"),
+    ("power_l2", "powermon_phase_power_kw", 'phase="l2",direction="consumption"', "Power per phase"),
+    ("power_l3", "powermon_phase_power_kw", 'phase="l3",direction="consumption"', "Power per phase"),
+    ("return_l1", "powermon_phase_power_kw", 'phase="l1",direction="production"', "Power per phase"),
+    ("return_l2", "powermon_phase_power_kw", 'phase="l2",direction="production"', "Power per phase"),
+    ("return_l3", "powermon_phase_power_kw", 'phase="l3",direction="production"', "Power per phase"),
+    ("voltage_l1", "powermon_phase_voltage_volts", 'phase="l1"', "Voltage per phase"),
+    ("voltage_l2", "powermon_phase_voltage_volts", 'phase="l2"', "Voltage per phase"),
+    ("voltage_l3", "powermon_phase_voltage_volts", 'phase="l3"', "Voltage per phase"),
+    ("current_l1", "powermon_phase_current_amperes", 'phase="l1"', "Current per phase"),
+    ("current_l2", "powermon_phase_current_amperes", 'phase="l2"', "Current per phase"),
+    ("current_l3", "powermon_phase_current_amperes", 'phase="l3"', "Current per phase"),
+    ("t1", "powermon_energy_kwh_total", 'tariff="1",direction="consumption"', "Meter counters"),
+    ("t2", "powermon_energy_kwh_total", 'tariff="2",direction="consumption"', "Meter counters"),
+    ("t1_return", "powermon_energy_kwh_total", 'tariff="1",direction="production"', "Meter counters"),
+    ("t2_return", "powermon_energy_kwh_total", 'tariff="2",direction="production"', "Meter counters"),
+    ("tariff", "powermon_tariff", "", "Current tariff"),
+    ("gas", "powermon_gas_m3_total", "", "Gas meter counter"),
+)
+
+
+def meterLabels(meter, labels=""):
+    """ Adds the meter to the labels, for all but the default meter """
+    if meter is None:
+        return labels
+    meter = 'meter="%s"' % str(meter).replace('\\', '\\\\').replace('"', '\\"')
+    return meter + "," + labels if labels else meter
+
+
+def jsonDefault(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError("Cannot serialize %r" % (value,))
+
+
+class metricsWriter():
+    """ Builds a Prometheus text exposition. Samples are grouped per metric, with its
+        HELP and TYPE once, as the format requires. """
+    def __init__ (self):
+        self.metrics = {}
+
+    def add(self, name, value, labels="", help="", kind="gauge", family=None):
+        """ Adds a sample. The _bucket, _sum and _count samples of a histogram go
+            together, under the name of the family. """
+        if value is None:
+            return
+        family = family or name
+        metric = self.metrics.get(family)
+        if metric is None:
+            metric = self.metrics[family] = ["# HELP %s %s" % (family, help), "# TYPE %s %s" % (family, kind)]
+        if labels:
+            metric.append("%s{%s} %s" % (name, labels, repr(float(value))))
+        else:
+            metric.append("%s %s" % (name, repr(float(value))))
+
+    def text(self):
+        return "\n".join(line for metric in self.metrics.values() for line in metric) + "\n"
+
+
+class statusServer():
+    """ Serves the live state of a powermon instance over HTTP, from a daemon thread """
+    def __init__ (self, instance, port=8080, host=""):
+        self.instance = instance
+        status = self
+
+        class handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                url = urlsplit(self.path)
+                try:
+                    route = status.routes.get(url.path)
+                    if route is None:
+                        self.reply(404, "text/plain", "Not found\n")
+                        return
+                    contentType, body = route(parse_qs(url.query))
+                    self.reply(200, contentType, body)
+                except ValueError as e:
+                    self.reply(400, "text/plain", "%s\n" % e)
+                except Exception:
+                    logging.exception("Error on serving %s", self.path)
+                    self.reply(500, "text/plain", "Internal error\n")
+
+            def reply(self, code, contentType, body):
+                body = body.encode("utf-8")
+                self.send_response(code)
+                self.send_header("Content-Type", contentType)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                logging.debug("HTTP %s - %s", self.address_string(), format % args)
+
+        self.routes = {"/reading": self.reading,
+                       "/buckets": self.buckets,
+                       "/recent": self.recent,
+                       "/consumption": self.consumption,
+                       "/peaks": self.peaks,
+                       "/metrics": self.metrics}
+        self.server = ThreadingHTTPServer((host, port), handler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, name="http", daemon=True)
+        self.thread.start()
+        logging.info("Serving status on port %d", self.server.server_port)
+
+    def json(self, value):
+        return "application/json", json.dumps(value, default=jsonDefault) + "\n"
+
+    def rollup(self, query):
+        """ The rollup engine of the meter asked for, or of the primary meter """
+        meter = query.get("meter", [self.instance.p1.meter])[0]
+        return self.instance.persistence.rollups.get(meter)
+
+    def reading(self, query):
+        rollup = self.rollup(query)
+        last = rollup.last if rollup is not None else None
+        return self.json(None if last is None else last.asDict())
+
+    def buckets(self, query):
+        rollup = self.rollup(query)
+        return self.json(rollup.openBuckets() if rollup is not None else [])
+
+    def recent(self, query):
+        recent = self.instance.recent
+        if recent is None:
+            return self.json(None)
+        seconds = float(query.get("seconds", ["3600"])[0])
+        return self.json(recent.window(seconds))
+
+    def consumption(self, query):
+        if "start" not in query:
+            raise ValueError("/consumption needs a start")
+        start = parseTime(query["start"][0])
+        end = parseTime(query["end"][0]) if "end" in query else datetime.now(start.tzinfo)
+        meter = query.get("meter", [self.instance.p1.meter])[0]
+        return self.json(self.instance.persistence.consumption(start, end, meter))
+
+    def trackers(self):
+        """ The peak trackers per meter, if peaks are tracked """
+        trackers = {}
+        for sink in self.instance.sinks:
+            trackers.update(getattr(sink, "trackers", {}))
+        return trackers
+
+    def peaks(self, query):
+        tracker = self.trackers().get(query.get("meter", [self.instance.p1.meter])[0])
+        return self.json(tracker.state() if tracker is not None else None)
+
+    def metrics(self, query):
+        out = metricsWriter()
+        instance = self.instance
+        rollups = instance.persistence.rollups
+        for p1 in instance.meters:
+            rollup = rollups.get(p1.meter)
+            last = rollup.last if rollup is not None else None
+            if last is None:
+                continue
+            for field, name, labels, help in READING_METRICS:
+                kind = "counter" if name.endswith("_total") else "gauge"
+                out.add(name, getattr(last, field, None), meterLabels(p1.meter, labels), help, kind)
+            out.add("powermon_reading_timestamp_seconds", last.timestamp.timestamp(), meterLabels(p1.meter),
+                    "Time of the latest reading, according to the meter")
+
+        out.add("powermon_telegrams_total", instance.telegrams, help="Telegrams processed", kind="counter")
+        out.add("powermon_readings_total", instance.readings, help="Complete readings processed", kind="counter")
+        for p1 in instance.meters:
+            reader = getattr(p1, "telegramReader", None)
+            if reader is None:
+                continue
+            framer = reader.framer
+            help = "Telegram framing"
+            out.add("powermon_framer_total", framer.frames, meterLabels(p1.meter, 'result="frame"'), help, "counter")
+            out.add("powermon_framer_total", framer.corrupt, meterLabels(p1.meter, 'result="corrupt"'), help, "counter")
+            out.add("powermon_framer_total", framer.dropped, meterLabels(p1.meter, 'result="dropped"'), help, "counter")
+            out.add("powermon_framer_discarded_bytes_total", framer.discardedBytes, meterLabels(p1.meter),
+                    "Bytes outside of any telegram", "counter")
+
+        seen = set()
+        for sink in instance.sinks:
+            # Other sinks, such as the peaks, may write to the same persistence
+            buffer = getattr(getattr(sink, "persistence", None), "buffer", None)
+            if buffer is None or id(buffer) in seen:
+                continue
+            seen.add(id(buffer))
+            labels = 'sink="%s"' % sink.name
+            values = buffer.stats()
+            out.add("powermon_write_behind_depth", values["depth"], labels, "Writes waiting to be flushed")
+            out.add("powermon_write_behind_flushes_total", values["flushes"], labels, "Flushes", "counter")
+            out.add("powermon_write_behind_documents_total", values["written"], labels + ',result="written"',
+                    "Documents flushed", "counter")
+            out.add("powermon_write_behind_documents_total", values["failed"], labels + ',result="failed"',
+                    "Documents flushed", "counter")
+            out.add("powermon_write_behind_flush_latency_max_seconds", values["flush_latency_max"], labels,
+                    "Slowest flush")
+            out.add("powermon_write_behind_depth_high_water", values["high_water"], labels,
+                    "Most writes ever waiting to be flushed")
+            out.add("powermon_write_behind_dropped_total", values["dropped"], labels, "Readings dropped on overload",
+                    "counter")
+            if "wal_bytes" in values:
+                out.add("powermon_wal_bytes", values["wal_bytes"], labels, "Size of the write-ahead log")
+                out.add("powermon_database_circuit_open", values["circuit"] != "closed", labels,
+                        "Whether database writes are being held back")
+
+        if instance.forwarder is not None:
+            for values in instance.forwarder.stats():
+                labels = 'url="%s"' % values["url"].replace('"', '\\"')
+                out.add("powermon_forwarder_queued", values["queued"], labels, "Telegrams waiting to be sent")
+                out.add("powermon_forwarder_spooled", values["spooled"], labels, "Telegrams spooled to disk")
+                out.add("powermon_forwarder_sent_total", values["sent"], labels, "Telegrams sent", "counter")
+                out.add("powermon_forwarder_rejected_total", values["rejected"], labels,
+                        "Telegrams rejected by the server", "counter")
+                out.add("powermon_forwarder_circuit_open", values["state"] != "closed", labels,
+                        "Whether the endpoint is being skipped")
+                out.add("powermon_forwarder_latency_max_seconds", values["latency_max"], labels,
+                        "Slowest request")
+
+        for worker in instance.workers:
+            labels = 'sink="%s"' % worker.name
+            values = worker.stats()
+            out.add("powermon_sink_queue_depth", values["queued"], labels, "Telegrams waiting for a sink")
+            out.add("powermon_sink_queue_high_water", values["high_water"], labels,
+                    "Most telegrams ever waiting for a sink")
+            out.add("powermon_sink_queue_dropped_total", values["dropped"], labels,
+                    "Telegrams a sink dropped on overload", "counter")
+
+        sampler = getattr(instance, "downsampler", None)
+        if sampler is not None:
+            values = sampler.stats()
+            out.add("powermon_downsample_readings_total", values["offered"], 'result="offered"',
+                    "Readings offered to the downsampling", "counter")
+            out.add("powermon_downsample_readings_total", values["stored"], 'result="stored"',
+                    "Readings offered to the downsampling", "counter")
+            out.add("powermon_downsample_ratio", values["ratio"], help="Readings offered per reading stored")
+
+        for meter, tracker in self.trackers().items():
+            peak = tracker.peak()
+            out.add("powermon_peak_month_kw", peak[0] if peak is not None else None, meterLabels(meter),
+                    "Highest quarter-hour demand of the month")
+            out.add("powermon_peak_quarter_average_kw", tracker.average(), meterLabels(meter),
+                    "Average demand of the running quarter hour so far")
+            out.add("powermon_peak_quarter_projected_kw", tracker.projected, meterLabels(meter),
+                    "Demand of the running quarter hour if the current power holds")
+
+        if instance.recent is not None:
+            out.add("powermon_recent_readings", len(instance.recent), help="Readings held in memory")
+
+        snapshot = stats.snapshot()
+        family = "powermon_stage_seconds"
+        for stage, values in snapshot["stages"].items():
+            labels = 'stage="%s"' % stage
+            total = 0
+            for bound, count in values["buckets"]:
+                total += count
+                out.add(family + "_bucket", total, '%s,le="%s"' % (labels, bound),
+                        "Time spent per stage", "histogram", family)
+            out.add(family + "_bucket", values["count"], labels + ',le="+Inf"', family=family)
+            out.add(family + "_sum", values["sum"], labels, family=family)
+            out.add(family + "_count", values["count"], labels, family=family)
+        for name, value in sorted(snapshot["counters"].items()):
+            out.add("powermon_%s_total" % name, value, help=name.replace("_", " ").capitalize(), kind="counter")
+        return "text/plain; version=0.0.4; charset=utf-8", out.text()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
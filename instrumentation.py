@@ -0,0 +1,193 @@
+#!/usr/bin/env python
+"""
+    Timing of the stages of the pipeline, and counting of what passes through
+
+    Every stage reports its duration to the shared stats object, which keeps a
+    histogram with fixed buckets per stage, so recording costs a binary search and
+    a few additions. Stats start disabled, and then do nothing but return. Reporters
+    get snapshots: as a log line, as a JSON file, or, through httpexport, as
+    Prometheus histograms.
+
+        t0 = perf_counter()
+        ...
+        stats.observe("parse", perf_counter() - t0)
+        stats.count("telegrams_rejected")
+"""
+
+#    Copyright (C) 2016  Chris Brouwer
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import json
+import logging
+import os
+import threading
+from bisect import bisect_left
+
+# Upper bounds of the buckets, in seconds: from parsing (tens of microseconds) up to
+# waiting for the serial port (a second, or much longer when the meter is quiet)
+BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+           0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# serial_wait  waiting for the serial port to have data
+# frame        cutting the received bytes into telegrams
+# parse        turning a telegram into a reading
+# store        handing a reading to the persistence
+# rollup       updating the metrics
+# write        one bulk write to the database
+# forward      one HTTP request to DSMR-reader
+STAGES = ("serial_wait", "frame", "parse", "store", "rollup", "write", "forward")
+
+
+class histogram():
+    """ Counts durations in fixed buckets. Not locked: a rare lost update between
+        threads is an acceptable price for keeping the hot path cheap. """
+    def __init__ (self, bounds=BUCKETS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds):
+        self.counts[bisect_left(self.bounds, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def quantile(self, fraction):
+        """ The upper bound of the bucket holding the given fraction of the durations """
+        if not self.count:
+            return None
+        rank = fraction * self.count
+        seen = 0
+        for bound, count in zip(self.bounds, self.counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def snapshot(self):
+        return {"count": self.count,
+                "sum": self.sum,
+                "mean": self.sum / self.count if self.count else None,
+                "p50": self.quantile(0.50),
+                "p99": self.quantile(0.99),
+                "max": self.max,
+                "buckets": list(zip(self.bounds, self.counts))}
+
+
+class instruments():
+    """ The histograms per stage and the counters """
+    def __init__ (self, enabled=False):
+        self.enabled = enabled
+        self.histograms = {}
+        self.counters = {}
+        self.lock = threading.Lock()
+
+    def enable(self, enabled=True):
+        self.enabled = enabled
+
+    def observe(self, stage, seconds):
+        if not self.enabled:
+            return
+        h = self.histograms.get(stage)
+        if h is None:
+            with self.lock:
+                h = self.histograms.setdefault(stage, histogram())
+        h.observe(seconds)
+
+    def count(self, name, n=1):
+        if not self.enabled:
+            return
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def reset(self):
+        with self.lock:
+            self.histograms = {}
+            self.counters = {}
+
+    def snapshot(self):
+        with self.lock:
+            histograms = dict(self.histograms)
+        return {"stages": {stage: h.snapshot() for stage, h in histograms.items()},
+                "counters": dict(self.counters)}
+
+
+# Shared by all modules. Import the object, and check nothing: when disabled,
+# observe() and count() return right away.
+stats = instruments()
+
+
+def formatSnapshot(snapshot):
+    """ One line summary of a snapshot, in pipeline order """
+    stages = snapshot["stages"]
+    parts = []
+    for stage in STAGES + tuple(sorted(set(stages) - set(STAGES))):
+        values = stages.get(stage)
+        if values is None or not values["count"]:
+            continue
+        parts.append("%s n=%d mean=%.3fms p50<=%.3fms p99<=%.3fms max=%.3fms" % (
+            stage, values["count"], 1000 * values["mean"], 1000 * values["p50"],
+            1000 * values["p99"], 1000 * values["max"]))
+    counters = ", ".join("%s=%d" % item for item in sorted(snapshot["counters"].items()))
+    return "; ".join(parts) + (" | " + counters if counters else "")
+
+
+class logReporter():
+    """ Logs a snapshot as a single line """
+    def report(self, snapshot):
+        logging.info("Pipeline stats: %s", formatSnapshot(snapshot))
+
+
+class jsonReporter():
+    """ Writes a snapshot to a JSON file, replacing it atomically, for other tools to read """
+    def __init__ (self, path):
+        self.path = path
+
+    def report(self, snapshot):
+        tmp = self.path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(snapshot, f, indent=2)
+        os.replace(tmp, self.path)
+
+
+class periodicReporter():
+    """ Hands a snapshot of the stats to every reporter every interval seconds, from a
+        daemon thread, and once more on close() """
+    def __init__ (self, reporters, interval=60, instruments=None):
+        self.reporters = reporters
+        self.interval = interval
+        self.instruments = instruments if instruments is not None else stats
+        self.stopping = threading.Event()
+        self.thread = threading.Thread(target=self.run, name="stats", daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while not self.stopping.wait(self.interval):
+            self.report()
+
+    def report(self):
+        snapshot = self.instruments.snapshot()
+        for reporter in self.reporters:
+            try:
+                reporter.report(snapshot)
+            except Exception:
+                logging.exception("Error on reporting stats to %s", type(reporter).__name__)
+
+    def close(self):
+        self.stopping.set()
+        self.thread.join()
+        self.report()
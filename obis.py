@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+"""
+    Parses the OBIS codes of a complete P1 telegram in a single pass
+"""
+
+#    Copyright (C) 2016  Chris Brouwer
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from datetime import datetime
+import pytz
+
+# OBIS code -> (field, kind). The kind tells how the value groups are decoded.
+OBIS_FIELDS = {
+    b'0-0:1.0.0': ('timestamp', 'timestamp'),
+    b'0-0:96.14.0': ('tariff', 'int'),
+    b'1-0:1.8.1': ('t1', 'float'),
+    b'1-0:1.8.2': ('t2', 'float'),
+    b'1-0:2.8.1': ('t1_return', 'float'),
+    b'1-0:2.8.2': ('t2_return', 'float'),
+    b'1-0:1.7.0': ('consumption', 'float'),
+    b'1-0:2.7.0': ('production', 'float'),
+    b'1-0:21.7.0': ('power_l1', 'float'),
+    b'1-0:41.7.0': ('power_l2', 'float'),
+    b'1-0:61.7.0': ('power_l3', 'float'),
+    b'1-0:22.7.0': ('return_l1', 'float'),
+    b'1-0:42.7.0': ('return_l2', 'float'),
+    b'1-0:62.7.0': ('return_l3', 'float'),
+    b'1-0:32.7.0': ('voltage_l1', 'float'),
+    b'1-0:52.7.0': ('voltage_l2', 'float'),
+    b'1-0:72.7.0': ('voltage_l3', 'float'),
+    b'1-0:31.7.0': ('current_l1', 'float'),
+    b'1-0:51.7.0': ('current_l2', 'float'),
+    b'1-0:71.7.0': ('current_l3', 'float'),
+    # Gas: DSMR 4/5 '(timestamp)(value*m3)', DSMR 2.2 '(timestamp)(..)(..)(..)(code)(m3)'
+    # with the value on the next line
+    b'0-1:24.2.1': ('gas', 'gas'),
+    b'0-1:24.3.0': ('gas', 'gas22'),
+}
+
+
+class telegramParser():
+    """ Turns a raw telegram (bytes) into a dict of field -> value """
+    def __init__ (self, tz=None):
+        self.tz = tz if tz is not None else pytz.timezone("Europe/Amsterdam")
+        # DSMR 4 and up tell whether the meter's local time is summer (S) or winter (W)
+        # time, so we can convert to UTC without any guessing around DST transitions.
+        self.winterOffset = self.tz.utcoffset(datetime(2000, 1, 15))
+        self.summerOffset = self.tz.utcoffset(datetime(2000, 7, 15))
+        # DSMR 2.2 has no such flag; remember the offset per local hour instead
+        self.hourOffsets = {}
+
+    def parse(self, telegram):
+        values = {}
+        fields = OBIS_FIELDS
+        continuation = False
+        # The serial interface seems to be adding NULL characters sometimes...
+        for line in telegram.replace(b'\x00', b'').split(b'\n'):
+            code, _, rest = line.partition(b'(')
+            field = fields.get(code)
+            if field is None:
+                if continuation and not code and rest:
+                    values['gas'] = float(rest.rstrip(b')\r'))
+                continuation = False
+                continue
+            name, kind = field
+            if kind == 'float':
+                # The last '(...)' group holds the value, possibly followed by a unit
+                values[name] = float(rest.rpartition(b'(')[2].partition(b'*')[0].rstrip(b')\r'))
+            elif kind == 'timestamp':
+                values[name] = self.decodeTimestamp(rest)
+            elif kind == 'int':
+                values[name] = int(rest.rstrip(b')\r'))
+            elif kind == 'gas':
+                values[name] = float(rest.rpartition(b'(')[2].partition(b'*')[0].rstrip(b')\r'))
+                values['gas_timestamp'] = self.decodeTimestamp(rest)
+            elif kind == 'gas22':
+                values['gas_timestamp'] = self.decodeTimestamp(rest)
+                continuation = True
+        return values
+
+    def decodeTimestamp(self, value):
+        """ Decodes the fixed width YYMMDDhhmmss[S|W] format into an aware UTC datetime """
+        d = [c - 48 for c in value[:12]]
+        local = datetime(2000 + d[0] * 10 + d[1], d[2] * 10 + d[3], d[4] * 10 + d[5],
+                         d[6] * 10 + d[7], d[8] * 10 + d[9], d[10] * 10 + d[11])
+        dst = value[12:13]
+        if dst == b'W':
+            return (local - self.winterOffset).replace(tzinfo=pytz.utc)
+        if dst == b'S':
+            return (local - self.summerOffset).replace(tzinfo=pytz.utc)
+        # No DST flag, let pytz figure it out (once per hour)
+        offset = self.hourOffsets.get(value[:8])
+        if offset is None:
+            if len(self.hourOffsets) > 1000:
+                self.hourOffsets.clear()
+            offset = self.hourOffsets[value[:8]] = self.tz.localize(local).utcoffset()
+        return (local - offset).replace(tzinfo=pytz.utc)
@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+"""
+    Peak demand per quarter hour, for capacity tariffs
+
+    A capacity tariff bills the highest average power drawn in any quarter hour of
+    the month. The tracker follows the quarter hour running now from the t1 and t2
+    counters, so it needs nothing but the readings as they come in:
+
+        average demand of a quarter = ((t1 + t2 at its end) - (t1 + t2 at its start)) * 4
+
+    A quarter starts at the first reading at or after its boundary, as the rollup
+    buckets do, so a quarter is exactly the sum of its three 5-minute metrics. When
+    readings are missing across a boundary, the quarter before the gap gets the
+    average over the whole gap, which is a lower bound of the real peak in there.
+
+    Every reading costs a few additions; the top of the month is only updated once
+    per quarter, and holds at most topN quarters. While a quarter runs, its demand
+    is projected by assuming the current power holds until its end, so a warning
+    can go out while there is still time to switch something off.
+"""
+
+#    Copyright (C) 2016  Chris Brouwer
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import logging
+from datetime import datetime
+import pytz
+
+QUARTER_SECONDS = 900
+
+
+class peakTracker():
+    """ Follows the quarter-hour demand of one meter, and keeps the topN highest
+        quarters of the month, highest first, as (kW, start in epoch seconds) """
+    def __init__ (self, topN=5, tz=None):
+        self.topN = topN
+        self.tz = tz if tz is not None else pytz.timezone("Europe/Amsterdam")
+        # Boundary of the running quarter, and t1 + t2 at its start; None while we
+        # started halfway a quarter
+        self.boundary = None
+        self.startEnergy = None
+        self.energy = None
+        self.lastTs = None
+        # Start and end of the (local) month the top belongs to, in epoch seconds
+        self.month = None
+        self.monthEnd = None
+        self.top = []
+        self.quarters = 0
+        self.projected = None
+        self.warned = False
+
+    def monthSpan(self, epoch):
+        """ Start and end of the local month epoch is in """
+        local = datetime.fromtimestamp(epoch, self.tz)
+        nextMonth = datetime(local.year + local.month // 12, local.month % 12 + 1, 1)
+        return (self.tz.localize(datetime(local.year, local.month, 1)).timestamp(),
+                self.tz.localize(nextMonth).timestamp())
+
+    def offer(self, reading):
+        """ Takes the next reading of the meter; returns (start, kW) of the quarter it
+            completes, or None """
+        now = reading.timestamp.timestamp()
+        if self.lastTs is not None and now <= self.lastTs:
+            return None
+        energy = reading.t1 + reading.t2
+        boundary = now - now % QUARTER_SECONDS
+        finished = None
+        if self.boundary is None or boundary > self.boundary:
+            if self.startEnergy is not None:
+                finished = self.finish(self.boundary, boundary, energy - self.startEnergy)
+            self.startEnergy = energy if self.boundary is not None or now == boundary else None
+            self.boundary = boundary
+            self.warned = False
+        self.lastTs = now
+        self.energy = energy
+        self.project(reading.consumption, now)
+        return finished
+
+    def finish(self, start, end, delta):
+        if delta < 0:
+            logging.warning("Meter counters went back in the quarter from %s, skipping it",
+                            datetime.fromtimestamp(start, self.tz))
+            return None
+        kw = round(delta * 3600 / (end - start), 3)
+        if self.month is None or not self.month <= start < self.monthEnd:
+            self.month, self.monthEnd = self.monthSpan(start)
+            self.top = []
+            self.quarters = 0
+        self.quarters += 1
+        if len(self.top) < self.topN or kw > self.top[-1][0]:
+            index = len(self.top)
+            while index > 0 and self.top[index - 1][0] < kw:
+                index -= 1
+            self.top.insert(index, (kw, start))
+            del self.top[self.topN:]
+        return start, kw
+
+    def project(self, power, now):
+        """ The demand of the running quarter if power (kW) holds until its end """
+        if self.startEnergy is None or power is None:
+            self.projected = None
+            return
+        remaining = self.boundary + QUARTER_SECONDS - now
+        self.projected = (self.energy - self.startEnergy + power * remaining / 3600) * 3600 / QUARTER_SECONDS
+
+    def average(self):
+        """ The average demand of the running quarter so far """
+        if self.startEnergy is None or self.lastTs <= self.boundary:
+            return None
+        return (self.energy - self.startEnergy) * 3600 / (self.lastTs - self.boundary)
+
+    def peak(self):
+        """ The highest quarter of the month the running quarter is in, or None """
+        if self.top and self.boundary is not None and self.month <= self.boundary < self.monthEnd:
+            return self.top[0]
+        return None
+
+    def warning(self, threshold=2.5, warnAfter=300):
+        """ Returns True, once per quarter, when warnAfter seconds into the quarter the
+            projection reaches threshold kW and beats the peak of the month """
+        if self.warned or self.projected is None or self.lastTs - self.boundary < warnAfter:
+            return False
+        peak = self.peak()
+        if self.projected < threshold or (peak is not None and self.projected <= peak[0]):
+            return False
+        self.warned = True
+        return True
+
+    def document(self):
+        """ The peaks of the month, as stored in the peaks collection """
+        peak = self.top[0] if self.top else (None, None)
+        return {"ts": datetime.fromtimestamp(self.month, pytz.utc),
+                "peak_kw": peak[0],
+                "peak_ts": datetime.fromtimestamp(peak[1], pytz.utc) if peak[1] is not None else None,
+                "top": [{"ts": datetime.fromtimestamp(start, pytz.utc), "kw": kw} for kw, start in self.top],
+                "quarters": self.quarters}
+
+    def restore(self, document):
+        """ Continues the month of a stored document """
+        self.month, self.monthEnd = self.monthSpan(document["ts"].timestamp())
+        self.top = [(entry["kw"], entry["ts"].timestamp()) for entry in document["top"]][:self.topN]
+        self.quarters = document["quarters"]
+
+    def state(self):
+        peak = self.peak()
+        return {"quarter": datetime.fromtimestamp(self.boundary, pytz.utc) if self.boundary is not None else None,
+                "average_kw": self.average(),
+                "projected_kw": self.projected,
+                "peak": None if peak is None else {"ts": datetime.fromtimestamp(peak[1], pytz.utc), "kw": peak[0]},
+                "top": [{"ts": datetime.fromtimestamp(start, pytz.utc), "kw": kw} for kw, start in self.top]}
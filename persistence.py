@@ -17,162 +17,709 @@
 #    You should have received a copy of the GNU General Public License
 #    along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import abc
+import argparse
+import hashlib
 import logging
+import os
 import sys
+import threading
+import struct
+import time
 from datetime import datetime
-from datetime import timedelta
+from time import perf_counter
 import pytz
 import pymongo
+from bson import ObjectId
 from pymongo import MongoClient
+from pymongo import InsertOne
+from pymongo import ReplaceOne
+from pymongo.errors import BulkWriteError
+from helpers import circuitBreaker
 from helpers import reading
+from instrumentation import stats
+from pipeline import shed
+from rollup import INTERVALS
+from rollup import rollupEngine
+from wal import walBuffer
+from wal import writeAheadLog
 
+MONGO_URL = os.environ.get('POWERMON_MONGO_URL', 'mongodb://192.168.1.1:27017/')
 
-class mongoPersistence():
-    def __init__ (self):
-        self.client = None;
+BACKENDS = ("mongo", "sqlite", "memory")
+
+# Writes go through a background thread and a circuit breaker, so there is no need
+# to wait pymongo's default 30 seconds to find out the server is gone
+SERVER_SELECTION_TIMEOUT_MS = 2000
+
+DUPLICATE_KEY = 11000
+
+# Seconds between attempts to prepare the database and look up the last metrics while
+# it is down
+RECONCILE_RETRY = 30
+
+# Sources of counters that aren't the real counters at the time asked for
+INEXACT = ("interpolated", "clamped")
+
+METRICS_COLLECTIONS = tuple(definition[1] for definition in INTERVALS)
+
+# The quarter-hour peaks of every month, see peak.py
+PEAKS_COLLECTION = "peaks"
+
+# Collections that may be created as native time-series collections (MongoDB 5.0+)
+TIMESERIES_GRANULARITY = {"reading": "seconds", "metrics.minute": "minutes"}
+
+
+def readingId(reading, meter=None):
+    """ The _id of a reading: its time plus a hash of the meter, in an ObjectId, so
+        writing the same reading twice is a duplicate key instead of a second copy """
+    meterHash = hashlib.blake2b(str(meter or "").encode("utf-8"), digest_size=8).digest()
+    return ObjectId(struct.pack(">I", int(reading.timestamp.timestamp())) + meterHash)
+
+
+def operation(item):
+    """ Turns a queued write into a pymongo operation. Writes are queued as plain
+        documents, so they can go through the write-ahead log. """
+    if item["op"] == "insert":
+        return InsertOne(item["doc"])
+    return ReplaceOne(item["filter"], item["doc"], upsert=True)
+
+
+def isTimeseries(db, name):
+    for info in db.list_collections(filter={"name": name}):
+        return info.get("type") == "timeseries"
+    return False
+
+
+def provisionSchema(db, timeseries=()):
+    """ Creates the collections and indexes powermon relies on. Only creates what is
+        missing, so it is cheap to run on every start. Collections named in timeseries
+        are created as time-series collections, if they don't exist yet. """
+    existing = set(db.list_collection_names())
+    for name in timeseries:
+        if name not in existing:
+            logging.info("Creating time-series collection %s", name)
+            db.create_collection(name, timeseries={"timeField": "ts", "metaField": "meter",
+                                                   "granularity": TIMESERIES_GRANULARITY[name]})
+        elif not isTimeseries(db, name):
+            logging.warning("%s is a regular collection; run 'python persistence.py migrate %s'"
+                            + " to turn it into a time-series collection", name, name)
+    for name in ("reading",) + METRICS_COLLECTIONS + (PEAKS_COLLECTION,):
+        db[name].create_index([("ts", pymongo.DESCENDING)], name="ts")
+        # Documents of the default meter have no meter field, which {"meter": None}
+        # matches as well, so this index serves every meter
+        db[name].create_index([("meter", pymongo.ASCENDING), ("ts", pymongo.DESCENDING)], name="meter_ts")
+
+
+def migrateToTimeseries(db, name, batchSize=10000, keepLegacy=False):
+    """ Moves the documents of an existing regular collection into a new time-series
+        collection with the same name. The old data is renamed to <name>.legacy first,
+        so nothing is lost if the copy gets interrupted. """
+    if isTimeseries(db, name):
+        logging.info("%s already is a time-series collection", name)
+        return 0
+    legacy = name + ".legacy"
+    if name in db.list_collection_names():
+        db[name].rename(legacy)
+    db.create_collection(name, timeseries={"timeField": "ts", "metaField": "meter",
+                                           "granularity": TIMESERIES_GRANULARITY[name]})
+    copied = 0
+    batch = []
+    for document in db[legacy].find({}, {"_id": 0}).sort("ts", pymongo.ASCENDING).batch_size(batchSize):
+        batch.append(document)
+        if len(batch) >= batchSize:
+            db[name].insert_many(batch, ordered=False)
+            copied += len(batch)
+            batch = []
+    if batch:
+        db[name].insert_many(batch, ordered=False)
+        copied += len(batch)
+    db[name].create_index([("ts", pymongo.DESCENDING)], name="ts")
+    db[name].create_index([("meter", pymongo.ASCENDING), ("ts", pymongo.DESCENDING)], name="meter_ts")
+    logging.info("Copied %d documents from %s into time-series collection %s", copied, legacy, name)
+    if not keepLegacy:
+        db[legacy].drop()
+    return copied
+
+
+class writeBehindBuffer():
+    """ Collects writes per collection, and hands them to write(collection, items) in
+        bulk from a background thread. A flush happens once maxBatch items are waiting,
+        or when the oldest one has waited maxLatency seconds. What an item is, is up to
+        the backend: a queued document, a row, ...
+
+        While the database is slow, at most maxPending items wait. Beyond that the
+        overload policy drops items of the droppable collections (the raw readings);
+        other items, like metrics, are always kept. """
+    def __init__ (self, write, maxBatch=100, maxLatency=5.0, statsInterval=300, maxPending=10000,
+                  overload="drop-oldest", droppable=("reading",)):
+        self.write = write
+        self.maxBatch = maxBatch
+        self.maxLatency = maxLatency
+        self.statsInterval = statsInterval
+        self.maxPending = maxPending
+        self.overload = overload
+        self.droppable = droppable
+        self.lock = threading.Lock()
+        self.flushLock = threading.Lock()
+        self.pending = {}
+        self.depth = 0
+        self.oldest = None
+
+        # Statistics
+        self.flushes = 0
+        self.written = 0
+        self.failed = 0
+        self.dropped = 0
+        self.highWater = 0
+        self.lastFlushSize = 0
+        self.maxFlushSize = 0
+        self.lastFlushLatency = None
+        self.maxFlushLatency = 0.0
+        self.totalFlushLatency = 0.0
+
+        self.wakeup = threading.Event()
+        self.stopping = threading.Event()
+        self.thread = threading.Thread(target=self.run, name="write-behind", daemon=True)
+        self.thread.start()
+
+    def add(self, collection, item):
+        with self.lock:
+            items = self.pending.setdefault(collection, [])
+            if self.depth >= self.maxPending and collection in self.droppable:
+                dropped = shed(items, self.overload)
+                self.depth -= dropped
+                self.dropped += dropped
+                stats.count("readings_dropped_overload", dropped)
+                if self.dropped == dropped:
+                    logging.warning("The database can't keep up, dropping readings (%s)", self.overload)
+            items.append(item)
+            self.depth += 1
+            if self.depth > self.highWater:
+                self.highWater = self.depth
+            if self.oldest is None:
+                self.oldest = time.monotonic()
+            full = self.depth >= self.maxBatch
+        if full:
+            self.wakeup.set()
 
+    def run(self):
+        nextStats = time.monotonic() + self.statsInterval
+        while not self.stopping.is_set():
+            oldest = self.oldest
+            timeout = self.maxLatency if oldest is None else oldest + self.maxLatency - time.monotonic()
+            self.wakeup.wait(max(timeout, 0))
+            self.wakeup.clear()
+            oldest = self.oldest
+            if self.depth >= self.maxBatch or \
+               (oldest is not None and time.monotonic() - oldest >= self.maxLatency):
+                self.flush()
+            if time.monotonic() >= nextStats:
+                logging.info("Write-behind stats: %s", self.stats())
+                nextStats = time.monotonic() + self.statsInterval
+
+    def flush(self):
+        with self.flushLock:
+            with self.lock:
+                pending = self.pending
+                size = self.depth
+                self.pending = {}
+                self.depth = 0
+                self.oldest = None
+            if not size:
+                return
+            start = time.monotonic()
+            for collection, items in pending.items():
+                try:
+                    t0 = perf_counter()
+                    self.write(collection, items)
+                    stats.observe("write", perf_counter() - t0)
+                    self.written += len(items)
+                except Exception:
+                    logging.exception("Error on writing %d documents in %s!", len(items), collection)
+                    self.failed += len(items)
+            latency = time.monotonic() - start
+            self.flushes += 1
+            self.lastFlushSize = size
+            self.maxFlushSize = max(self.maxFlushSize, size)
+            self.lastFlushLatency = latency
+            self.maxFlushLatency = max(self.maxFlushLatency, latency)
+            self.totalFlushLatency += latency
+
+    def stats(self):
+        flushes = self.flushes
+        return {"depth": self.depth,
+                "high_water": self.highWater,
+                "flushes": flushes,
+                "written": self.written,
+                "failed": self.failed,
+                "dropped": self.dropped,
+                "flush_size_last": self.lastFlushSize,
+                "flush_size_max": self.maxFlushSize,
+                "flush_size_avg": self.written / flushes if flushes else None,
+                "flush_latency_last": self.lastFlushLatency,
+                "flush_latency_max": self.maxFlushLatency,
+                "flush_latency_avg": self.totalFlushLatency / flushes if flushes else None}
+
+    def close(self):
+        """ Stops the background thread, and writes whatever is still waiting """
+        self.stopping.set()
+        self.wakeup.set()
+        self.thread.join()
+        self.flush()
+
+
+class basePersistence(abc.ABC):
+    """ What powermon needs from a persistence backend: storing readings, storing the
+        metrics the rollup engine produces, and finding the last metrics written, to
+        continue where we left off. The rollup itself is the same for every backend.
+
+        Every meter has its own rollup engine. Meter None is the default meter, whose
+        documents aren't tagged, just like before there were multiple meters.
+
+        With a checkpoint, the rollup engines are restored from the local file at
+        startup, and the database is only asked for the last metrics afterwards, from
+        a background thread. Whatever it finds is applied by the pipeline thread, on
+        the next reading. The same goes for an engine that couldn't be seeded because
+        the database didn't answer: it starts without the last metrics, and gets them
+        once the database is back. """
+    def __init__ (self, checkpoint=None):
+        self.rollups = {}
+        # Coarsest first, to find the document a moment is the boundary of
+        self.intervals = list(reversed(rollupEngine().intervals))
+        self.checkpoint = checkpoint
+        self.reconciled = None
+        self.reconcileLock = threading.Lock()
+        # Set once prepare() has run; writes to the database wait for it
+        self.prepared = threading.Event()
+        # Whether prepare() succeeded; until it does, it is retried
+        self.provisioned = False
+        self.provisionLock = threading.Lock()
+
+    def startup(self):
+        """ Restores the rollup engines from the checkpoint, if there is one. Without
+            it, the engine of a meter is seeded from the database at its first reading,
+            so only the meters that are actually read get one. Subclasses call this at
+            the end of __init__. """
+        saved = self.checkpoint.load() if self.checkpoint is not None else {}
+        if not saved:
+            if not self.runPrepare():
+                threading.Thread(target=self.reconcile, args=([], False), name="reconcile", daemon=True).start()
+            return
+        for meter, state in saved.items():
+            self.rollups[meter] = rollupEngine()
+            self.rollups[meter].restore(state)
+        logging.info("Restored the rollup state of %d meter(s) from %s", len(saved), self.checkpoint.path)
+        threading.Thread(target=self.reconcile, args=(list(saved),), name="reconcile", daemon=True).start()
+
+    def prepare(self):
+        """ Gets the database ready for use, e.g. by creating indexes """
+
+    def provision(self):
+        """ Runs prepare() until it succeeds once; raises while it fails """
+        with self.provisionLock:
+            if not self.provisioned:
+                self.prepare()
+                self.provisioned = True
+
+    def runPrepare(self):
+        """ Tries to prepare the database, and lets the writes go ahead either way.
+            Returns whether it worked. """
+        try:
+            self.provision()
+        except Exception:
+            logging.exception("Error on preparing the database!")
+        finally:
+            self.prepared.set()
+        return self.provisioned
+
+    def reconcile(self, meters, prepare=True):
+        """ Prepares the database and looks up the last metrics of the restored meters,
+            in the background, until the database answers """
+        if prepare:
+            self.runPrepare()
+        while True:
+            found = []
+            try:
+                self.provision()
+                for meter in meters:
+                    for collection in METRICS_COLLECTIONS:
+                        last = self.getLastMetrics(collection, meter)
+                        if last is not None:
+                            found.append((meter, collection, last))
+                break
+            except Exception as e:
+                logging.warning("Can't prepare the database or look up the last metrics (%s), retrying in %d s",
+                                e, RECONCILE_RETRY)
+                time.sleep(RECONCILE_RETRY)
+        if not meters:
+            return
+        with self.reconcileLock:
+            self.reconciled = (self.reconciled or []) + found
+
+    def applyReconciled(self):
+        """ Seeds the buckets the database is further along with than the rollup state,
+            e.g. because another process wrote them, or because the engine started
+            without the database """
+        with self.reconcileLock:
+            found, self.reconciled = self.reconciled, None
+        seeded = 0
+        for meter, collection, last in found:
+            if self.rollups[meter].seedIfNewer(collection, last.timestamp, last.t1, last.t2):
+                seeded += 1
+        logging.info("Reconciled the rollup state with the database: %d bucket(s) ahead of it", seeded)
+
+    def saveCheckpoint(self):
         try:
-            self.client = MongoClient('mongodb://192.168.1.1:27017/')
+            self.checkpoint.save(self.rollups)
+        except Exception:
+            logging.exception("Error on saving the rollup checkpoint to %s!", self.checkpoint.path)
+
+    @property
+    def rollup(self):
+        """ The rollup engine of the default meter """
+        return self.rollupFor(None)
+
+    def rollupFor(self, meter):
+        engine = self.rollups.get(meter)
+        if engine is None:
+            engine = self.loadLastState(meter)
+        return engine
+
+    def loadLastState(self, meter=None):
+        """ Creates the rollup engine of a meter, seeded with the last metrics written
+            for every interval. If the database doesn't answer, the engine starts
+            unseeded, and is seeded in the background once it does. """
+        engine = self.rollups[meter] = rollupEngine()
+        try:
+            found = [(interval.collection, self.getLastMetrics(interval.collection, meter))
+                     for interval in engine.intervals]
+        except Exception as e:
+            logging.warning("Can't look up the last metrics of meter %s (%s); rolling up without them"
+                            + " until the database answers", meter, e)
+            threading.Thread(target=self.reconcile, args=([meter], False), name="reconcile", daemon=True).start()
+            return engine
+        for collection, last in found:
+            if last is not None:
+                engine.seed(collection, last.timestamp, last.t1, last.t2)
+        return engine
+
+    def updateMetrics(self, reading, meter=None):
+        t0 = perf_counter()
+        if self.reconciled is not None:
+            self.applyReconciled()
+        documents = self.rollupFor(meter).update(reading)
+        for collection, document in documents:
+            self.writeMetrics(collection, document, meter)
+        if documents and self.checkpoint is not None:
+            # A bucket boundary: the only moment the open buckets change
+            self.saveCheckpoint()
+        stats.observe("rollup", perf_counter() - t0)
+
+    def boundaryCounters(self, ts, meter=None):
+        """ Returns the counters at ts (an aware datetime) as the rollup knows them, plus
+            where they came from: from the open buckets or the last reading, or from the
+            coarsest metrics document starting at ts. (None, None) otherwise. """
+        engine = self.rollups.get(meter)
+        epoch = ts.timestamp()
+        if engine is not None:
+            counters = engine.countersAt(epoch)
+            if counters is not None:
+                return counters, "rollup"
+        for interval in self.intervals:
+            if interval.floor(ts) == epoch:
+                counters = self.getMetricsAt(interval.collection, ts, meter)
+                if counters is not None:
+                    return counters, interval.collection
+        return None, None
+
+    def countersAt(self, ts, meter=None):
+        """ Returns the counters at ts (an aware datetime) as a reading, plus where they
+            came from. The counters at a boundary are those of the first reading at or
+            after it, which is what the metrics document starting there holds.
+
+            Between boundaries the counters are interpolated between the closest known
+            ones around ts: the 1 minute boundaries, or stored readings in between.
+            Raw readings may be downsampled, so the first one stored after ts can be
+            minutes later; the minute boundaries keep the error within the
+            consumption of a minute. Outside the stored readings the nearest one is
+            returned, with source "clamped". """
+        counters, source = self.boundaryCounters(ts, meter)
+        if counters is not None:
+            return counters, source
+        before, after = self.getReadingsAround(ts, meter)
+        if after is not None and after.timestamp == ts:
+            return after, "reading"
+        minute = self.intervals[-1]
+        start = minute.floor(ts)
+        low = self.boundaryCounters(datetime.fromtimestamp(start, pytz.utc), meter)[0]
+        high = self.boundaryCounters(datetime.fromtimestamp(minute.next(start), pytz.utc), meter)[0]
+        if before is not None and (low is None or before.timestamp > low.timestamp):
+            low = before
+        if after is not None and (high is None or after.timestamp < high.timestamp):
+            high = after
+        if low is None or high is None:
+            # Before the first or after the last reading: the nearest we know, which
+            # isn't the counters at ts
+            return (high or low), "clamped"
+        share = (ts - low.timestamp) / (high.timestamp - low.timestamp)
+        return reading(timestamp=ts, t1=low.t1 + (high.t1 - low.t1) * share,
+                       t2=low.t2 + (high.t2 - low.t2) * share), "interpolated"
+
+    def consumption(self, start, end, meter=None):
+        """ Returns the consumption between two aware datetimes, per tariff, or None if
+            there are no readings.
+
+            Every metrics document carries the counters at its boundary, so the sum over
+            any run of adjacent buckets is the difference of the counters at its ends.
+            A range therefore only needs the counters at its two edges: from the
+            coarsest document starting at an edge, or for an edge that isn't on a
+            boundary, interpolated within the minute around it (see countersAt). That is
+            a few lookups for any range. The result is exact when both edges are on a
+            boundary; "exact" is False when an edge was interpolated, or lies outside the
+            stored readings. """
+        first, fromSource = self.countersAt(start, meter)
+        last, toSource = self.countersAt(end, meter)
+        if first is None or last is None:
+            return None
+        d_t1 = round(last.t1 - first.t1, 5)
+        d_t2 = round(last.t2 - first.t2, 5)
+        return {"start": start,
+                "end": end,
+                "d_t1": d_t1,
+                "d_t2": d_t2,
+                "d_total": round(d_t1 + d_t2, 5),
+                "exact": fromSource not in INEXACT and toSource not in INEXACT,
+                "from": {"ts": first.timestamp, "source": fromSource},
+                "to": {"ts": last.timestamp, "source": toSource}}
+
+    @abc.abstractmethod
+    def storeReading(self, reading, meter=None):
+        """ Stores a reading """
+
+    @abc.abstractmethod
+    def writeMetrics(self, collection, document, meter=None):
+        """ Stores a metrics document, replacing the one of the meter with the same ts """
+
+    @abc.abstractmethod
+    def getLastMetrics(self, collection, meter=None):
+        """ Returns the last metrics of a meter in collection as a reading (timestamp,
+            t1, t2), or None if there are none. Raises if the lookup fails, as an
+            engine that believes there are none would overwrite the last bucket. """
+
+    @abc.abstractmethod
+    def getMetricsAt(self, collection, ts, meter=None):
+        """ Returns the metrics of a meter in collection starting at ts as a reading
+            (timestamp, t1, t2), or None """
+
+    @abc.abstractmethod
+    def getReadingsAround(self, ts, meter=None):
+        """ Returns the last stored reading of a meter before ts and the first one at
+            or after it, each as a reading (timestamp, t1, t2) or None """
+
+    @abc.abstractmethod
+    def writePeaks(self, document, meter=None):
+        """ Stores the peaks document of a month, replacing the one of the meter with
+            the same ts """
+
+    @abc.abstractmethod
+    def getPeaks(self, ts, meter=None):
+        """ Returns the peaks document of a meter for the month starting at ts, or None """
+
+    def close(self):
+        if self.checkpoint is not None and self.rollups:
+            self.saveCheckpoint()
+
+
+class mongoPersistence(basePersistence):
+    def __init__ (self, url=MONGO_URL, dbName="powermon", timeseries=(), client=None, checkpoint=None,
+                  walDir=None, maxPending=10000, overload="drop-oldest"):
+        basePersistence.__init__(self, checkpoint)
+        self.client = client;
+
+        try:
+            if self.client is None:
+                self.client = MongoClient(url, serverSelectionTimeoutMS=SERVER_SELECTION_TIMEOUT_MS)
         except Exception:
             logging.exception("Error on opening mongo client")
             sys.exit("Exception on getting Persistence - no point in continuing...")
-        self.last5mreading = self.getLastMetrics("metrics.minute")
-        self.last1Hreading = self.getLastMetrics("metrics.hour")
-        self.last1Dreading = self.getLastMetrics("metrics.day")
-        self.last1Mreading = self.getLastMetrics("metrics.month")
+        self.db = self.client[dbName]
+        self.timeseries = set(timeseries)
+        self.breaker = circuitBreaker()
+        if walDir:
+            self.buffer = walBuffer(self.bulkWrite, writeAheadLog(walDir), self.breaker)
+        else:
+            self.buffer = writeBehindBuffer(self.bulkWrite, maxPending=maxPending, overload=overload)
+        self.startup()
+
+    def prepare(self):
+        provisionSchema(self.db, self.timeseries)
 
-    def getLastMetrics(self, collection):
+    def bulkWrite(self, collection, items):
+        # Time-series collections have to exist before the first insert, or it would
+        # create a regular one
+        self.prepared.wait()
+        self.provision()
         try:
-            db = self.client.powermon
-            metrics = db[collection]
-            cursor = metrics.find().sort('ts', pymongo.DESCENDING).limit(1)
-            if cursor.count() > 0:
-                next = cursor.next()
-                areading = reading()
-                areading.t1 = next["t1"]
-                areading.t2 = next["t2"]
-                areading.timestamp = pytz.UTC.localize(next["ts"])
-                return areading
+            self.db[collection].bulk_write([operation(item) for item in items], ordered=False)
+        except BulkWriteError as e:
+            # Readings that were written already, e.g. when replaying the write-ahead
+            # log after a crash
+            errors = e.details.get("writeErrors", [])
+            if e.details.get("writeConcernErrors") or any(error["code"] != DUPLICATE_KEY for error in errors):
+                raise
+            logging.info("Skipped %d documents already in %s", len(errors), collection)
+
+    def getLastMetrics(self, collection, meter=None):
+        if not self.breaker.allow():
+            raise ConnectionError("Mongo is unavailable")
+        try:
+            next = self.db[collection].find_one({"meter": meter}, sort=[('ts', pymongo.DESCENDING)])
         except Exception:
-            logging.exception("Error on retrieving last metrics  in %s!", collection)   
-        return None
+            self.breaker.failure()
+            raise
+        self.breaker.success()
+        if next is None:
+            return None
+        return reading(timestamp=pytz.UTC.localize(next["ts"]), t1=next["t1"], t2=next["t2"])
+
+    def getMetricsAt(self, collection, ts, meter=None):
+        document = self.db[collection].find_one({"ts": ts, "meter": meter})
+        if document is None:
+            return None
+        return reading(timestamp=pytz.UTC.localize(document["ts"]), t1=document["t1"], t2=document["t2"])
+
+    def getReadingsAround(self, ts, meter=None):
+        # Both served by the meter_ts index
+        before = self.db.reading.find_one({"meter": meter, "ts": {"$lt": ts}},
+                                          sort=[("ts", pymongo.DESCENDING)], projection=["ts", "t1", "t2"])
+        after = self.db.reading.find_one({"meter": meter, "ts": {"$gte": ts}},
+                                         sort=[("ts", pymongo.ASCENDING)], projection=["ts", "t1", "t2"])
+        return tuple(None if document is None else
+                     reading(timestamp=pytz.UTC.localize(document["ts"]), t1=document["t1"], t2=document["t2"])
+                     for document in (before, after))
         
-    def storeReading(self, reading):
+    def getPeaks(self, ts, meter=None):
+        if not self.breaker.allow():
+            return None
         try:
-            db = self.client.powermon
-            mreading = {"ts": reading.timestamp.utcnow(), \
-                        "consumption": reading.consumption}
-            readings = db.reading
-            readings.insert_one(mreading)
+            document = self.db[PEAKS_COLLECTION].find_one({"ts": ts, "meter": meter})
+            self.breaker.success()
         except Exception:
-            logging.exception("Error on inserting reading!")
-            
-    def updateMetrics(self, reading):
-        self.updateMetrics5m(reading)
-        self.updateMetrics1H(reading) 
-        self.updateMetrics1D(reading)
-        self.updateMetrics1M(reading)
-    
-    def updateMetrics5m(self, reading):
-        doUpdate = False
-        
-        logging.debug(self.last5mreading)
-        if self.last5mreading is None:
-            doUpdate = True
-        else:
-            # Going to check how old our last metrics is. If it's older than 6 minutes, 
-            # then we missed some data. To prevent weird delta's, we clear the last reading
-            if (reading.timestamp - self.last5mreading.timestamp) > timedelta(seconds=359):
-                doUpdate = True;
-                self.last5mreading = None
-            elif (reading.timestamp - self.last5mreading.timestamp) > timedelta(seconds=300):
-                doUpdate = True;
-        if doUpdate:
-            logging.info("updating metrics 5m")
-            reading.timestamp = reading.timestamp.replace(second=0,microsecond=0)
-            self.insertMetrics(reading, self.last5mreading, "metrics.minute")
-            self.last5mreading = reading
-
-    def updateMetrics1H(self, reading):
-        doUpdate = False
-        if self.last1Hreading is None:
-            doUpdate = True
-        else:
-            # Going to check how old our last metrics is. If it's older than 1:05 hours, 
-            # then we missed some data. To prevent weird delta's, we clear the last reading
-            if (reading.timestamp - self.last1Hreading.timestamp) > timedelta(seconds=3900):
-                doUpdate = True;
-                self.last1Hreading = None
-            elif reading.timestamp.hour != self.last1Hreading.timestamp.hour:
-                doUpdate = True;
-        if doUpdate:
-            logging.info("updating metrics 1H")
-            reading.timestamp = reading.timestamp.replace(minute=0,second=0,microsecond=0)
-            self.insertMetrics(reading, self.last1Hreading, "metrics.hour")
-            self.last1Hreading = reading
-       
-    def updateMetrics1D(self, reading):
-        doUpdate = False
-        if self.last1Dreading is None:
-            doUpdate = True
-        else:
-            # Going to check how old our last metrics is. If it's older than 25 hours, 
-            # then we missed some data. To prevent weird delta's, we clear the last reading
-            if (reading.timestamp - self.last1Dreading.timestamp) >= timedelta(hours=25):
-                doUpdate = True;
-                self.last1Dreading = None
-            elif reading.timestamp.day != self.last1Dreading.timestamp.day:
-                doUpdate = True;
-        if doUpdate:
-            logging.info("updating metrics 1D")
-            reading.timestamp = reading.timestamp.replace(hour=0,minute=0,second=0,microsecond=0)
-            self.insertMetrics(reading, self.last1Dreading, "metrics.day")
-            self.last1Dreading = reading
-
-    def updateMetrics1M(self, reading):
-        doUpdate = False
-        if self.last1Mreading is None:
-            doUpdate = True
+            self.breaker.failure()
+            logging.exception("Error on retrieving the peaks of %s!", ts)
+            return None
+        if document is None:
+            return None
+        document["ts"] = pytz.UTC.localize(document["ts"])
+        if document["peak_ts"] is not None:
+            document["peak_ts"] = pytz.UTC.localize(document["peak_ts"])
+        for entry in document["top"]:
+            entry["ts"] = pytz.UTC.localize(entry["ts"])
+        return document
+
+    def close(self):
+        basePersistence.close(self)
+        self.buffer.close()
+        self.client.close()
+
+    def storeReading(self, reading, meter=None):
+        # Store everything we know, so the metrics can be rebuilt from the readings
+        mreading = {"_id": readingId(reading, meter), "ts": reading.timestamp}
+        if meter is not None:
+            mreading["meter"] = meter
+        mreading.update(reading.asDict())
+        del mreading["timestamp"]
+        self.buffer.add("reading", {"op": "insert", "doc": mreading})
+
+    def writeMetrics(self, collection, document, meter=None):
+        if meter is not None:
+            document = dict(document, meter=meter)
+        if collection in self.timeseries:
+            # Time-series collections don't support upserts
+            self.buffer.add(collection, {"op": "insert", "doc": document})
         else:
-            # Going to check how old our last metrics is. If it's older than 32 days, 
-            # then we missed some data. To prevent weird delta's, we clear the last reading
-            if (reading.timestamp - self.last1Mreading.timestamp) >= timedelta(days=32):
-                doUpdate = True;
-                self.last1Mreading = None
-            # Compare on month, rather than diff. This takes care of months with different
-            # number of days
-            elif reading.timestamp.month != self.last1Mreading.timestamp.month:
-                doUpdate = True;
-        if doUpdate:
-            logging.info("updating metrics 1M")
-            reading.timestamp = reading.timestamp.replace(hour=0,minute=0,second=0,microsecond=0)
-            self.insertMetrics(reading, self.last1Mreading, "metrics.month")
-            self.last1Mreading = reading
-
-    def insertMetrics(self, reading, lastreading, collection):
-            try:
-                db = self.client.powermon
-                
-                if lastreading is None:
-                    delta_t1 = 0
-                    delta_t2 = 0
-                    delta_total = 0
-                else:
-                    delta_t1 = round(reading.t1 - lastreading.t1, 5)
-                    delta_t2 = round(reading.t2 - lastreading.t2,5)
-                    delta_total = round(delta_t1 + delta_t2,5)
-                 
-                mreading = {"ts":  reading.timestamp, \
-                        "t1": reading.t1, \
-                        "t2": reading.t2, \
-                        "d_t1": delta_t1, \
-                        "d_t2": delta_t2, \
-                        "d_total": delta_total \
-                        }
-                metrics = db[collection]
-                metrics.insert_one(mreading)
-            except Exception:
-                logging.exception("Error on inserting metrics  in %s!", collection)   
-        
-        
-       
+            key = {"ts": document["ts"], "meter": meter}
+            self.buffer.add(collection, {"op": "replace", "filter": key, "doc": document})
+
+    def writePeaks(self, document, meter=None):
+        if meter is not None:
+            document = dict(document, meter=meter)
+        key = {"ts": document["ts"], "meter": meter}
+        self.buffer.add(PEAKS_COLLECTION, {"op": "replace", "filter": key, "doc": document})
+
+
+class memoryPersistence(basePersistence):
+    """ Keeps everything in memory, for tests and benchmarks """
+    def __init__ (self):
+        basePersistence.__init__(self)
+        self.readings = []
+        self.metrics = {}
+        self.peaks = {}
+
+    def storeReading(self, reading, meter=None):
+        self.readings.append((meter, reading))
+
+    def writeMetrics(self, collection, document, meter=None):
+        self.metrics.setdefault((collection, meter), {})[document["ts"]] = document
+
+    def getLastMetrics(self, collection, meter=None):
+        documents = self.metrics.get((collection, meter))
+        if not documents:
+            return None
+        last = documents[max(documents)]
+        return reading(timestamp=last["ts"], t1=last["t1"], t2=last["t2"])
+
+    def getMetricsAt(self, collection, ts, meter=None):
+        document = self.metrics.get((collection, meter), {}).get(ts)
+        if document is None:
+            return None
+        return reading(timestamp=document["ts"], t1=document["t1"], t2=document["t2"])
+
+    def getReadingsAround(self, ts, meter=None):
+        readings = [r for m, r in self.readings if m == meter]
+        earlier = [r for r in readings if r.timestamp < ts]
+        later = [r for r in readings if r.timestamp >= ts]
+        return (max(earlier, key=lambda r: r.timestamp) if earlier else None,
+                min(later, key=lambda r: r.timestamp) if later else None)
+
+    def writePeaks(self, document, meter=None):
+        self.peaks[(document["ts"], meter)] = document
+
+    def getPeaks(self, ts, meter=None):
+        return self.peaks.get((ts, meter))
+
+
+def createPersistence(backend="mongo", **options):
+    """ Returns the persistence backend with the given name: mongo (options url, dbName,
+        timeseries, checkpoint, walDir, maxPending and overload), sqlite (options path,
+        checkpoint, maxPending and overload) or memory """
+    if backend == "mongo":
+        return mongoPersistence(**options)
+    if backend == "sqlite":
+        # Imported here, as sqlitepersistence builds on this module
+        from sqlitepersistence import sqlitePersistence
+        return sqlitePersistence(**options)
+    if backend == "memory":
+        return memoryPersistence()
+    raise ValueError("Unknown persistence backend %r, expected one of %s" % (backend, ", ".join(BACKENDS)))
+
+if __name__ == '__main__':
+    argparser = argparse.ArgumentParser(description="Manage the powermon database schema")
+    argparser.add_argument('--url', default=MONGO_URL)
+    argparser.add_argument('--db', default='powermon')
+    commands = argparser.add_subparsers(dest='command', required=True)
+    provision = commands.add_parser('provision', help="create missing collections and indexes")
+    provision.add_argument('--timeseries', nargs='*', default=[], choices=sorted(TIMESERIES_GRANULARITY))
+    migrate = commands.add_parser('migrate', help="convert existing collections to time-series collections")
+    migrate.add_argument('collections', nargs='+', choices=sorted(TIMESERIES_GRANULARITY))
+    migrate.add_argument('--keep-legacy', action='store_true')
+    args = argparser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    db = MongoClient(args.url)[args.db]
+    if args.command == 'provision':
+        provisionSchema(db, args.timeseries)
+    else:
+        for name in args.collections:
+            migrateToTimeseries(db, name, keepLegacy=args.keep_legacy)
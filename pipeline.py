@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+"""
+    Decoupling of the sinks from the serial reader
+
+        serial reader, parse, rollup ─┬─[sink queue]──> store ──[write-behind buffer]──> database
+                  │                   ├─[sink queue]──> forward to DSMR-reader
+                  │                   └─[sink queue]──> archive, ...
+                  └──[write-behind buffer]──> database (metrics)
+
+    The reader frames, parses and rolls up every telegram itself: that costs some
+    tens of microseconds, and the rollup only queues its writes, so it keeps up with
+    the meter whatever happens further on. Each sink (see sinks.py) then gets the
+    telegram on a thread of its own, so a slow sink doesn't hold up the others. The
+    sink queues are bounded; when one is full, the overload policy decides what
+    gives:
+
+        drop-oldest  the oldest waiting telegram is dropped
+        coalesce     every other waiting telegram is dropped, so the backlog gets
+                     sparser instead of losing a stretch of it
+
+    Only raw work is ever dropped: storing a reading, forwarding or archiving a
+    telegram. The rollup has seen every reading before any queue, so the first
+    reading of every bucket makes it into the metrics, and the metrics documents
+    are never dropped by the write-behind buffer either.
+"""
+
+#    Copyright (C) 2016  Chris Brouwer
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import logging
+import threading
+from collections import deque
+from instrumentation import stats
+
+OVERLOAD_POLICIES = ("drop-oldest", "coalesce")
+
+
+def shed(items, policy):
+    """ Makes room in a full list or deque of raw items; returns how many were dropped """
+    if not items:
+        return 0
+    if policy == "coalesce" and len(items) > 1:
+        kept = list(items)[1::2]
+        dropped = len(items) - len(kept)
+        items.clear()
+        items.extend(kept)
+        return dropped
+    if isinstance(items, deque):
+        items.popleft()
+    else:
+        del items[0]
+    return 1
+
+
+class telegramPipeline():
+    """ Runs process(telegram, ...) on its own thread, for the telegrams submit()ted to
+        it, through a queue of at most maxQueue telegrams """
+    def __init__ (self, process, maxQueue=600, policy="drop-oldest", name="process"):
+        if policy not in OVERLOAD_POLICIES:
+            raise ValueError("Unknown overload policy %r, expected one of %s" % (policy, ", ".join(OVERLOAD_POLICIES)))
+        self.process = process
+        self.maxQueue = maxQueue
+        self.policy = policy
+        self.queue = deque()
+        self.condition = threading.Condition()
+        self.highWater = 0
+        self.dropped = 0
+        self.stopping = False
+        self.thread = threading.Thread(target=self.run, name=name, daemon=True)
+        self.thread.start()
+
+    def submit(self, telegram, *args):
+        """ Queues a telegram, and the other arguments for process(); never waits """
+        with self.condition:
+            if len(self.queue) >= self.maxQueue:
+                dropped = shed(self.queue, self.policy)
+                self.dropped += dropped
+                stats.count("telegrams_dropped_overload", dropped)
+                if self.dropped == dropped:
+                    logging.warning("The %s thread can't keep up with the meter, dropping telegrams (%s)",
+                                    self.thread.name, self.policy)
+            self.queue.append((telegram,) + args)
+            if len(self.queue) > self.highWater:
+                self.highWater = len(self.queue)
+            self.condition.notify()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.queue and not self.stopping:
+                    self.condition.wait()
+                if not self.queue:
+                    return
+                item = self.queue.popleft()
+            try:
+                self.process(*item)
+            except Exception:
+                logging.exception("Error on processing a telegram! Trying to continue")
+
+    def stats(self):
+        return {"queued": len(self.queue),
+                "high_water": self.highWater,
+                "dropped": self.dropped,
+                "policy": self.policy}
+
+    def close(self):
+        """ Processes what is still queued, and stops the thread """
+        with self.condition:
+            self.stopping = True
+            self.condition.notify()
+        self.thread.join()
@@ -5,6 +5,10 @@
     Reads information from the P1 interface, and optionally stores it in a 
     persistence backend. Furthermore it stores some derived metrics, such as 
     consumption per interval.
+
+    The meters are read once, and every telegram goes to the configured sinks:
+    one or more databases, DSMR-reader, the archive and the HTTP server. The
+    configuration comes from powermon.ini and the environment, see config.py.
 """
 
 #    Copyright (C) 2016  Chris Brouwer
@@ -22,126 +26,414 @@
 #    You should have received a copy of the GNU General Public License
 #    along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import argparse
 from time import sleep
-from datetime import datetime
+from time import monotonic
+from time import perf_counter
+from time import time
 import pytz
 import serial
 import sys
 import logging
-import requests
-from persistence import mongoPersistence
+import os
+import signal
+from persistence import BACKENDS
+from persistence import createPersistence
+from checkpoint import rollupCheckpoint
+from helpers import parseTime
 from helpers import reading
+from framer import multiTelegramReader
+from framer import serialTelegramReader
+from obis import telegramParser
+from forwarder import fanOutForwarder
+from capture import captureWriter
+from config import argumentDefaults
+from config import loadConfig
+from capture import replayCapture
+from capture import replayTelegrams
+from archive import archiveWriter
+from archive import telegramArchive
+from ringbuffer import readingRingBuffer
+from downsample import MODES as DOWNSAMPLE_MODES
+from downsample import downsampler
+from pipeline import OVERLOAD_POLICIES
+from sinks import forwardSink
+from sinks import peakSink
+from sinks import persistenceSink
+from sinks import recentSink
+from sinks import recordSink
+from sinks import sinkWorker
+from httpexport import statusServer
+from instrumentation import stats
+from instrumentation import jsonReporter
+from instrumentation import logReporter
+from instrumentation import periodicReporter
+
+SERIAL_MODE = "115200 7E1"
+BYTESIZES = {"7": serial.SEVENBITS, "8": serial.EIGHTBITS}
+PARITIES = {"N": serial.PARITY_NONE, "E": serial.PARITY_EVEN, "O": serial.PARITY_ODD}
+STOPBITS = {"1": serial.STOPBITS_ONE, "2": serial.STOPBITS_TWO}
+
+
+def parseSerialMode(mode):
+    """ Parses a mode like "115200 8N1" (DSMR 4 and 5) or "9600 7E1" (DSMR 2.2) """
+    try:
+        baudrate, frame = mode.split()
+        return int(baudrate), BYTESIZES[frame[0]], PARITIES[frame[1].upper()], STOPBITS[frame[2:]]
+    except (ValueError, KeyError, IndexError):
+        raise ValueError("Invalid serial mode %r, expected e.g. '115200 8N1'" % mode)
+
 
 class p1Interface():
     """p1Interface class: handling the serial interface and such"""
-    def __init__ (self):
-        self.serial_connection = self.getSerialConnection()
+    def __init__ (self, port="/dev/ttyUSB0", meter=None, mode=SERIAL_MODE, xonxoff=False):
         self.tz =  pytz.timezone("Europe/Amsterdam")
+        self.parser = telegramParser(self.tz)
+        # None is the default meter, whose documents are stored without a meter id
+        self.meter = meter
+        self.port = port
+        self.serial_connection = None
+        if port is None:
+            # Only parsing, e.g. when replaying a capture
+            return
+        self.serial_connection = self.getSerialConnection(port, mode, xonxoff)
         try:
             self.serial_connection.open()
         except Exception:
             logging.exception("Exception on opening serial connection!");
             sys.exit ("No serial connection - I quit!")
+        self.telegramReader = serialTelegramReader(self.serial_connection)
+
+    def close(self):
+        if self.serial_connection is not None:
+            self.serial_connection.close()
 
-    def getSerialConnection(self):
+    def getSerialConnection(self, port, mode=SERIAL_MODE, xonxoff=False):
         ser = serial.Serial()
-        ser.baudrate = 115200
-        ser.bytesize=serial.SEVENBITS
-        ser.parity=serial.PARITY_EVEN
-        ser.stopbits=serial.STOPBITS_ONE
-        ser.xonxoff=0
+        ser.baudrate, ser.bytesize, ser.parity, ser.stopbits = parseSerialMode(mode)
+        ser.xonxoff=int(xonxoff)
         ser.rtscts=0
         ser.timeout=20
-        ser.port="/dev/ttyUSB0"
+        ser.port=port
         return ser
-        
+
+    def getTelegram(self):
+        """ Will block until a full telegram is received from the serial interface!
+            Returns None if nothing was received in time. """
+        telegram = None
+        try:
+            telegram = self.telegramReader.readTelegram()
+        except Exception:
+            logging.exception("Exception on retrieving data from serial interface!"
+                             + " Trying to continue")
+            sleep(1)
+        return telegram
+
     def getReading(self):
-        """ Will block until a full reading is received from the serial interface!
-            If the reading is incomplete (e.g. partial data from the serial interface), 
-            it will return None """
-        self.reading = reading()
-        data_left = 1;
-        telegram = "";
-        while (data_left > 0):
-            try:
-                p1_raw = self.serial_connection.readline()
-                telegram += str(p1_raw) 
-                self.processLine(str(p1_raw))
-            except Exception:
-                logging.exception("Exception on retrieving data from serial interface!"
-                                 + " Trying to continue")
-            # Sleep for just a moment, otherwise data_left will always just be 0
-            sleep(0.1)
-            data_left = self.serial_connection.inWaiting()
+        """ Will block until a full telegram is received from the serial interface!
+            If the telegram does not hold a complete reading (or nothing was received 
+            in time), it will return None """
+        telegram = self.getTelegram()
+        if telegram is None:
+            return None
+        return self.parseTelegram(telegram)
+
+    def parseTelegram(self, telegram):
+        """ Returns the reading in the telegram, or None if it is incomplete """
+        t0 = perf_counter()
+        try:
+            self.reading = reading.fromDict(self.parser.parse(telegram))
+        except Exception:
+            logging.exception("Exception on processing telegram! Trying to continue")
+            stats.count("telegrams_rejected")
+            return None
+        stats.observe("parse", perf_counter() - t0)
         
-        # When we get here, there is no more data left. Check if the reading we have is
-        # complete. If so, return it!
+        # Check if the reading we have is complete. If so, return it!
         if self.reading.isComplete():
-            logging.debug("Received a reading at " , self.reading.timestamp)
-            logging.debug("usage: ", self.reading.consumption)
-            logging.debug("t1: ", self.reading.t1)
-            logging.debug("t2: ", self.reading.t2)
-            self.send_telegram(telegram, 'http://dsmr.blindwatchmaker.nl/api/v1/datalogger/dsmrreading','WO2EV8TNYEP94O8DNDYMQXWQB0FR477IUMS4T1KJ1Y841JBLZ47R7SWZA1FKBS6C')
+            logging.debug("Received a reading at %s: usage %s, t1 %s, t2 %s", self.reading.timestamp,
+                          self.reading.consumption, self.reading.t1, self.reading.t2)
             return self.reading;
         else:
             logging.warning("Ignoring invalid reading!")
+            stats.count("telegrams_rejected")
         return None
-        
-
-    def send_telegram(self, telegram, api_url, api_key):
-        # Register telegram by simply sending it to the application with a POST request.
-        response = requests.post(
-            api_url,
-            headers={'X-AUTHKEY': api_key},
-            data={'telegram': telegram},
-        )
-
-        # Old versions of DSMR-reader return 200, new ones 201.
-        if response.status_code not in (200, 201):
-            # Or you will find the error (hint) in the reponse body on failure.
-            print('API error: {}'.format(response.text))
-        
-    def processLine(self, line):
-        # The serial interface seems to be adding NULL characters sometimes...
-        line=line.replace("\x00", "")
-        if "0-0:1.0.0" in line:
-            i_start = line.index('(')
-            i_end = line.index(')')
-            if (line.find('W') > -1):
-               i_end = line.index('W')
-            try:
-               date = datetime.strptime( line[i_start+1:i_end], '%y%m%d%H%M%SS')
-            except ValueError:
-              date = datetime.strptime( line[i_start+1:i_end], '%y%m%d%H%M%S')
-            self.reading.timestamp = self.tz.localize(date).astimezone(pytz.utc)
-        elif "1-0:1.7.0" in line:
-            i_start = line.index('(')
-            i_end = line.index('*')
-            self.reading.consumption = float(line[i_start+1:i_end])
-        elif "1-0:1.8.1" in line:
-            i_start = line.index('(')
-            i_end = line.index('*')
-            self.reading.t1 = float(line[i_start+1:i_end])
-        elif "1-0:1.8.2" in line:
-            i_start = line.index('(')
-            i_end = line.index('*')
-            self.reading.t2 = float(line[i_start+1:i_end])
-        #elif "kWh" in line:
-        #    print "ignoring: ", line
 
 
 class powermon():
-    """ Powermon will request readings from the p1 interface, and process them """
-    def __init__ (self):
-        self.persistence = mongoPersistence()
-        self.p1 = p1Interface()
+    """ Powermon will request readings from the p1 interface, and process them.
+
+        More meters can be read by the same process: p1 is the primary meter, and
+        meters the others. They share the persistence, while every meter has its own
+        parser and rollup state. Only the primary meter is forwarded and kept in
+        memory, as DSMR-reader handles a single meter.
+
+        Every telegram is parsed once, and then handed to the sinks (see sinks.py):
+        the persistence, the recent readings and the forwarder, plus the extra
+        sinks given, such as a second database or an archive. With a downsampler only
+        the readings it picks are stored; the rollup, the recent readings and the
+        forwarder still get all of them.
+
+        Parsing and the rollup of every database run on the reader's thread, for
+        every telegram: they take some tens of microseconds, and the rollup only
+        queues its writes (or appends them to the write-ahead log), so the reader
+        keeps up with the meter whatever the database does. With a queue size
+        every sink runs on a thread of its own, behind a queue that may drop
+        telegrams; see pipeline.py. """
+    def __init__ (self, p1=None, persistence=None, forwarder=None, recent=None, meters=(), downsampler=None,
+                  queueSize=0, overload="drop-oldest", sinks=()):
+        self.persistence = persistence if persistence is not None else createPersistence()
+        self.p1 = p1 if p1 is not None else p1Interface()
+        self.meters = [self.p1] + list(meters)
+        ids = [meter.meter for meter in self.meters]
+        if len(set(ids)) != len(ids):
+            raise ValueError("Every meter needs a different id, got %s" % ids)
+        self.forwarder = forwarder
+        # The last hours of readings in memory, for questions about recent usage
+        self.recent = recent
+        self.downsampler = downsampler
+        self.sinks = [persistenceSink(self.persistence, downsampler)]
+        if recent is not None:
+            self.sinks.append(recentSink(recent, [self.p1.meter]))
+        if forwarder is not None:
+            self.sinks.append(forwardSink(forwarder, [self.p1.meter]))
+        self.sinks.extend(sinks)
+        # The rollups run before the sink queues, which may drop telegrams
+        self.rollups = [sink for sink in self.sinks if isinstance(sink, persistenceSink)]
+        self.workers = [sinkWorker(sink, queueSize, overload) for sink in self.sinks] if queueSize else []
+        self.telegrams = 0
+        self.readings = 0
     
     def start(self):
-        while True:
-            reading = self.p1.getReading()
-            if reading is not None:
-               self.persistence.storeReading(reading)
-               self.persistence.updateMetrics(reading)
-               
-instance = powermon()
-instance.start()
+        try:
+            if len(self.meters) == 1:
+                while True:
+                    telegram = self.p1.getTelegram()
+                    if telegram is not None:
+                        self.handle(telegram, self.p1)
+            else:
+                self.readMeters()
+        finally:
+            self.close()
+
+    def readMeters(self):
+        """ Reads all meters from this thread, taking telegrams from whichever is ready """
+        meters = {p1.meter: p1 for p1 in self.meters}
+        reader = multiTelegramReader({meter: p1.telegramReader for meter, p1 in meters.items()})
+        nextCheck = monotonic() + reader.timeout
+        try:
+            while True:
+                try:
+                    item = reader.readTelegram()
+                except Exception:
+                    logging.exception("Exception on retrieving data from the serial interfaces!"
+                                      + " Trying to continue")
+                    sleep(1)
+                    continue
+                if item is not None:
+                    meter, telegram = item
+                    self.handle(telegram, meters[meter])
+                if monotonic() >= nextCheck:
+                    silent = reader.silent()
+                    if silent:
+                        logging.warning("No telegrams from meter(s) %s for %d s", ", ".join(map(str, silent)),
+                                        reader.timeout)
+                    nextCheck = monotonic() + reader.timeout
+        finally:
+            reader.close()
+
+    def handle(self, telegram, p1):
+        """ Processes a telegram the reader got """
+        self.process(telegram, p1, time())
+
+    def process(self, telegram, p1=None, received=None):
+        """ Parses a telegram, and hands it with its reading to the sinks of its meter """
+        p1 = p1 if p1 is not None else self.p1
+        received = received if received is not None else time()
+        self.telegrams += 1
+        reading = p1.parseTelegram(telegram)
+        if reading is not None:
+            self.readings += 1
+            for sink in self.rollups:
+                if sink.accepts(p1.meter):
+                    sink.rollup(p1.meter, reading)
+        for sink in self.workers or self.sinks:
+            if sink.accepts(p1.meter):
+                sink.write(p1.meter, received, telegram, reading)
+        return reading
+
+    def close(self):
+        for p1 in self.meters:
+            p1.close()
+        # The persistence goes last, as other sinks may still write to it
+        if self.workers:
+            for worker in reversed(self.workers):
+                worker.close()
+            return
+        for sink in reversed(self.sinks):
+            try:
+                sink.close()
+            except Exception:
+                logging.exception("Error on closing the %s sink!", sink.name)
+
+
+def createBackend(args, backend, primary):
+    """ The persistence for a --backend; only the primary one keeps a checkpoint and a
+        write-ahead log, as those are per process """
+    # A replay would overwrite the state of the live meter, and share its log
+    live = primary and not args.replay
+    checkpoint = rollupCheckpoint(args.checkpoint) if args.checkpoint and live else None
+    if backend == 'mongo':
+        return createPersistence('mongo', url=args.mongo_url, dbName=args.db, checkpoint=checkpoint,
+                                 walDir=args.wal if live else None, maxPending=args.write_queue,
+                                 overload=args.overload)
+    if backend == 'sqlite':
+        return createPersistence('sqlite', path=args.sqlite_path, checkpoint=checkpoint,
+                                 maxPending=args.write_queue, overload=args.overload)
+    return createPersistence(backend)
+
+
+def backendList(value):
+    backends = [backend.strip() for backend in value.split(',') if backend.strip()]
+    for backend in backends:
+        if backend not in BACKENDS:
+            raise argparse.ArgumentTypeError("unknown backend %r, expected some of %s" % (backend, ", ".join(BACKENDS)))
+    if not backends:
+        raise argparse.ArgumentTypeError("no backend given")
+    return backends
+
+
+def terminate(signum, frame):
+    """ Turns SIGTERM into a normal exit, so the sinks are closed and flushed """
+    logging.info("Terminated, shutting down")
+    sys.exit(0)
+
+
+def main():
+    # The configuration gives the defaults for the command line
+    preparser = argparse.ArgumentParser(add_help=False)
+    preparser.add_argument('--config', metavar='FILE')
+    config = loadConfig(preparser.parse_known_args()[0].config)
+
+    argparser = argparse.ArgumentParser(description="Reads the P1 interface, and feeds the readings and telegrams"
+                                        + " to the configured sinks", parents=[preparser])
+    argparser.add_argument('--port', help="serial port of the meter")
+    argparser.add_argument('--serial', metavar='MODE', help="serial settings, e.g. '115200 8N1' (DSMR 4 and 5) or"
+                           + " '9600 7E1' (DSMR 2.2)")
+    argparser.add_argument('--xonxoff', action='store_true', help="use software flow control")
+    argparser.add_argument('--meter', action='append', metavar='[ID=]PORT',
+                           help="read this meter (repeat for more meters, instead of --port); the"
+                           + " readings are tagged with ID, or stored untagged if there is none. The"
+                           + " first meter is the one forwarded and recorded.")
+    argparser.add_argument('--backend', type=backendList, metavar='BACKEND[,BACKEND]',
+                           help="where to store the readings: some of %s; the first one answers the"
+                           % ", ".join(BACKENDS) + " HTTP queries")
+    argparser.add_argument('--mongo-url', help="defaults to $POWERMON_MONGO_URL")
+    argparser.add_argument('--db', help="name of the Mongo database")
+    argparser.add_argument('--sqlite-path', help="SQLite database file, defaults to $POWERMON_SQLITE_PATH"
+                           + " or ~/.powermon/powermon.db")
+    argparser.add_argument('--wal', metavar='DIR',
+                           help="write-ahead log for the Mongo writes, kept while Mongo is down (empty to disable)")
+    argparser.add_argument('--checkpoint', metavar='FILE',
+                           help="keep the rollup state in this file, for a fast restart (empty to disable)")
+    argparser.add_argument('--downsample', choices=DOWNSAMPLE_MODES,
+                           help="store only the readings needed to reconstruct the power within --deviation")
+    argparser.add_argument('--deviation', type=float,
+                           help="largest error in kW a downsampled power reading may have (default 0.025)")
+    argparser.add_argument('--max-gap', type=float,
+                           help="store a reading at least every this many seconds when downsampling")
+    argparser.add_argument('--queue-size', type=int,
+                           help="telegrams that may wait for each sink, which all run on threads of their own"
+                           + " (0: feed the sinks on the reader's thread); the rollup always gets every telegram")
+    argparser.add_argument('--write-queue', type=int,
+                           help="readings that may wait for the database")
+    argparser.add_argument('--overload', choices=OVERLOAD_POLICIES,
+                           help="what to drop from a full queue; metrics are never dropped")
+    argparser.add_argument('--record', metavar='FILE', help="record the raw telegrams to a capture file")
+    argparser.add_argument('--archive', metavar='DIR',
+                           help="keep every raw telegram in a compressed archive; other meters in DIR/ID")
+    argparser.add_argument('--replay', metavar='FILE|DIR',
+                           help="process a capture file or an archive instead of the serial port")
+    argparser.add_argument('--since', type=parseTime, help="replay an archive from this (ISO) time")
+    argparser.add_argument('--until', type=parseTime, help="replay an archive up to this (ISO) time")
+    argparser.add_argument('--speed', type=float, default=1.0,
+                           help="replay speed: 1 is real time, 10 is ten times as fast, 0 is as fast as possible")
+    argparser.add_argument('--recent-hours', type=float,
+                           help="hours of readings to keep in memory, 0 to keep none")
+    argparser.add_argument('--http-port', type=int, help="serve the live state and Prometheus metrics on this port")
+    argparser.add_argument('--http-host', help="address to serve on (default: all)")
+    argparser.add_argument('--stats-log', action='store_true', help="log the latency per stage periodically")
+    argparser.add_argument('--stats-json', metavar='FILE', help="write the latency per stage to a JSON file periodically")
+    argparser.add_argument('--stats-interval', type=float, help="seconds between stats reports")
+    argparser.add_argument('--no-forward', action='store_true', help="don't forward telegrams to DSMR-reader")
+    argparser.add_argument('--peaks', action='store_true',
+                           help="track the quarter-hour peaks of every month, for capacity tariffs")
+    argparser.add_argument('--peak-top', type=int, help="number of highest quarters to keep per month")
+    argparser.add_argument('--peak-threshold', type=float,
+                           help="warn when a quarter heads for a new peak of at least this many kW")
+    argparser.set_defaults(**argumentDefaults(config))
+    args = argparser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+
+    forwarder = None
+    if not args.no_forward and args.servers:
+        forwarder = fanOutForwarder(args.servers, args.spool)
+    persistences = [createBackend(args, backend, i == 0) for i, backend in enumerate(args.backend)]
+
+    recent = readingRingBuffer(args.recent_hours) if args.recent_hours > 0 else None
+
+    def sampler():
+        return downsampler(args.downsample, args.deviation, args.max_gap) if args.downsample != 'off' else None
+
+    # Every further backend gets the same readings, through a sink of its own
+    sinks = [persistenceSink(persistence, sampler(), name="store-%d" % i)
+             for i, persistence in enumerate(persistences[1:], 1)]
+    if args.peaks:
+        sinks.append(peakSink(persistences[0], args.peak_top, args.peak_threshold, args.peak_warn_after))
+    definitions = [definition.rpartition('=') for definition in args.meter or args.config_meters or [args.port]]
+    if args.replay:
+        # A capture holds the telegrams of one meter, the first one
+        instance = powermon(p1Interface(None, meter=definitions[0][0] or None), persistences[0], forwarder, recent,
+                            downsampler=sampler(), sinks=sinks)
+    else:
+        meters = [p1Interface(port, meter or None, args.serial, args.xonxoff) for meter, _, port in definitions]
+        if args.record:
+            sinks.append(recordSink({meters[0].meter: captureWriter(args.record)}))
+        if args.archive:
+            sinks.append(recordSink({p1.meter: archiveWriter(os.path.join(args.archive, p1.meter) if p1.meter
+                                                             else args.archive, args.archive_chunk)
+                                     for p1 in meters}, "archive"))
+        instance = powermon(meters[0], persistences[0], forwarder, recent, meters[1:], sampler(),
+                            args.queue_size, args.overload, sinks)
+    status = statusServer(instance, args.http_port, args.http_host) if args.http_port else None
+    reporters = []
+    if args.stats_log:
+        reporters.append(logReporter())
+    if args.stats_json:
+        reporters.append(jsonReporter(args.stats_json))
+    if reporters or status is not None:
+        stats.enable()
+    reporter = periodicReporter(reporters, args.stats_interval) if reporters else None
+    signal.signal(signal.SIGTERM, terminate)
+
+    try:
+        if args.replay:
+            try:
+                if os.path.isdir(args.replay):
+                    records = telegramArchive(args.replay).read(args.since, args.until)
+                    replayTelegrams(instance, records, args.replay, args.speed)
+                else:
+                    replayCapture(instance, args.replay, args.speed)
+            finally:
+                instance.close()
+        else:
+            instance.start()
+    finally:
+        if reporter is not None:
+            reporter.close()
+        if status is not None:
+            status.close()
+
+
+if __name__ == '__main__':
+    main()
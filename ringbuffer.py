@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+"""
+    Recent readings, kept in memory
+
+    A fixed size ring buffer of the last hours of readings, stored column-wise in
+    NumPy arrays instead of as one Python object per reading. Readings arrive in
+    time order, so a time range is found with a binary search, and aggregates over
+    a window are computed on whole arrays at once.
+"""
+
+#    Copyright (C) 2016  Chris Brouwer
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import threading
+import warnings
+from datetime import datetime
+import numpy as np
+
+# The counters need double precision to keep their three decimals; kW, V and A fit
+# in single precision
+RING_FIELDS = (
+    ("t1", np.float64),
+    ("t2", np.float64),
+    ("consumption", np.float32),
+    ("production", np.float32),
+    ("power_l1", np.float32),
+    ("power_l2", np.float32),
+    ("power_l3", np.float32),
+    ("voltage_l1", np.float32),
+    ("voltage_l2", np.float32),
+    ("voltage_l3", np.float32),
+    ("current_l1", np.float32),
+    ("current_l2", np.float32),
+    ("current_l3", np.float32),
+)
+
+COUNTERS = ("t1", "t2")
+
+
+def epoch(value):
+    """ Accepts an aware datetime or epoch seconds """
+    return value.timestamp() if isinstance(value, datetime) else float(value)
+
+
+class readingRingBuffer():
+    """ Holds the last capacity readings (by default 24 hours at one per second).
+        Missing values are stored as NaN. Appending is done by the pipeline thread,
+        reading by anyone; every query returns copies, taken under a lock. """
+    def __init__ (self, hours=24, rate=1.0):
+        self.capacity = max(1, int(hours * 3600 * rate))
+        self.ts = np.zeros(self.capacity, dtype=np.float64)
+        self.columns = {name: np.full(self.capacity, np.nan, dtype=dtype) for name, dtype in RING_FIELDS}
+        self.head = 0
+        self.count = 0
+        self.outOfOrder = 0
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return self.count
+
+    def nbytes(self):
+        return self.ts.nbytes + sum(column.nbytes for column in self.columns.values())
+
+    def append(self, reading):
+        now = reading.timestamp.timestamp()
+        with self.lock:
+            if self.count and now <= self.ts[self.head - 1]:
+                # The binary search relies on time order; the meter clock stepping back
+                # is rare enough to just leave those readings out
+                self.outOfOrder += 1
+                return
+            i = self.head
+            self.ts[i] = now
+            for name, column in self.columns.items():
+                value = getattr(reading, name, None)
+                column[i] = np.nan if value is None else value
+            self.head = (i + 1) % self.capacity
+            if self.count < self.capacity:
+                self.count += 1
+
+    def segments(self):
+        """ The filled part as (oldest, newest) physical slices """
+        if self.count < self.capacity:
+            return slice(0, self.count), slice(0, 0)
+        return slice(self.head, self.capacity), slice(0, self.head)
+
+    def locate(self, ts, side="left"):
+        """ Binary search for ts over both segments; returns a logical index """
+        older, newer = self.segments()
+        i = int(np.searchsorted(self.ts[older], ts, side=side))
+        if i < older.stop - older.start:
+            return i
+        return i + int(np.searchsorted(self.ts[newer], ts, side=side))
+
+    def physical(self, first, last):
+        """ Physical indices of the logical range [first, last) """
+        oldest = 0 if self.count < self.capacity else self.head
+        return (np.arange(first, last) + oldest) % self.capacity
+
+    def range(self, start=None, end=None, fields=None):
+        """ Returns the readings with start <= timestamp < end as a dict of arrays, with
+            the epoch timestamps under "ts" """
+        with self.lock:
+            first = 0 if start is None else self.locate(epoch(start))
+            last = self.count if end is None else self.locate(epoch(end))
+            index = self.physical(first, max(first, last))
+            result = {"ts": self.ts[index]}
+            for name in fields if fields is not None else self.columns:
+                result[name] = self.columns[name][index]
+        return result
+
+    def newest(self):
+        """ Epoch timestamp of the newest reading, or None """
+        with self.lock:
+            return float(self.ts[self.head - 1]) if self.count else None
+
+    def last(self, seconds, fields=None):
+        """ Returns the readings of the last seconds, counting back from the newest one """
+        newest = self.newest()
+        return self.range(None if newest is None else newest - seconds, None, fields)
+
+    def aggregate(self, start=None, end=None, fields=None):
+        """ Returns count, first and last timestamp, min/max/mean per field, and the
+            consumption according to the counters over [start, end) """
+        window = self.range(start, end, fields)
+        ts = window.pop("ts")
+        result = {"count": len(ts),
+                  "start": float(ts[0]) if len(ts) else None,
+                  "end": float(ts[-1]) if len(ts) else None}
+        with warnings.catch_warnings():
+            # Fields a meter doesn't report are all NaN
+            warnings.simplefilter("ignore", RuntimeWarning)
+            for name, values in window.items():
+                if not len(values) or np.isnan(values).all():
+                    result[name] = None
+                    continue
+                result[name] = {"min": float(np.nanmin(values)),
+                                "max": float(np.nanmax(values)),
+                                "mean": float(np.nanmean(values))}
+                if name in COUNTERS:
+                    result[name]["delta"] = round(float(np.nanmax(values) - np.nanmin(values)), 5)
+        return result
+
+    def window(self, seconds, fields=None):
+        """ aggregate() over the last seconds """
+        newest = self.newest()
+        return self.aggregate(None if newest is None else newest - seconds, None, fields)
+
+    def resample(self, start, end, step, field="consumption"):
+        """ Averages field over buckets of step seconds in [start, end). Returns the
+            bucket starts and the means (NaN for empty buckets). """
+        start = epoch(start)
+        end = epoch(end)
+        window = self.range(start, end, [field])
+        buckets = int(np.ceil((end - start) / step))
+        index = ((window["ts"] - start) // step).astype(np.int64)
+        values = window[field].astype(np.float64)
+        present = ~np.isnan(values)
+        sums = np.bincount(index[present], weights=values[present], minlength=buckets)
+        counts = np.bincount(index[present], minlength=buckets)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            means = sums / counts
+        return start + step * np.arange(buckets), means
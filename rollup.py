@@ -0,0 +1,232 @@
+#!/usr/bin/env python
+"""
+    Incremental rollup of readings into consumption metrics per interval
+"""
+
+#    Copyright (C) 2016  Chris Brouwer
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from datetime import datetime
+from datetime import timedelta
+import pytz
+from helpers import reading
+
+# name, collection, unit, step. The 5 minute metrics have always lived in
+# metrics.minute, so that collection keeps its name.
+INTERVALS = (
+    ("1m", "metrics.1m", "minute", 1),
+    ("5m", "metrics.minute", "minute", 5),
+    ("15m", "metrics.15m", "minute", 15),
+    ("1h", "metrics.hour", "hour", 1),
+    ("1d", "metrics.day", "day", 1),
+    ("1M", "metrics.month", "month", 1),
+)
+
+UNIT_SECONDS = {"minute": 60, "hour": 3600}
+
+
+class interval():
+    """ Knows where the buckets of one interval start, in local time """
+    def __init__ (self, name, collection, unit, step, tz):
+        self.name = name
+        self.collection = collection
+        self.unit = unit
+        self.step = step
+        self.tz = tz
+
+    def floor(self, ts):
+        """ Returns the start of the bucket holding ts (an aware datetime), as epoch seconds """
+        if self.unit in UNIT_SECONDS:
+            # Europe/Amsterdam is a whole number of hours away from UTC, so minute and hour
+            # buckets line up with UTC and DST doesn't matter
+            seconds = UNIT_SECONDS[self.unit] * self.step
+            epoch = ts.timestamp()
+            return epoch - epoch % seconds
+        local = ts.astimezone(self.tz)
+        if self.unit == "day":
+            start = datetime(local.year, local.month, local.day)
+        else:
+            start = datetime(local.year, local.month, 1)
+        return self.tz.localize(start).timestamp()
+
+    def next(self, start):
+        """ Returns the start of the bucket after the one starting at start (epoch seconds) """
+        if self.unit in UNIT_SECONDS:
+            return start + UNIT_SECONDS[self.unit] * self.step
+        local = datetime.fromtimestamp(start, self.tz)
+        if self.unit == "day":
+            # Days are 23 or 25 hours long around a DST transition
+            nextLocal = datetime(local.year, local.month, local.day) + timedelta(days=self.step)
+        else:
+            month = local.month - 1 + self.step
+            nextLocal = datetime(local.year + month // 12, month % 12 + 1, 1)
+        return self.tz.localize(nextLocal).timestamp()
+
+
+class bucketState():
+    """ The open bucket of an interval: when it started, the counters at that moment,
+        and when the next one starts. A partial bucket started before the engine did:
+        its counters are those of a reading somewhere inside it. """
+    __slots__ = ("interval", "start", "next", "t1", "t2", "partial")
+
+    def __init__ (self, interval):
+        self.interval = interval
+        self.start = None
+        self.next = float("-inf")
+        self.t1 = None
+        self.t2 = None
+        self.partial = False
+
+
+class rollupEngine():
+    """ Rolls readings up into buckets for a table of intervals.
+
+        For every interval the start of the next bucket is precomputed, so a reading
+        costs one comparison per interval. When a reading crosses a boundary, a
+        document is produced for the bucket that just started, carrying the counters
+        and the consumption since the previous boundary. Documents are keyed on ts, so
+        writing them as upserts makes a restart harmless.
+
+        No document is produced for a bucket whose start the engine didn't see and
+        wasn't seeded for: the first reading after startup may be anywhere in its
+        buckets, and the database (or the write-ahead log) may already hold the real
+        documents for them. A seeded bucket rolls as usual, from its seed counters. """
+    def __init__ (self, intervals=INTERVALS, tz=None):
+        self.tz = tz if tz is not None else pytz.timezone("Europe/Amsterdam")
+        self.intervals = [interval(*definition, tz=self.tz) for definition in intervals]
+        self.states = [bucketState(i) for i in self.intervals]
+        self.last = None
+
+    def seed(self, collection, timestamp, t1, t2):
+        """ Restores the open bucket of an interval, from the last document written for it """
+        for state in self.states:
+            if state.interval.collection == collection:
+                state.start = state.interval.floor(timestamp)
+                state.next = state.interval.next(state.start)
+                state.t1 = t1
+                state.t2 = t2
+                state.partial = False
+
+    def seedIfNewer(self, collection, timestamp, t1, t2):
+        """ Seeds an interval, unless its open bucket started at or after timestamp's
+            bucket already, with the counters at its start. Returns whether it did. """
+        for state in self.states:
+            if state.interval.collection == collection:
+                start = state.interval.floor(timestamp)
+                if state.start is not None and (start < state.start or (start == state.start and not state.partial)):
+                    return False
+                self.seed(collection, timestamp, t1, t2)
+                return True
+        return False
+
+    def state(self):
+        """ The open buckets and the last reading, as plain values to checkpoint """
+        last = self.last
+        return {"last": None if last is None else [last.timestamp.timestamp(), last.t1, last.t2],
+                "buckets": {state.interval.collection: [state.start, state.t1, state.t2, state.partial]
+                            for state in self.states if state.start is not None}}
+
+    def restore(self, saved):
+        """ Restores what state() returned """
+        for state in self.states:
+            bucket = saved["buckets"].get(state.interval.collection)
+            if bucket is not None:
+                state.start, state.t1, state.t2 = bucket[:3]
+                state.partial = len(bucket) > 3 and bucket[3]
+                state.next = state.interval.next(state.start)
+        if saved.get("last") is not None:
+            ts, t1, t2 = saved["last"]
+            self.last = reading(timestamp=datetime.fromtimestamp(ts, pytz.utc), t1=t1, t2=t2)
+
+    def countersAt(self, ts):
+        """ The counters at ts (epoch seconds) as far as the engine knows them: at the
+            start of an open bucket, or at or after the last reading. None otherwise. """
+        last = self.last
+        if last is not None and ts >= last.timestamp.timestamp():
+            return last
+        for state in self.states:
+            if state.start == ts and not state.partial:
+                return reading(timestamp=datetime.fromtimestamp(ts, pytz.utc), t1=state.t1, t2=state.t2)
+        return None
+
+    def update(self, reading):
+        """ Processes a reading, and returns the (collection, document) pairs to upsert """
+        previous = self.last
+        self.last = reading
+        now = reading.timestamp.timestamp()
+        documents = []
+        for state in self.states:
+            if now < state.next:
+                continue
+            document = self.roll(state, reading, previous)
+            if document is not None:
+                documents.append((state.interval.collection, document))
+        return documents
+
+    def roll(self, state, reading, previous):
+        start = state.interval.floor(reading.timestamp)
+        unseen = previous is None or previous.timestamp.timestamp() >= start
+        if unseen and (state.start is None or state.partial):
+            # The first reading since startup, and nothing was seeded: it only tells the
+            # counters somewhere in its bucket, so it doesn't get a document
+            state.start = start
+            state.next = state.interval.next(start)
+            state.t1 = reading.t1
+            state.t2 = reading.t2
+            state.partial = True
+            return None
+        if state.start is None or start > state.next or state.partial:
+            # First bucket ever, or we missed at least one whole bucket, or didn't see
+            # the start of the last one. To prevent weird deltas, we don't attribute
+            # the consumption in between to this bucket.
+            delta_t1 = 0
+            delta_t2 = 0
+            delta_total = 0
+        else:
+            delta_t1 = round(reading.t1 - state.t1, 5)
+            delta_t2 = round(reading.t2 - state.t2, 5)
+            delta_total = round(delta_t1 + delta_t2, 5)
+        state.start = start
+        state.next = state.interval.next(start)
+        state.t1 = reading.t1
+        state.t2 = reading.t2
+        state.partial = False
+        return {"ts": datetime.fromtimestamp(start, pytz.utc),
+                "t1": reading.t1,
+                "t2": reading.t2,
+                "d_t1": delta_t1,
+                "d_t2": delta_t2,
+                "d_total": delta_total}
+
+    def openBuckets(self):
+        """ Returns the buckets currently being filled, with the consumption so far """
+        buckets = []
+        last = self.last
+        for state in self.states:
+            if state.start is None:
+                continue
+            bucket = {"interval": state.interval.name,
+                      "collection": state.interval.collection,
+                      "start": datetime.fromtimestamp(state.start, pytz.utc),
+                      "end": datetime.fromtimestamp(state.next, pytz.utc),
+                      "t1": state.t1,
+                      "t2": state.t2,
+                      "partial": state.partial}
+            if last is not None:
+                bucket["d_t1"] = round(last.t1 - state.t1, 5)
+                bucket["d_t2"] = round(last.t2 - state.t2, 5)
+                bucket["d_total"] = round(bucket["d_t1"] + bucket["d_t2"], 5)
+            buckets.append(bucket)
+        return buckets
@@ -0,0 +1,460 @@
+#!/usr/bin/env python
+"""
+    A simulated P1 port, for load and scale testing
+
+    Every simulated meter is a household: a base load with a morning and an evening
+    peak, appliances that switch on at random, more use in winter, optionally solar
+    panels, and a gas meter that heats in winter. The counters only go up, the
+    tariff switches at 07:00 and 23:00 on weekdays (low all weekend), and the
+    timestamps follow Europe/Amsterdam, DST transitions included. Telegrams are
+    formatted as the meters of each DSMR version send them:
+
+        2.2  every 10 s, no CRC, gas on a continuation line; as a real DSMR 2.2
+             telegram has no time at all, the simulator adds 0-0:1.0.0 without the
+             summer/winter flag, as DSMR 3 meters do
+        4    every 10 s, CRC, gas every hour
+        5    every second, CRC, gas every 5 minutes, voltages
+
+    serve     writes the telegrams to pseudo-terminals that powermon can open like
+              a serial port (symlinked as DIR/ttyUSB0, DIR/ttyUSB1, ...), in real
+              time or --speed times as fast
+    history   generates a time range as fast as it can: the telegrams to capture
+              files (for --replay), or the readings and metrics straight into a
+              database, to benchmark rollups, backfills and queries at scale
+
+        python simulator.py serve --meters 3 --version 4
+        python powermon.py --serial '115200 8N1' --meter a=/tmp/powermon-sim/ttyUSB0 ...
+        python simulator.py history --start 2023-01-01 --end 2026-01-01 --backend sqlite --sqlite-path /tmp/sim.db
+"""
+
+#    Copyright (C) 2016  Chris Brouwer
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import argparse
+import heapq
+import logging
+import math
+import os
+import random
+import time
+import tty
+from datetime import datetime
+import pytz
+from capture import captureWriter
+from framer import crc16
+from helpers import parseTime
+from helpers import reading
+from persistence import BACKENDS
+from persistence import MONGO_URL
+from persistence import createPersistence
+from sqlitepersistence import SQLITE_PATH
+
+PTY_DIR = '/tmp/powermon-sim'
+
+# Seconds between telegrams, seconds between gas readings, and the serial settings
+# powermon needs for them (see --serial)
+VERSIONS = {
+    "2.2": {"interval": 10, "gasInterval": 3600, "serial": "9600 7E1"},
+    "4": {"interval": 10, "gasInterval": 3600, "serial": "115200 8N1"},
+    "5": {"interval": 1, "gasInterval": 300, "serial": "115200 8N1"},
+}
+
+# Appliances that switch on at random: (kW, seconds on, starts per hour)
+APPLIANCES = (
+    (2.0, 180, 0.6),     # kettle
+    (1.1, 240, 0.4),     # microwave
+    (2.2, 2400, 0.08),   # oven
+    (1.9, 5400, 0.05),   # washing machine
+    (1.6, 6000, 0.04),   # dishwasher
+    (2.5, 3600, 0.03),   # dryer
+)
+
+HEADERS = {
+    "2.2": b'/KMP5 KA6U%09d',
+    "4": b'/KFM5KAIFA-METER',
+    "5": b'/ISK5\\2M550T-1012',
+}
+
+
+def bump(hour, centre, width):
+    return math.exp(-((hour - centre) / width) ** 2)
+
+
+def equipmentId(serial):
+    return "".join("%02X" % ord(c) for c in serial).encode()
+
+
+class simulatedMeter():
+    """ One household and its meter. step() advances the clock by the interval and
+        returns the values the meter shows then, rounded as the telegram has them;
+        telegram() formats them. """
+    def __init__ (self, version="5", start=None, interval=None, seed=0, solar=0.0, tz=None):
+        if version not in VERSIONS:
+            raise ValueError("Unknown DSMR version %r, expected one of %s" % (version, ", ".join(VERSIONS)))
+        self.version = version
+        self.interval = interval or VERSIONS[version]["interval"]
+        self.gasInterval = VERSIONS[version]["gasInterval"]
+        self.tz = tz if tz is not None else pytz.timezone("Europe/Amsterdam")
+        self.rng = random.Random(seed)
+        start = start if start is not None else time.time()
+        self.ts = float(int(start) - int(start) % self.interval)
+        self.solar = solar
+
+        rng = self.rng
+        self.serial = "E00%013d" % rng.randrange(10 ** 13)
+        self.gasSerial = "G00%013d" % rng.randrange(10 ** 13)
+        self.t1 = rng.uniform(1000, 20000)
+        self.t2 = rng.uniform(1000, 20000)
+        self.t1Return = 0.0
+        self.t2Return = 0.0
+        self.gas = rng.uniform(500, 8000)
+        self.baseLoad = rng.uniform(0.08, 0.25)
+        self.scale = rng.uniform(0.6, 1.6)
+        self.heating = rng.uniform(0.1, 0.5)
+        self.running = []
+        self.clouds = 1.0
+        self.offsets = {}
+        self.gasTs = None
+        self.gasTimestamp = None
+        self.gasShown = self.gas
+
+    def local(self, ts):
+        """ Local time as epoch seconds; the UTC offset only changes on the hour """
+        hour = int(ts // 3600)
+        offset = self.offsets.get(hour)
+        if offset is None:
+            if len(self.offsets) > 1000:
+                self.offsets.clear()
+            moment = datetime.fromtimestamp(hour * 3600, self.tz)
+            offset = self.offsets[hour] = (moment.utcoffset().total_seconds(), bool(moment.dst()))
+        return ts + offset[0], offset[1]
+
+    def tariff(self, local):
+        weekday = (int(local // 86400) + 3) % 7
+        hour = local % 86400 / 3600
+        return 2 if weekday < 5 and 7 <= hour < 23 else 1
+
+    def load(self, ts, local):
+        """ The power the household draws, in kW """
+        hour = local % 86400 / 3600
+        winter = math.cos(2 * math.pi * ((local / 86400) % 365.25 - 15) / 365.25)
+        morning = bump(hour, 7.5, 1.0)
+        evening = bump(hour, 19.5, 2.5)
+        activity = 0.2 + morning + 1.5 * evening
+        rng = self.rng
+        for kw, duration, perHour in APPLIANCES:
+            if rng.random() < perHour * activity * self.interval / 3600:
+                self.running.append((ts + duration * rng.uniform(0.5, 1.5), kw * rng.uniform(0.8, 1.2)))
+        self.running = [appliance for appliance in self.running if appliance[0] > ts]
+        power = self.baseLoad * (1 + 0.3 * winter)
+        power += self.scale * (0.1 * morning + 0.4 * evening) * (1 + 0.3 * winter)
+        power += sum(kw for end, kw in self.running)
+        return max(0.0, power + rng.gauss(0, 0.005))
+
+    def pv(self, local):
+        """ What the solar panels deliver, in kW """
+        if not self.solar:
+            return 0.0
+        day = (local / 86400) % 365.25
+        hour = local % 86400 / 3600
+        length = 12 + 4 * math.cos(2 * math.pi * (day - 172) / 365.25)
+        sun = math.sin(math.pi * (hour - (13.5 - length / 2)) / length)
+        self.clouds = min(1.0, max(0.1, self.clouds + self.rng.gauss(0, 0.02)))
+        return max(0.0, self.solar * 0.8 * sun * self.clouds * (0.6 + 0.4 * math.cos(2 * math.pi * (day - 172) / 365.25)))
+
+    def step(self):
+        self.ts += self.interval
+        ts = self.ts
+        local, summer = self.local(ts)
+        tariff = self.tariff(local)
+        net = self.load(ts, local) - self.pv(local)
+        consumption = max(net, 0.0)
+        production = max(-net, 0.0)
+        hours = self.interval / 3600
+        if tariff == 1:
+            self.t1 += consumption * hours
+            self.t1Return += production * hours
+        else:
+            self.t2 += consumption * hours
+            self.t2Return += production * hours
+
+        winter = math.cos(2 * math.pi * ((local / 86400) % 365.25 - 15) / 365.25)
+        self.gas += (0.01 + self.heating * max(0.0, winter + 0.2)) * hours * self.rng.uniform(0.5, 1.5)
+        gasTs = ts - ts % self.gasInterval
+        if gasTs != self.gasTs:
+            self.gasTs = gasTs
+            self.gasTimestamp = datetime.fromtimestamp(gasTs, pytz.utc)
+            self.gasShown = self.gas
+
+        timestamp = datetime.fromtimestamp(ts, pytz.utc)
+        values = {"timestamp": timestamp,
+                  "tariff": tariff,
+                  "t1": round(self.t1, 3),
+                  "t2": round(self.t2, 3),
+                  "t1_return": round(self.t1Return, 3),
+                  "t2_return": round(self.t2Return, 3),
+                  "gas": round(self.gasShown, 3),
+                  "gas_timestamp": self.gasTimestamp,
+                  # Only used to format the telegram
+                  "local": local,
+                  "summer": summer}
+        if self.version == "2.2":
+            values["consumption"] = round(consumption, 2)
+            values["production"] = round(production, 2)
+            return values
+        values["consumption"] = round(consumption, 3)
+        values["production"] = round(production, 3)
+        # Most houses have one phase doing most of the work
+        voltages = [round(self.rng.gauss(230, 1.5), 1) for _ in range(3)]
+        for phase, share, voltage in zip((1, 2, 3), (0.55, 0.3, 0.15), voltages):
+            values["power_l%d" % phase] = round(consumption * share, 3)
+            values["return_l%d" % phase] = round(production * share, 3)
+            values["current_l%d" % phase] = int(round((consumption + production) * share * 1000 / voltage))
+            if self.version == "5":
+                values["voltage_l%d" % phase] = voltage
+        return values
+
+    def reading(self, values):
+        return reading.fromDict(values)
+
+    def timestamp(self, local, summer):
+        flag = "" if self.version == "2.2" else ("S" if summer else "W")
+        return (time.strftime("%y%m%d%H%M%S", time.gmtime(local)) + flag).encode()
+
+    def telegram(self, values):
+        local, summer = values["local"], values["summer"]
+        gasLocal, gasSummer = self.local(values["gas_timestamp"].timestamp())
+        if self.version == "2.2":
+            lines = [HEADERS["2.2"] % (int(self.serial[3:]) % 10 ** 9), b'',
+                     b'0-0:1.0.0(%s)' % self.timestamp(local, summer),
+                     b'0-0:96.1.1(%s)' % equipmentId(self.serial),
+                     b'1-0:1.8.1(%09.3f*kWh)' % values["t1"],
+                     b'1-0:1.8.2(%09.3f*kWh)' % values["t2"],
+                     b'1-0:2.8.1(%09.3f*kWh)' % values["t1_return"],
+                     b'1-0:2.8.2(%09.3f*kWh)' % values["t2_return"],
+                     b'0-0:96.14.0(%04d)' % values["tariff"],
+                     b'1-0:1.7.0(%07.2f*kW)' % values["consumption"],
+                     b'1-0:2.7.0(%07.2f*kW)' % values["production"],
+                     b'0-0:17.0.0(999*A)',
+                     b'0-0:96.3.10(1)',
+                     b'0-0:96.13.1()',
+                     b'0-0:96.13.0()',
+                     b'0-1:24.1.0(3)',
+                     b'0-1:96.1.0(%s)' % equipmentId(self.gasSerial),
+                     b'0-1:24.3.0(%s)(00)(60)(1)(0-1:24.2.1)(m3)' % self.timestamp(gasLocal, gasSummer),
+                     b'(%09.3f)' % values["gas"],
+                     b'0-1:24.4.0(1)',
+                     b'!']
+            return b'\r\n'.join(lines) + b'\r\n'
+
+        lines = [HEADERS[self.version], b'',
+                 b'1-3:0.2.8(%s)' % (b'50' if self.version == "5" else b'42'),
+                 b'0-0:1.0.0(%s)' % self.timestamp(local, summer),
+                 b'0-0:96.1.1(%s)' % equipmentId(self.serial),
+                 b'1-0:1.8.1(%010.3f*kWh)' % values["t1"],
+                 b'1-0:1.8.2(%010.3f*kWh)' % values["t2"],
+                 b'1-0:2.8.1(%010.3f*kWh)' % values["t1_return"],
+                 b'1-0:2.8.2(%010.3f*kWh)' % values["t2_return"],
+                 b'0-0:96.14.0(%04d)' % values["tariff"],
+                 b'1-0:1.7.0(%06.3f*kW)' % values["consumption"],
+                 b'1-0:2.7.0(%06.3f*kW)' % values["production"],
+                 b'0-0:96.7.21(00004)',
+                 b'0-0:96.7.9(00002)',
+                 b'1-0:99.97.0(0)(0-0:96.7.19)',
+                 b'1-0:32.32.0(00000)',
+                 b'1-0:52.32.0(00000)',
+                 b'1-0:72.32.0(00000)',
+                 b'1-0:32.36.0(00000)',
+                 b'1-0:52.36.0(00000)',
+                 b'1-0:72.36.0(00000)',
+                 b'0-0:96.13.0()']
+        if self.version == "5":
+            lines += [b'1-0:%d.7.0(%05.1f*V)' % (code, values["voltage_l%d" % phase])
+                      for phase, code in ((1, 32), (2, 52), (3, 72))]
+        lines += [b'1-0:%d.7.0(%03d*A)' % (code, values["current_l%d" % phase])
+                  for phase, code in ((1, 31), (2, 51), (3, 71))]
+        lines += [b'1-0:%d.7.0(%06.3f*kW)' % (code, values["power_l%d" % phase])
+                  for phase, code in ((1, 21), (2, 41), (3, 61))]
+        lines += [b'1-0:%d.7.0(%06.3f*kW)' % (code, values["return_l%d" % phase])
+                  for phase, code in ((1, 22), (2, 42), (3, 62))]
+        lines += [b'0-1:24.1.0(003)',
+                  b'0-1:96.1.0(%s)' % equipmentId(self.gasSerial),
+                  b'0-1:24.2.1(%s)(%09.3f*m3)' % (self.timestamp(gasLocal, gasSummer), values["gas"]),
+                  b'!']
+        body = b'\r\n'.join(lines)
+        return body + b'%04X\r\n' % crc16(body)
+
+
+class ptyPort():
+    """ A pseudo-terminal that looks like a serial port: powermon opens path (a
+        symlink to the terminal), the simulator writes to the other end. Like a real
+        meter it never waits: what doesn't fit while nobody reads is dropped. """
+    def __init__ (self, path):
+        if os.path.lexists(path) and not os.path.islink(path):
+            raise ValueError("%s exists, and isn't a symlink of an earlier run" % path)
+        self.path = path
+        self.master, self.slave = os.openpty()
+        # No translation of line ends, the telegrams go through as they are
+        tty.setraw(self.slave)
+        os.set_blocking(self.master, False)
+        if os.path.lexists(path):
+            os.remove(path)
+        os.symlink(os.ttyname(self.slave), path)
+        self.written = 0
+        self.dropped = 0
+
+    def write(self, data):
+        try:
+            sent = os.write(self.master, data)
+        except BlockingIOError:
+            sent = 0
+        if sent < len(data):
+            self.dropped += 1
+        else:
+            self.written += 1
+
+    def close(self):
+        if os.path.islink(self.path):
+            os.remove(self.path)
+        os.close(self.master)
+        os.close(self.slave)
+
+
+def serve(meters, ports, speed=1.0, duration=None):
+    """ Writes the telegrams of every meter to its port, as the meters would send
+        them: at their interval, or speed times as fast """
+    started = time.monotonic()
+    first = meters[0].ts
+    due = [(meter.ts + meter.interval, index) for index, meter in enumerate(meters)]
+    heapq.heapify(due)
+    sent = 0
+    while due:
+        ts, index = heapq.heappop(due)
+        if duration is not None and ts - first > duration:
+            break
+        delay = started + (ts - first) / speed - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        meter = meters[index]
+        ports[index].write(meter.telegram(meter.step()))
+        sent += 1
+        if sent % 10000 == 0:
+            logging.info("Sent %d telegrams, %d dropped while nobody was reading", sent,
+                         sum(port.dropped for port in ports))
+        heapq.heappush(due, (meter.ts + meter.interval, index))
+    return sent
+
+
+def history(meter, end, capture=None, persistence=None, meterId=None, metrics=True, maxPending=50000):
+    """ Runs a meter up to end (epoch seconds) as fast as it can, writing the
+        telegrams to capture and/or the readings to persistence. Waits for the
+        database when more than maxPending writes are queued, instead of dropping. """
+    count = 0
+    buffer = getattr(persistence, "buffer", None)
+    while meter.ts + meter.interval < end:
+        values = meter.step()
+        if capture is not None:
+            capture.write(meter.ts, meter.telegram(values))
+        if persistence is not None:
+            current = meter.reading(values)
+            persistence.storeReading(current, meterId)
+            if metrics:
+                persistence.updateMetrics(current, meterId)
+        count += 1
+        if buffer is not None and count % 1000 == 0:
+            while buffer.stats()["depth"] > maxPending:
+                time.sleep(0.01)
+    return count
+
+
+def main():
+    argparser = argparse.ArgumentParser(description="Simulates P1 meters, for load and scale testing")
+    argparser.add_argument('--meters', type=int, default=1, help="number of meters")
+    argparser.add_argument('--version', choices=sorted(VERSIONS), default='5', help="DSMR version")
+    argparser.add_argument('--interval', type=float, help="seconds between telegrams (default: as the version)")
+    argparser.add_argument('--solar', type=float, default=0.0, help="kWp of solar panels per house")
+    argparser.add_argument('--seed', type=int, default=0, help="meter n is simulated with seed + n")
+    commands = argparser.add_subparsers(dest='command', required=True)
+    served = commands.add_parser('serve', help="write telegrams to pseudo-terminals, in (sped up) real time")
+    served.add_argument('--dir', default=PTY_DIR, help="where to put the ttyUSB<n> symlinks (default %s)" % PTY_DIR)
+    served.add_argument('--speed', type=float, default=1.0, help="times as fast as real time")
+    served.add_argument('--start', type=parseTime, help="time of the first telegram (default: now)")
+    served.add_argument('--duration', type=float, help="stop after this many simulated seconds")
+    generated = commands.add_parser('history', help="generate a time range as fast as possible")
+    generated.add_argument('--start', type=parseTime, required=True)
+    generated.add_argument('--end', type=parseTime, required=True)
+    generated.add_argument('--capture', metavar='DIR', help="write the telegrams of meter n to DIR/meter<n>.cap")
+    generated.add_argument('--backend', choices=BACKENDS, help="store the readings and metrics here")
+    generated.add_argument('--mongo-url', default=MONGO_URL)
+    generated.add_argument('--db', default='powermon', help="name of the Mongo database")
+    generated.add_argument('--sqlite-path', default=SQLITE_PATH)
+    generated.add_argument('--no-metrics', action='store_true',
+                           help="store only the readings, e.g. to benchmark backfill.py")
+    args = argparser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+
+    if args.command == 'serve':
+        start = args.start.timestamp() if args.start else time.time()
+        meters = [simulatedMeter(args.version, start, args.interval, args.seed + n, args.solar)
+                  for n in range(args.meters)]
+        os.makedirs(args.dir, exist_ok=True)
+        ports = [ptyPort(os.path.join(args.dir, "ttyUSB%d" % n)) for n in range(args.meters)]
+        logging.info("Serving %d DSMR %s meter(s) on %s/ttyUSB0..%d; read them with --serial '%s'",
+                     args.meters, args.version, args.dir, args.meters - 1, VERSIONS[args.version]["serial"])
+        try:
+            serve(meters, ports, args.speed, args.duration)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            for port in ports:
+                port.close()
+        return
+
+    if not args.capture and not args.backend:
+        argparser.error("history needs --capture and/or --backend")
+    if args.backend == 'mongo':
+        persistence = createPersistence('mongo', url=args.mongo_url, dbName=args.db, maxPending=10 ** 9)
+    elif args.backend == 'sqlite':
+        persistence = createPersistence('sqlite', path=args.sqlite_path, maxPending=10 ** 9)
+    elif args.backend:
+        persistence = createPersistence(args.backend)
+    else:
+        persistence = None
+    if args.capture:
+        os.makedirs(args.capture, exist_ok=True)
+    started = time.perf_counter()
+    total = 0
+    try:
+        for n in range(args.meters):
+            meter = simulatedMeter(args.version, args.start.timestamp(), args.interval, args.seed + n, args.solar)
+            # A single meter is the default meter, more get an id
+            meterId = "sim%d" % n if args.meters > 1 else None
+            capture = captureWriter(os.path.join(args.capture, "meter%d.cap" % n)) if args.capture else None
+            try:
+                count = history(meter, args.end.timestamp(), capture, persistence, meterId, not args.no_metrics)
+            finally:
+                if capture is not None:
+                    capture.close()
+            total += count
+            logging.info("Meter %d: %d telegrams", n, count)
+    finally:
+        if persistence is not None:
+            persistence.close()
+    elapsed = time.perf_counter() - started
+    logging.info("Generated %d telegrams in %.1f s: %.0f per second", total, elapsed, total / elapsed if elapsed else 0)
+
+
+if __name__ == '__main__':
+    main()
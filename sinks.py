@@ -0,0 +1,212 @@
+#!/usr/bin/env python
+"""
+    The outputs of powermon
+
+    The meters are read and every telegram is parsed once; the telegram and its
+    reading (None if it wasn't complete) then go to every sink that takes that
+    meter:
+
+        persistenceSink  stores the readings (Mongo, SQLite, memory)
+        forwardSink      sends the raw telegrams to DSMR-reader
+        recordSink       writes the raw telegrams to a capture file or an archive
+        recentSink       keeps the last hours of readings in memory, for the HTTP server
+        peakSink         tracks the quarter-hour peaks of the month, for capacity tariffs
+
+    A sinkWorker runs a sink on a thread of its own, behind a bounded queue, so
+    adding an output costs no extra serial reads or parsing, and a slow output
+    doesn't hold up the others. As a full queue drops telegrams, the rollup of a
+    persistenceSink isn't part of its write(): powermon calls rollup() for every
+    reading before handing it to the queues, so only raw work is ever dropped.
+"""
+
+#    Copyright (C) 2016  Chris Brouwer
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import logging
+from datetime import datetime
+from time import perf_counter
+import pytz
+from instrumentation import stats
+from peak import peakTracker
+from pipeline import telegramPipeline
+
+
+class sink():
+    """ Gets write(meter, received, telegram, reading) for every telegram of the
+        meters it takes: all of them when meters is None """
+    name = "sink"
+
+    def __init__ (self, meters=None):
+        self.meters = None if meters is None else set(meters)
+
+    def accepts(self, meter):
+        return self.meters is None or meter in self.meters
+
+    def write(self, meter, received, telegram, reading):
+        pass
+
+    def close(self):
+        pass
+
+
+class persistenceSink(sink):
+    """ Stores the readings, or with a downsampler the ones it picks. rollup()
+        updates the metrics, and has to get every reading. """
+    def __init__ (self, persistence, downsampler=None, meters=None, name="store"):
+        sink.__init__(self, meters)
+        self.persistence = persistence
+        self.downsampler = downsampler
+        self.name = name
+
+    def write(self, meter, received, telegram, reading):
+        if reading is None:
+            return
+        t0 = perf_counter()
+        if self.downsampler is None:
+            self.persistence.storeReading(reading, meter)
+        else:
+            for kept in self.downsampler.offer(reading, meter):
+                self.persistence.storeReading(kept, meter)
+        stats.observe("store", perf_counter() - t0)
+
+    def rollup(self, meter, reading):
+        self.persistence.updateMetrics(reading, meter)
+
+    def close(self):
+        if self.downsampler is not None:
+            for meter, reading in self.downsampler.flush():
+                self.persistence.storeReading(reading, meter)
+            self.downsampler.report()
+        self.persistence.close()
+
+
+class forwardSink(sink):
+    """ Forwards the telegrams that hold a complete reading """
+    name = "forward"
+
+    def __init__ (self, forwarder, meters=None):
+        sink.__init__(self, meters)
+        self.forwarder = forwarder
+
+    def write(self, meter, received, telegram, reading):
+        if reading is not None:
+            self.forwarder.submit(telegram.decode('ascii', 'replace'))
+
+    def close(self):
+        self.forwarder.close()
+
+
+class recordSink(sink):
+    """ Writes every raw telegram to the writer of its meter: a captureWriter or an
+        archiveWriter per meter id """
+    name = "record"
+
+    def __init__ (self, writers, name="record"):
+        sink.__init__(self, writers)
+        self.writers = writers
+        self.name = name
+
+    def write(self, meter, received, telegram, reading):
+        self.writers[meter].write(received, telegram)
+
+    def close(self):
+        for writer in self.writers.values():
+            writer.close()
+
+
+class recentSink(sink):
+    """ Appends the readings to a readingRingBuffer """
+    name = "recent"
+
+    def __init__ (self, recent, meters=None):
+        sink.__init__(self, meters)
+        self.recent = recent
+
+    def write(self, meter, received, telegram, reading):
+        if reading is not None:
+            self.recent.append(reading)
+
+
+class peakSink(sink):
+    """ Runs a peakTracker per meter, and stores the peaks of the month whenever a
+        quarter completes. The stored peaks of the running month are loaded when a
+        meter is first seen, so a restart continues the month. """
+    name = "peaks"
+
+    def __init__ (self, persistence, topN=5, threshold=2.5, warnAfter=300, meters=None):
+        sink.__init__(self, meters)
+        self.persistence = persistence
+        self.topN = topN
+        self.threshold = threshold
+        self.warnAfter = warnAfter
+        self.trackers = {}
+
+    def tracker(self, meter, reading):
+        tracker = peakTracker(self.topN)
+        month = tracker.monthSpan(reading.timestamp.timestamp())[0]
+        try:
+            document = self.persistence.getPeaks(datetime.fromtimestamp(month, pytz.utc), meter)
+        except Exception:
+            logging.exception("Error on loading the peaks of the month, starting over")
+            document = None
+        if document is not None:
+            tracker.restore(document)
+        self.trackers[meter] = tracker
+        return tracker
+
+    def write(self, meter, received, telegram, reading):
+        if reading is None:
+            return
+        tracker = self.trackers.get(meter)
+        if tracker is None:
+            tracker = self.tracker(meter, reading)
+        finished = tracker.offer(reading)
+        if finished is not None:
+            self.persistence.writePeaks(tracker.document(), meter)
+            start, kw = finished
+            if tracker.top[0] == (kw, start) and tracker.quarters > 1:
+                logging.info("New peak of the month: %.3f kW in the quarter from %s", kw,
+                             datetime.fromtimestamp(start, tracker.tz))
+        elif tracker.warning(self.threshold, self.warnAfter):
+            peak = tracker.peak()
+            logging.warning("The quarter from %s heads for %.3f kW, above the peak of the month (%s)",
+                            datetime.fromtimestamp(tracker.boundary, tracker.tz), tracker.projected,
+                            "%.3f kW" % peak[0] if peak is not None else "none yet")
+
+
+class sinkWorker():
+    """ Runs a sink on its own thread, behind a queue of at most maxQueue telegrams """
+    def __init__ (self, sink, maxQueue=600, policy="drop-oldest"):
+        self.sink = sink
+        self.name = sink.name
+        self.accepts = sink.accepts
+        self.pipeline = telegramPipeline(self.process, maxQueue, policy, "sink-" + sink.name)
+
+    def write(self, meter, received, telegram, reading):
+        self.pipeline.submit(telegram, meter, received, reading)
+
+    def process(self, telegram, meter, received, reading):
+        self.sink.write(meter, received, telegram, reading)
+
+    def stats(self):
+        return self.pipeline.stats()
+
+    def close(self):
+        """ Lets the sink finish what is queued, then closes it """
+        self.pipeline.close()
+        try:
+            self.sink.close()
+        except Exception:
+            logging.exception("Error on closing the %s sink!", self.name)
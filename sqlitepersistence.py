@@ -0,0 +1,190 @@
+#!/usr/bin/env python
+"""
+    Embedded persistence for PowerMon, in a local SQLite database
+
+    Meant for devices where a network database is too slow or too fragile for
+    readings that arrive every second. The database runs in WAL mode, so readers
+    (e.g. a dashboard) don't block the writer, and writes are batched into one
+    transaction per flush by the write-behind buffer.
+"""
+
+#    Copyright (C) 2016  Chris Brouwer
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import json
+import logging
+import os
+import sqlite3
+import threading
+from datetime import datetime
+import pytz
+from helpers import READING_FIELDS as FIELDS
+from helpers import reading
+from persistence import basePersistence
+from persistence import writeBehindBuffer
+
+SQLITE_PATH = os.environ.get('POWERMON_SQLITE_PATH', os.path.expanduser('~/.powermon/powermon.db'))
+
+# Every field the parser knows gets a column; timestamps are stored as epoch seconds
+READING_FIELDS = tuple(name for name in FIELDS if name != "timestamp")
+TIMESTAMP_FIELDS = frozenset(("gas_timestamp",))
+
+# Primary key columns can't be NULL, so the default meter is stored as ''
+DEFAULT_METER = ""
+
+# The primary key doubles as the index for upserts and for finding the last bucket
+METRICS_SCHEMA = "CREATE TABLE IF NOT EXISTS metrics (collection TEXT NOT NULL, meter TEXT NOT NULL DEFAULT ''," \
+                 + " ts INTEGER NOT NULL, t1 REAL, t2 REAL, d_t1 REAL, d_t2 REAL, d_total REAL," \
+                 + " PRIMARY KEY (collection, meter, ts)) WITHOUT ROWID"
+
+SCHEMA = (
+    "CREATE TABLE IF NOT EXISTS reading (meter TEXT NOT NULL DEFAULT '', ts REAL NOT NULL, %s)"
+        % ", ".join("%s %s" % (name, "INTEGER" if name == "tariff" else "REAL") for name in READING_FIELDS),
+    "DROP INDEX IF EXISTS reading_ts",
+    "CREATE INDEX IF NOT EXISTS reading_meter_ts ON reading (meter, ts)",
+    METRICS_SCHEMA,
+    # The top quarters of a month as JSON [[ts, kW], ...], highest first
+    "CREATE TABLE IF NOT EXISTS peaks (meter TEXT NOT NULL DEFAULT '', ts INTEGER NOT NULL, peak_ts INTEGER,"
+        + " peak_kw REAL, top TEXT NOT NULL, quarters INTEGER NOT NULL, PRIMARY KEY (meter, ts)) WITHOUT ROWID",
+)
+
+# The SQL text never changes, so sqlite3 compiles each statement once and reuses it
+# from its statement cache
+INSERT_READING = "INSERT INTO reading (meter, ts, %s) VALUES (?, ?%s)" % (", ".join(READING_FIELDS),
+                                                                            ", ?" * len(READING_FIELDS))
+UPSERT_METRICS = "INSERT OR REPLACE INTO metrics (collection, meter, ts, t1, t2, d_t1, d_t2, d_total)" \
+                 + " VALUES (?, ?, ?, ?, ?, ?, ?, ?)"
+LAST_METRICS = "SELECT ts, t1, t2 FROM metrics WHERE collection = ? AND meter = ? ORDER BY ts DESC LIMIT 1"
+METRICS_AT = "SELECT ts, t1, t2 FROM metrics WHERE collection = ? AND meter = ? AND ts = ?"
+READING_AFTER = "SELECT ts, t1, t2 FROM reading WHERE meter = ? AND ts >= ? ORDER BY ts LIMIT 1"
+READING_BEFORE = "SELECT ts, t1, t2 FROM reading WHERE meter = ? AND ts < ? ORDER BY ts DESC LIMIT 1"
+UPSERT_PEAKS = "INSERT OR REPLACE INTO peaks (meter, ts, peak_ts, peak_kw, top, quarters) VALUES (?, ?, ?, ?, ?, ?)"
+PEAKS_AT = "SELECT ts, top, quarters FROM peaks WHERE meter = ? AND ts = ?"
+STATEMENTS = {"reading": INSERT_READING, "metrics": UPSERT_METRICS, "peaks": UPSERT_PEAKS}
+
+
+def columns(connection, table):
+    return [row[1] for row in connection.execute("PRAGMA table_info(%s)" % table)]
+
+
+def upgradeSchema(connection):
+    """ Adds the meter column to databases created before there were multiple meters """
+    existing = columns(connection, "reading")
+    if existing and "meter" not in existing:
+        logging.info("Adding the meter column to the readings")
+        connection.execute("ALTER TABLE reading ADD COLUMN meter TEXT NOT NULL DEFAULT ''")
+    existing = columns(connection, "metrics")
+    if existing and "meter" not in existing:
+        # The meter has to become part of the primary key, which needs a new table
+        logging.info("Adding the meter column to the metrics")
+        connection.execute("ALTER TABLE metrics RENAME TO metrics_upgrade")
+        connection.execute(METRICS_SCHEMA)
+        connection.execute("INSERT INTO metrics (collection, ts, t1, t2, d_t1, d_t2, d_total)"
+                           + " SELECT collection, ts, t1, t2, d_t1, d_t2, d_total FROM metrics_upgrade")
+        connection.execute("DROP TABLE metrics_upgrade")
+
+
+class sqlitePersistence(basePersistence):
+    def __init__ (self, path=SQLITE_PATH, maxBatch=100, maxLatency=5.0, checkpoint=None, maxPending=10000,
+                  overload="drop-oldest"):
+        basePersistence.__init__(self, checkpoint)
+        self.path = path
+        if path != ":memory:" and os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        # The connection is shared with the write-behind thread, guarded by self.lock
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        # In WAL mode NORMAL only risks the last transactions on a power cut, not corruption
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute("PRAGMA busy_timeout=5000")
+        with self.connection:
+            upgradeSchema(self.connection)
+            for statement in SCHEMA:
+                self.connection.execute(statement)
+        self.buffer = writeBehindBuffer(self.writeRows, maxBatch=maxBatch, maxLatency=maxLatency,
+                                        maxPending=maxPending, overload=overload)
+        self.startup()
+
+    def writeRows(self, table, rows):
+        """ Writes a batch of rows in a single transaction """
+        statement = STATEMENTS[table]
+        with self.lock:
+            with self.connection:
+                self.connection.executemany(statement, rows)
+
+    def getLastMetrics(self, collection, meter=None):
+        with self.lock:
+            row = self.connection.execute(LAST_METRICS, (collection, meter or DEFAULT_METER)).fetchone()
+        if row is None:
+            return None
+        return reading(timestamp=datetime.fromtimestamp(row[0], pytz.utc), t1=row[1], t2=row[2])
+
+    def getMetricsAt(self, collection, ts, meter=None):
+        with self.lock:
+            row = self.connection.execute(METRICS_AT, (collection, meter or DEFAULT_METER,
+                                                       int(ts.timestamp()))).fetchone()
+        return self.counters(row)
+
+    def getReadingsAround(self, ts, meter=None):
+        with self.lock:
+            before = self.connection.execute(READING_BEFORE, (meter or DEFAULT_METER, ts.timestamp())).fetchone()
+            after = self.connection.execute(READING_AFTER, (meter or DEFAULT_METER, ts.timestamp())).fetchone()
+        return self.counters(before), self.counters(after)
+
+    def counters(self, row):
+        if row is None:
+            return None
+        return reading(timestamp=datetime.fromtimestamp(row[0], pytz.utc), t1=row[1], t2=row[2])
+
+    def storeReading(self, reading, meter=None):
+        row = [meter or DEFAULT_METER, reading.timestamp.timestamp()]
+        for field in READING_FIELDS:
+            value = getattr(reading, field, None)
+            if field in TIMESTAMP_FIELDS and value is not None:
+                value = value.timestamp()
+            row.append(value)
+        self.buffer.add("reading", row)
+
+    def writeMetrics(self, collection, document, meter=None):
+        # All metrics share one table, so a flush is one transaction for all of them
+        self.buffer.add("metrics", (collection, meter or DEFAULT_METER, int(document["ts"].timestamp()),
+                                    document["t1"], document["t2"], document["d_t1"],
+                                    document["d_t2"], document["d_total"]))
+
+    def writePeaks(self, document, meter=None):
+        top = [[int(entry["ts"].timestamp()), entry["kw"]] for entry in document["top"]]
+        peakTs = document["peak_ts"]
+        self.buffer.add("peaks", (meter or DEFAULT_METER, int(document["ts"].timestamp()),
+                                  int(peakTs.timestamp()) if peakTs is not None else None,
+                                  document["peak_kw"], json.dumps(top), document["quarters"]))
+
+    def getPeaks(self, ts, meter=None):
+        with self.lock:
+            row = self.connection.execute(PEAKS_AT, (meter or DEFAULT_METER, int(ts.timestamp()))).fetchone()
+        if row is None:
+            return None
+        top = [{"ts": datetime.fromtimestamp(start, pytz.utc), "kw": kw} for start, kw in json.loads(row[1])]
+        return {"ts": datetime.fromtimestamp(row[0], pytz.utc),
+                "peak_kw": top[0]["kw"] if top else None,
+                "peak_ts": top[0]["ts"] if top else None,
+                "top": top,
+                "quarters": row[2]}
+
+    def close(self):
+        basePersistence.close(self)
+        self.buffer.close()
+        with self.lock:
+            self.connection.close()
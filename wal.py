@@ -0,0 +1,347 @@
+#!/usr/bin/env python
+"""
+    A local write-ahead log for the database writes
+
+    Every write is appended to a log on local disk first, and a background thread
+    replays the log into the database in bulk. When the database is unreachable a
+    circuit breaker stops the replaying, so nothing waits for it, and the log just
+    grows until the database is back. Replaying is idempotent (readings have
+    deterministic ids, metrics are upserts), so after a crash the log is simply
+    replayed again from the last position that was known to be written.
+
+    The log is a directory of numbered segment files holding BSON documents back to
+    back, plus a cursor file with the replay position. Segments that have been
+    replayed completely are deleted.
+"""
+
+#    Copyright (C) 2016  Chris Brouwer
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import json
+import logging
+import os
+import struct
+import threading
+import time
+from time import perf_counter
+import bson
+import pytz
+from bson.codec_options import CodecOptions
+from helpers import circuitBreaker
+from instrumentation import stats
+
+WAL_DIR = os.path.expanduser('~/.powermon/wal')
+
+# A BSON document starts with its length, including those four bytes
+LENGTH = struct.Struct("<i")
+CODEC_OPTIONS = CodecOptions(tz_aware=True, tzinfo=pytz.utc)
+
+
+class writeAheadLog():
+    """ Appends BSON documents to segment files of about segmentBytes, and reads them
+        back from a (segment, offset) position. One thread appends, another reads and
+        commits; segments are never modified once a newer one exists. When the log
+        grows beyond maxBytes, the oldest segments are dropped. """
+    def __init__ (self, directory=WAL_DIR, segmentBytes=4 * 1024 * 1024, maxBytes=1024 * 1024 * 1024):
+        self.directory = directory
+        self.segmentBytes = segmentBytes
+        self.maxBytes = maxBytes
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+        segments = self.segments()
+        self.cursor = self.loadCursor()
+        if segments and self.cursor[0] < segments[0]:
+            self.cursor = (segments[0], 0)
+        self.active = segments[-1] if segments else self.cursor[0]
+        self.recover(self.active)
+        self.file = open(self.path(self.active), "ab", buffering=0)
+        self.size = self.file.tell()
+        self.pending = self.count(self.cursor)
+        self.dropped = 0
+        if self.pending:
+            logging.info("Write-ahead log holds %d records that still have to be written", self.pending)
+
+    def path(self, segment):
+        return os.path.join(self.directory, "%012d.wal" % segment)
+
+    def segments(self):
+        return sorted(int(name[:-4]) for name in os.listdir(self.directory) if name.endswith(".wal"))
+
+    def nbytes(self):
+        return sum(os.path.getsize(self.path(segment)) for segment in self.segments())
+
+    def loadCursor(self):
+        try:
+            with open(os.path.join(self.directory, "cursor")) as f:
+                cursor = json.load(f)
+            return (cursor["segment"], cursor["offset"])
+        except FileNotFoundError:
+            return (0, 0)
+        except (OSError, ValueError, KeyError):
+            # Replaying from the start is harmless, just slower
+            logging.exception("Unreadable write-ahead log cursor, replaying everything")
+            return (0, 0)
+
+    def saveCursor(self):
+        # Not synced: losing the cursor only means replaying records again
+        path = os.path.join(self.directory, "cursor")
+        with open(path + ".tmp", "w") as f:
+            json.dump({"segment": self.cursor[0], "offset": self.cursor[1]}, f)
+        os.replace(path + ".tmp", path)
+
+    def recover(self, segment):
+        """ Cuts off a record that was only partly written when we stopped """
+        try:
+            with open(self.path(segment), "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            return
+        end = 0
+        for end, document in self.parse(data, 0):
+            pass
+        if end < len(data):
+            logging.warning("Dropping %d bytes of an incomplete record at the end of %s",
+                            len(data) - end, self.path(segment))
+            with open(self.path(segment), "r+b") as f:
+                f.truncate(end)
+
+    def parse(self, data, offset, limit=None):
+        """ Yields (offset after, document) for the complete records in data """
+        n = 0
+        while offset + LENGTH.size <= len(data) and (limit is None or n < limit):
+            length = LENGTH.unpack_from(data, offset)[0]
+            if length < 5 or offset + length > len(data):
+                return
+            try:
+                document = bson.decode(data[offset:offset + length], CODEC_OPTIONS)
+            except Exception:
+                return
+            offset += length
+            n += 1
+            yield offset, document
+
+    def append(self, document):
+        data = bson.encode(document)
+        with self.lock:
+            if self.size and self.size + len(data) > self.segmentBytes:
+                self.roll()
+            self.file.write(data)
+            self.size += len(data)
+            self.pending += 1
+
+    def roll(self):
+        """ Closes the active segment and starts the next one; called holding the lock """
+        os.fsync(self.file.fileno())
+        self.file.close()
+        self.active += 1
+        self.file = open(self.path(self.active), "ab", buffering=0)
+        self.size = 0
+
+    def sync(self):
+        """ Makes what was appended so far survive a power cut """
+        with self.lock:
+            fd = self.file.fileno()
+        try:
+            os.fsync(fd)
+        except OSError:
+            # The segment was rolled (and synced) in the meantime
+            pass
+
+    def read(self, position, limit):
+        """ Returns up to limit documents from position, and the position after them """
+        with self.lock:
+            active = self.active
+            size = self.size
+        segment, offset = position
+        documents = []
+        while len(documents) < limit:
+            try:
+                with open(self.path(segment), "rb") as f:
+                    f.seek(offset)
+                    data = f.read(size - offset if segment == active else -1)
+            except FileNotFoundError:
+                data = b""
+            for end, document in self.parse(data, 0, limit - len(documents)):
+                documents.append(document)
+                position = (segment, offset + end)
+            if len(documents) >= limit or segment >= active:
+                break
+            segment, offset = segment + 1, 0
+            position = (segment, 0)
+        return documents, position
+
+    def count(self, position):
+        n = 0
+        while True:
+            documents, position = self.read(position, 10000)
+            if not documents:
+                return n
+            n += len(documents)
+
+    def commit(self, position, count):
+        """ Marks everything before position as written """
+        with self.lock:
+            self.cursor = position
+            self.pending -= count
+            active = self.active
+        self.saveCursor()
+        for segment in self.segments():
+            if segment < min(position[0], active):
+                os.remove(self.path(segment))
+
+    def trim(self):
+        """ Drops the oldest segments while the log is larger than maxBytes """
+        dropped = 0
+        segments = self.segments()
+        total = sum(os.path.getsize(self.path(segment)) for segment in segments)
+        for segment in segments:
+            if total <= self.maxBytes or segment >= self.active:
+                break
+            total -= os.path.getsize(self.path(segment))
+            os.remove(self.path(segment))
+            dropped += 1
+            if self.cursor[0] <= segment:
+                self.cursor = (segment + 1, 0)
+        if dropped:
+            logging.warning("Write-ahead log over %d bytes: dropped the %d oldest segments", self.maxBytes, dropped)
+            self.saveCursor()
+            pending = self.count(self.cursor)
+            with self.lock:
+                self.dropped += max(0, self.pending - pending)
+                self.pending = pending
+
+    def close(self):
+        with self.lock:
+            os.fsync(self.file.fileno())
+            self.file.close()
+
+
+class walBuffer():
+    """ Takes the place of writeBehindBuffer: add(collection, item) appends to the log,
+        and a background thread hands the records to write(collection, items), at
+        most maxBatch at a time, every maxLatency seconds or as soon as maxBatch are
+        waiting. Items have to be BSON documents. A failing write leaves the records
+        in the log, and opens the breaker. """
+    def __init__ (self, write, log, breaker=None, maxBatch=1000, maxLatency=5.0, syncInterval=1.0):
+        self.write = write
+        self.log = log
+        self.breaker = breaker if breaker is not None else circuitBreaker()
+        self.maxBatch = maxBatch
+        self.maxLatency = maxLatency
+        self.syncInterval = syncInterval
+
+        # Statistics
+        self.flushes = 0
+        self.written = 0
+        self.failed = 0
+        self.highWater = 0
+        self.lastFlushSize = 0
+        self.maxFlushSize = 0
+        self.lastFlushLatency = None
+        self.maxFlushLatency = 0.0
+        self.totalFlushLatency = 0.0
+
+        self.wakeup = threading.Event()
+        self.stopping = threading.Event()
+        self.thread = threading.Thread(target=self.run, name="wal-replay", daemon=True)
+        self.thread.start()
+
+    def add(self, collection, item):
+        self.log.append({"c": collection, "i": item})
+        if self.log.pending > self.highWater:
+            self.highWater = self.log.pending
+        if self.log.pending >= self.maxBatch:
+            self.wakeup.set()
+
+    def run(self):
+        lastFlush = time.monotonic()
+        while not self.stopping.is_set():
+            self.wakeup.wait(min(self.syncInterval, self.maxLatency))
+            self.wakeup.clear()
+            self.log.sync()
+            if self.log.pending >= self.maxBatch or time.monotonic() - lastFlush >= self.maxLatency:
+                lastFlush = time.monotonic()
+                try:
+                    self.log.trim()
+                    self.flush()
+                except Exception:
+                    logging.exception("Error on replaying the write-ahead log!")
+
+    def flush(self):
+        """ Writes everything in the log, stopping at the first failure """
+        while self.log.pending and self.breaker.allow():
+            documents, position = self.log.read(self.log.cursor, self.maxBatch)
+            if not documents:
+                return
+            pending = {}
+            for document in documents:
+                pending.setdefault(document["c"], []).append(document["i"])
+            start = time.monotonic()
+            try:
+                for collection, items in pending.items():
+                    t0 = perf_counter()
+                    self.write(collection, items)
+                    stats.observe("write", perf_counter() - t0)
+            except Exception as e:
+                self.breaker.failure()
+                self.failed += len(documents)
+                if self.breaker.isClosed():
+                    logging.exception("Error on writing %d records from the write-ahead log!", len(documents))
+                else:
+                    logging.warning("Database unavailable, keeping %d records in the write-ahead log: %s",
+                                    self.log.pending, e)
+                return
+            self.breaker.success()
+            # Anything written before a crash between these two lines is written again
+            # on the next start, which the deterministic ids make harmless
+            self.log.commit(position, len(documents))
+            latency = time.monotonic() - start
+            self.written += len(documents)
+            self.flushes += 1
+            self.lastFlushSize = len(documents)
+            self.maxFlushSize = max(self.maxFlushSize, len(documents))
+            self.lastFlushLatency = latency
+            self.maxFlushLatency = max(self.maxFlushLatency, latency)
+            self.totalFlushLatency += latency
+
+    def stats(self):
+        flushes = self.flushes
+        return {"depth": self.log.pending,
+                "high_water": self.highWater,
+                "flushes": flushes,
+                "written": self.written,
+                "failed": self.failed,
+                "dropped": self.log.dropped,
+                "flush_size_last": self.lastFlushSize,
+                "flush_size_max": self.maxFlushSize,
+                "flush_size_avg": self.written / flushes if flushes else None,
+                "flush_latency_last": self.lastFlushLatency,
+                "flush_latency_max": self.maxFlushLatency,
+                "flush_latency_avg": self.totalFlushLatency / flushes if flushes else None,
+                "wal_bytes": self.log.nbytes(),
+                "circuit": self.breaker.state}
+
+    def close(self):
+        """ Stops the background thread and tries a last flush; what can't be written
+            stays in the log for the next start """
+        self.stopping.set()
+        self.wakeup.set()
+        self.thread.join()
+        try:
+            self.flush()
+        except Exception:
+            logging.exception("Error on replaying the write-ahead log!")
+        self.log.close()